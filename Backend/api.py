@@ -1,36 +1,257 @@
-from fastapi import FastAPI, UploadFile, File, HTTPException
-from fastapi.responses import FileResponse
+from fastapi import FastAPI, UploadFile, File, HTTPException, Query, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import FileResponse, JSONResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
+from pydantic import BaseModel
+from typing import List, Literal
+from contextlib import asynccontextmanager
+from datetime import datetime
+from urllib.parse import quote
 import photoapp
+import responses
+import events
+import uploads
+import limits
+import reconciler
+import similarity
+import storage
+import asyncio
+import logging
 import os
+import re
+import shutil
 
-app = FastAPI(title="PhotoApp API", version="1.0.0")
+#
+# startup configuration, overridable per deployment (see serve.py):
+#
+CONFIG_FILE = os.environ.get("PHOTOAPP_CONFIG", "photoapp-config.ini")
+S3_PROFILE = os.environ.get("PHOTOAPP_S3_PROFILE", "s3readwrite")
+MYSQL_USER = os.environ.get("PHOTOAPP_MYSQL_USER", "photoapp-read-write")
 
-# Enable CORS for frontend
+
+async def reconcile_periodically(interval, cleanup, grace, lock_path):
+    """
+    Run photoapp.reconcile() every interval seconds; with several workers
+    the lock file makes sure only one of them runs it at a time.
+    """
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await run_in_threadpool(photoapp.reconcile, cleanup, grace, lock_path)
+        except Exception:
+            pass  # logged by photoapp.reconcile; try again next interval
+
+
+async def relabel_periodically(interval, lock_path):
+    """
+    Label the assets whose label detection was shed under load, every
+    interval seconds; the lock file keeps it to one worker at a time.
+    """
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await run_in_threadpool(photoapp.relabel_pending, lock_path=lock_path)
+        except Exception:
+            pass  # logged by photoapp.relabel_pending; try again next interval
+
+
+async def expire_uploads_periodically(interval):
+    """Abort chunked uploads left idle for longer than their TTL."""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await run_in_threadpool(UPLOADS.expire)
+        except Exception as err:
+            logging.warning(f"expiring uploads failed: {err}")
+
+
+@asynccontextmanager
+async def lifespan(app):
+    """Build the photoapp context on startup, release it on shutdown."""
+    state_dir = os.environ.get("PHOTOAPP_STATE_DIR")
+    if state_dir:
+        photoapp.use_shared_state(state_dir)
+        #
+        # so every worker can serve every request of a chunked upload:
+        #
+        global UPLOADS
+        UPLOADS = uploads.UploadManager(store=uploads.SharedUploadStore(os.path.join(state_dir, "uploads")))
+    warm = os.environ.get("PHOTOAPP_PREWARM", "0") == "1"
+    await run_in_threadpool(photoapp.initialize, CONFIG_FILE, S3_PROFILE, MYSQL_USER, warm)
+    # a worker (re)started after a POST /initialize uses its settings:
+    await run_in_threadpool(photoapp.follow_initialize)
+
+    config = photoapp.current_context().config
+    limits.configure(limits.from_config(config, state_dir))
+
+    # load the near-duplicate index in the background; until it's ready
+    # similarity queries fall back to SQL:
+    photoapp.start_similarity_rebuild()
+
+    #
+    # background storage / database reconciliation, configured by the
+    # [reconcile] section of the config file (off unless interval > 0).
+    # Cleanup deletes, so it only runs under the lock in the state
+    # directory, which keeps it to one worker at a time:
+    #
+    reconciling = None
+    interval = config.getint("reconcile", "interval", fallback=0)
+    if interval > 0:
+        cleanup = config.getboolean("reconcile", "cleanup", fallback=False)
+        if cleanup and not state_dir:
+            logging.warning("[reconcile] cleanup needs PHOTOAPP_STATE_DIR (see serve.py); reporting only")
+            cleanup = False
+        reconciling = asyncio.create_task(reconcile_periodically(
+            interval,
+            cleanup,
+            config.getint("reconcile", "grace", fallback=reconciler.GRACE),
+            os.path.join(state_dir, "reconcile.lock") if state_dir else None,
+        ))
+    #
+    # labels for assets uploaded while label detection was at capacity,
+    # every [labels] relabel_interval seconds (0 disables it):
+    #
+    relabeling = None
+    interval = config.getint("labels", "relabel_interval", fallback=photoapp.RELABEL_INTERVAL)
+    if interval > 0:
+        relabeling = asyncio.create_task(relabel_periodically(
+            interval,
+            os.path.join(state_dir, "relabel.lock") if state_dir else None,
+        ))
+
+    expiring = asyncio.create_task(expire_uploads_periodically(uploads.SWEEP_INTERVAL))
+    try:
+        yield
+    finally:
+        expiring.cancel()
+        if relabeling is not None:
+            relabeling.cancel()
+        if reconciling is not None:
+            reconciling.cancel()
+        photoapp.shutdown()
+
+
+app = FastAPI(title="PhotoApp API", version="1.0.0", lifespan=lifespan)
+
+#
+# column names for the photoapp row tuples returned by the list endpoints:
+#
+USER_COLUMNS = ("userid", "username", "givenname", "familyname")
+IMAGE_COLUMNS = photoapp.IMAGE_COLUMNS
+LABEL_SEARCH_COLUMNS = ("assetid", "label", "confidence")
+
+#
+# list endpoints accept ?format=columnar for parallel arrays instead
+# of one object per row:
+#
+ListFormat = Literal["rows", "columnar"]
+
+
+@app.middleware("http")
+async def pin_context(request: Request, call_next):
+    """
+    Pin the current photoapp context for the whole request, so a
+    concurrent POST /initialize never switches it mid-request.
+    """
+    if photoapp.context_outdated():
+        # another worker ran POST /initialize:
+        await run_in_threadpool(photoapp.follow_initialize)
+    with photoapp.use_context():
+        return await call_next(request)
+
+
+#
+# admission control for the upload endpoints, by (method, path):
+# "rate" takes a token from the user's and the global bucket, "slot"
+# holds one of the concurrent upload slots while the request runs.
+#
+ADMISSION_RULES = [
+    ("POST", re.compile(r"/images/(\d+)"), ("rate", "slot")),
+    ("POST", re.compile(r"/uploads/(\d+)"), ("rate",)),
+    ("PUT", re.compile(r"/uploads/[^/]+/chunks/\d+"), ("slot",)),
+    ("POST", re.compile(r"/uploads/[^/]+/complete"), ("slot",)),
+]
+
+
+def overloaded_response(e):
+    return JSONResponse(
+        status_code=429,
+        content={"detail": e.reason},
+        headers={"Retry-After": limits.retry_after_header(e.retry_after)},
+    )
+
+
+@app.middleware("http")
+async def admission_control(request: Request, call_next):
+    """
+    Shed upload requests with 429 + Retry-After when the user or the
+    server is over its limits. Runs before the request body is read,
+    so a shed upload costs almost nothing.
+    """
+    for method, pattern, checks in ADMISSION_RULES:
+        match = pattern.fullmatch(request.url.path)
+        if request.method == method and match:
+            break
+    else:
+        return await call_next(request)
+
+    admission = limits.ADMISSION
+    try:
+        if "rate" in checks:
+            admission.check_capacity()
+            admission.check_rate(int(match.group(1)))
+        if "slot" in checks and not admission.uploads.try_acquire():
+            await run_in_threadpool(admission.uploads.acquire)
+    except limits.Overloaded as e:
+        return overloaded_response(e)
+
+    if "slot" not in checks:
+        return await call_next(request)
+    try:
+        return await call_next(request)
+    finally:
+        admission.uploads.release()
+
+
+# Enable CORS for frontend (added last, so it also wraps the middleware
+# above and their 429 responses)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["http://localhost:5173", "http://localhost:3000"],
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["ETag", "Retry-After"],
 )
 
-@app.on_event("startup")
-def startup_event():
-    """Initialize photoapp on startup"""
-    photoapp.initialize('photoapp-config.ini', 's3readwrite', 'photoapp-read-write')
-
 
 @app.post("/initialize")
 def initialize(config_file: str, s3_profile: str, mysql_user: str):
-    """Initialize the photoapp with configuration."""
+    """
+    Re-initialize the photoapp with another configuration. The new
+    context is built and warmed before it replaces the current one;
+    requests already running finish on the old context. The other
+    workers switch before serving their next request.
+    """
     try:
-        photoapp.initialize(config_file, s3_profile, mysql_user)
+        photoapp.initialize(config_file, s3_profile, mysql_user, warm=True, broadcast=True)
         return {"success": True, "message": "Initialized successfully"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@app.post("/warmup")
+def warmup():
+    """
+    Pre-create pooled database connections and AWS clients, e.g. right
+    after a cold start, before real traffic arrives.
+    """
+    try:
+        return photoapp.warm_up()
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
 @app.get("/ping")
 def ping():
     """Check connection to S3 and database."""
@@ -41,44 +262,71 @@ def ping():
         raise HTTPException(status_code=500, detail=str(e))
 
 
+def check_catalog_etag(request, version=None):
+    """
+    Returns (tag, response) for a metadata request: response is a 304
+    if the client's copy is current, else None and the caller should
+    run the query and send tag with the result. The version (default:
+    the catalog version) is read before querying, so the tag never
+    claims newer data than the query saw.
+    """
+    if version is None:
+        version = photoapp.get_catalog_version()
+    tag = responses.etag(request, version)
+    return tag, responses.not_modified(request, tag)
+
+
 @app.get("/users")
-def get_users():
+def get_users(request: Request, format: ListFormat = "rows"):
     """Get all users."""
+    try:
+        version = photoapp.get_users_version()
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    tag, cached = check_catalog_etag(request, version)
+    if cached:
+        return cached
     try:
         users = photoapp.get_users()
-        return {
-            "users": [
-                {
-                    "userid": r[0],
-                    "username": r[1],
-                    "givenname": r[2],
-                    "familyname": r[3],
-                }
-                for r in users
-            ]
-        }
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+    return responses.rows_response(request, "users", USER_COLUMNS, users, format,
+                                   headers=responses.cache_headers(tag))
 
 
 @app.get("/images")
-def get_images(userid: int = None):
-    """Get all images or images for a specific user."""
-    try:
-        images = photoapp.get_images(userid=userid)
-        return {
-            "images": [
-                {
-                    "assetid": r[0],
-                    "userid": r[1],
-                    "localname": r[2],
-                    "bucketkey": r[3],
-                }
-                for r in images
-            ]
-        }
+def get_images(
+    request: Request,
+    userid: int = None,
+    include: str = None,
+    format: ListFormat = "rows",
+    min_width: int = None,
+    taken_after: datetime = None,
+    similar_to: int = None,
+    max_distance: int = Query(photoapp.SIMILAR_DISTANCE, ge=0, le=similarity.MAX_DISTANCE),
+    similar_limit: int = Query(photoapp.SIMILAR_LIMIT, ge=1, le=1000),
+):
+    """
+    Get all images or images for a specific user; include=labels adds each image's labels.
+    Filters: min_width (pixels), taken_after (EXIF capture time), similar_to (an assetid;
+    the similar_limit nearest images whose perceptual hash is within max_distance bits of it).
+    """
+    tag, cached = check_catalog_etag(request)
+    if cached:
+        return cached
+    try:
+        images = photoapp.get_images(userid=userid, min_width=min_width, taken_after=taken_after,
+                                     similar_to=similar_to, max_distance=max_distance,
+                                     similar_limit=similar_limit)
+        columns = IMAGE_COLUMNS
+        if include == "labels":
+            labels = photoapp.get_labels_for_assets([r[0] for r in images])
+            images = [r + (labels[r[0]],) for r in images]
+            columns = IMAGE_COLUMNS + ("labels",)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+    return responses.rows_response(request, "images", columns, images, format,
+                                   headers=responses.cache_headers(tag))
 
 
 @app.post("/images/{userid}")
@@ -86,9 +334,9 @@ def upload_image(userid: int, file: UploadFile = File(...)):
     """Upload an image for a user."""
     try:
         filename = file.filename
-        # Save file temporarily
+        # Save file temporarily, streaming rather than reading it all into memory
         with open(filename, "wb") as f:
-            f.write(file.file.read())
+            shutil.copyfileobj(file.file, f, 1024 * 1024)
         
         assetid = photoapp.post_image(userid, filename)
         
@@ -100,14 +348,34 @@ def upload_image(userid: int, file: UploadFile = File(...)):
         raise HTTPException(status_code=500, detail=str(e))
 
 
+def iter_stream(f):
+    """Yields a file object's contents a chunk at a time, then closes it."""
+    try:
+        while True:
+            chunk = f.read(storage.CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+    finally:
+        f.close()
+
+
 @app.get("/images/{assetid}/download")
 def download_image(assetid: int):
     """Download an image."""
     try:
-        filename = f"download_{assetid}.jpg"
-        photoapp.get_image(assetid, filename)
-        return FileResponse(filename, filename=filename)
-    except ValueError as e:
+        localname, mime, source = photoapp.open_image(assetid)
+        filename = os.path.basename(localname)
+        media_type = mime or "application/octet-stream"
+        if isinstance(source, str):
+            # the local backend's file itself, sent without copying it
+            return FileResponse(source, media_type=media_type, filename=filename)
+        return StreamingResponse(
+            iter_stream(source),
+            media_type=media_type,
+            headers={"Content-Disposition": f"attachment; filename*=utf-8''{quote(filename)}"},
+        )
+    except (ValueError, storage.NoSuchKey) as e:
         raise HTTPException(status_code=404, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -124,29 +392,191 @@ def delete_all_images():
 
 
 @app.get("/images/{assetid}/labels")
-def get_image_labels(assetid: int):
+def get_image_labels(request: Request, assetid: int):
     """Get labels for an image."""
+    tag, cached = check_catalog_etag(request)
+    if cached:
+        return cached
     try:
         labels = photoapp.get_image_labels(assetid)
-        return {
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    return responses.json_response(
+        request,
+        {
             "assetid": assetid,
             "labels": [{"label": r[0], "confidence": r[1]} for r in labels],
-        }
+        },
+        headers=responses.cache_headers(tag),
+    )
+
+
+@app.get("/images/{assetid}/similar")
+def get_similar_images(
+    request: Request,
+    assetid: int,
+    max_distance: int = Query(photoapp.SIMILAR_DISTANCE, ge=0, le=similarity.MAX_DISTANCE),
+    limit: int = Query(photoapp.SIMILAR_LIMIT, ge=1, le=1000),
+    format: ListFormat = "rows",
+):
+    """
+    Get the images that look like an image (near-duplicates): those whose perceptual
+    hash is within max_distance bits of its hash, nearest first.
+    """
+    tag, cached = check_catalog_etag(request)
+    if cached:
+        return cached
+    try:
+        images = photoapp.find_similar(assetid, max_distance=max_distance, limit=limit)
+    except ValueError as e:
+        raise HTTPException(status_code=404, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+    return responses.rows_response(request, "images", IMAGE_COLUMNS + ("distance",), images, format,
+                                   headers=responses.cache_headers(tag))
 
 
 @app.get("/labels/{label}")
-def get_images_by_label(label: str):
-    """Get all images with a specific label."""
+def get_images_by_label(request: Request, label: str, format: ListFormat = "rows"):
+    """Get all images with a label starting with the given text (case-insensitive)."""
+    tag, cached = check_catalog_etag(request)
+    if cached:
+        return cached
     try:
         images = photoapp.get_images_with_label(label)
-        return {
-            "label": label,
-            "images": [
-                {"assetid": r[0], "label": r[1], "confidence": r[2]}
-                for r in images
-            ],
-        }
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+    return responses.rows_response(request, "images", LABEL_SEARCH_COLUMNS, images, format,
+                                   extra={"label": label}, headers=responses.cache_headers(tag))
+
+
+class LabelBatchRequest(BaseModel):
+    assetids: List[int]
+
+
+#
+# max # of assetids accepted by one POST /labels/batch (the frontend's
+# getLabelsBatch splits larger lists to match):
+#
+MAX_LABEL_BATCH = 1000
+
+
+@app.post("/labels/batch")
+def get_labels_batch(request: LabelBatchRequest):
+    """Get labels for many images in one call, as {assetid: [[label, confidence], ...]}."""
+    if len(request.assetids) > MAX_LABEL_BATCH:
+        raise HTTPException(status_code=400, detail=f"at most {MAX_LABEL_BATCH} assetids per batch")
+    try:
+        labels = photoapp.get_labels_for_assets(request.assetids)
+        return {"labels": labels}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+#
+# seconds between keep-alive comments on an idle /events stream:
+#
+EVENTS_KEEPALIVE = 15
+
+
+@app.get("/events")
+async def get_events(userid: int = None):
+    """Stream upload and labeling progress as Server-Sent Events, optionally for one user."""
+    predicate = None
+    if userid is not None:
+        predicate = lambda event: event.get("userid") == userid
+    sub = events.BUS.subscribe(predicate=predicate)
+
+    async def stream():
+        try:
+            yield "retry: 3000\n\n"
+            while True:
+                event = await sub.get(timeout=EVENTS_KEEPALIVE)
+                if event is None:
+                    yield ": keep-alive\n\n"
+                else:
+                    yield events.format_sse(event)
+        finally:
+            events.BUS.unsubscribe(sub)
+
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+UPLOADS = uploads.UploadManager()
+
+
+def upload_error(e):
+    """Maps a chunked-upload exception to an HTTPException."""
+    if isinstance(e, uploads.NoSuchUpload):
+        return HTTPException(status_code=404, detail="no such upload")
+    if isinstance(e, ValueError):
+        return HTTPException(status_code=400, detail=str(e))
+    return HTTPException(status_code=500, detail=str(e))
+
+
+@app.post("/uploads/{userid}")
+def begin_upload(userid: int, filename: str, size: int = None):
+    """Start a resumable chunked upload; returns the upload id and the chunk size to use."""
+    try:
+        upload = UPLOADS.begin(userid, filename, size)
+    except Exception as e:
+        raise upload_error(e)
+    return {
+        "upload_id": upload.upload_id,
+        "chunk_size": UPLOADS.chunk_size,
+        "expires_in": UPLOADS.ttl,
+    }
+
+
+@app.get("/uploads/{upload_id}")
+def get_upload(upload_id: str):
+    """Get the parts received so far, so an interrupted upload can resume."""
+    try:
+        return UPLOADS.status(upload_id)
+    except Exception as e:
+        raise upload_error(e)
+
+
+@app.put("/uploads/{upload_id}/chunks/{part_number}")
+async def put_upload_chunk(upload_id: str, part_number: int, request: Request):
+    """Upload part part_number (from 1) of a chunked upload; the request body is the raw bytes."""
+    limit = UPLOADS.chunk_size
+    declared = request.headers.get("content-length")
+    if declared is not None and declared.isdigit() and int(declared) > limit:
+        raise HTTPException(status_code=413, detail=f"chunk larger than {limit} bytes")
+
+    # read at most one chunk, so memory use is bounded by the chunk size
+    data = bytearray()
+    async for piece in request.stream():
+        data += piece
+        if len(data) > limit:
+            raise HTTPException(status_code=413, detail=f"chunk larger than {limit} bytes")
+
+    try:
+        return await run_in_threadpool(UPLOADS.put_chunk, upload_id, part_number, bytes(data))
+    except Exception as e:
+        raise upload_error(e)
+
+
+@app.post("/uploads/{upload_id}/complete")
+def complete_upload(upload_id: str):
+    """Assemble the uploaded chunks into an image; returns the new assetid."""
+    try:
+        assetid = UPLOADS.complete(upload_id)
+    except Exception as e:
+        raise upload_error(e)
+    return {"assetid": assetid, "message": "Image uploaded successfully"}
+
+
+@app.delete("/uploads/{upload_id}")
+def abort_upload(upload_id: str):
+    """Abandon a chunked upload."""
+    try:
+        UPLOADS.abort(upload_id)
+    except Exception as e:
+        raise upload_error(e)
+    return {"success": True, "message": "Upload aborted"}
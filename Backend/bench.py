@@ -0,0 +1,166 @@
+#
+# Benchmarks for the photoapp API functions.
+#
+# Times the per-request query functions against the configured
+# database, then EXPLAINs the hot queries and fails (exit code 1)
+# if any of them falls back to a full table or index scan.
+#
+#   python bench.py [iterations]
+#
+# The serialization benchmark needs no AWS access:
+#
+#   python bench.py serialize [rows]
+#
+# nor does the near-duplicate index benchmark (synthetic hashes):
+#
+#   python bench.py similar [assets]
+#
+
+import photoapp
+import migrations
+import responses
+import similarity
+import json
+import sys
+import time
+
+
+def timeit(name, fn, iterations):
+  start = time.perf_counter()
+  for _ in range(iterations):
+    fn()
+  elapsed = time.perf_counter() - start
+  print(f"{name:<32} {elapsed / iterations * 1000:8.2f} ms/op")
+
+
+def run_queries(iterations):
+  print("**query timings**")
+
+  users = photoapp.get_users()
+  images = photoapp.get_images()
+
+  timeit("get_users", photoapp.get_users, iterations)
+  timeit("get_images", photoapp.get_images, iterations)
+
+  if users:
+    userid = users[0][0]
+    timeit("get_images(userid)", lambda: photoapp.get_images(userid=userid), iterations)
+
+  if images:
+    assetid = images[0][0]
+    timeit("get_image_labels", lambda: photoapp.get_image_labels(assetid), iterations)
+
+  timeit("get_images_with_label", lambda: photoapp.get_images_with_label("a"), iterations)
+
+
+def check_plans():
+  print("**query plans**")
+
+  dbConn = photoapp.get_dbConn()
+  try:
+    flagged = migrations.check_query_plans(dbConn, photoapp.HOT_QUERIES)
+  finally:
+    dbConn.close()
+
+  for name, table, access, keys in flagged:
+    print(f"FULL SCAN: {name}: table {table}, type {access}, possible keys {keys}")
+  if not flagged:
+    print("all hot queries use indexes")
+
+  return not flagged
+
+
+def run_serialization(nrows, iterations=5):
+  from fastapi.encoders import jsonable_encoder
+
+  print(f"**serialization, {nrows} image rows** (orjson: {responses.orjson is not None})")
+
+  rows = [(1001 + i, 80001 + i % 3, f"IMG_{i:05}.jpg", f"p_sarkar/{i:08x}-IMG_{i:05}.jpg")
+          for i in range(nrows)]
+  columns = ("assetid", "userid", "localname", "bucketkey")
+
+  def baseline():
+    payload = {"images": [dict(zip(columns, r)) for r in rows]}
+    return json.dumps(jsonable_encoder(payload)).encode("utf-8")
+
+  def fast_rows():
+    return b'{"images":' + responses.dumps_rows(columns, rows) + b"}"
+
+  def json_rows():
+    return b'{"images":' + responses._dumps_rows_by_column(columns, rows) + b"}"
+
+  def fast_columnar():
+    return responses.dumps({"images": responses.encode_rows(columns, rows, "columnar")})
+
+  timeit("jsonable_encoder + json", baseline, iterations)
+  timeit("responses rows", fast_rows, iterations)
+  if responses.orjson is not None:
+    timeit("responses rows, by column", json_rows, iterations)
+  timeit("responses columnar", fast_columnar, iterations)
+
+  body = fast_rows()
+  timeit("gzip rows body", lambda: responses.compress(body, "gzip"), iterations)
+  print(f"{'body bytes rows / columnar':<32} {len(body)} / {len(fast_columnar())}")
+  print(f"{'gzip bytes rows':<32} {len(responses.compress(body, 'gzip')[0])}")
+
+
+def run_similarity(nassets, iterations=200):
+  import random
+
+  print(f"**similarity search, {nassets} assets**")
+
+  #
+  # clusters of near-duplicates (a few bits flipped from a base hash),
+  # which is what perceptual hashes of real photo libraries look like:
+  #
+  rng = random.Random(0)
+  hashes = []
+  while len(hashes) < nassets:
+    base = rng.getrandbits(64)
+    for _ in range(rng.randint(1, 8)):
+      h = base
+      for bit in rng.sample(range(64), rng.randint(0, 6)):
+        h ^= 1 << bit
+      hashes.append(h)
+  hashes = hashes[:nassets]
+
+  index = similarity.SimilarityIndex()
+  start = time.perf_counter()
+  index.add_many(enumerate(hashes, 1))
+  print(f"{'build':<32} {time.perf_counter() - start:8.2f} s")
+
+  queries = [rng.choice(hashes) for _ in range(iterations)]
+  for distance in (4, 6, 10, similarity.MAX_DISTANCE):
+    it = iter(queries * 2)
+    timeit(f"search(max_distance={distance})", lambda: index.search(next(it), distance), iterations)
+
+  def scan():
+    h = queries[0]
+    return [i for i, x in enumerate(hashes, 1) if similarity.popcount(x ^ h) <= 10]
+
+  timeit("linear scan(max_distance=10)", scan, 3)
+
+
+def main(argv):
+  if len(argv) > 1 and argv[1] == 'similar':
+    run_similarity(int(argv[2]) if len(argv) > 2 else 1000000)
+    return 0
+
+
+  if len(argv) > 1 and argv[1] == 'serialize':
+    run_serialization(int(argv[2]) if len(argv) > 2 else 10000)
+    return 0
+
+  iterations = int(argv[1]) if len(argv) > 1 else 20
+
+  photoapp.initialize('photoapp-config.ini', 's3readwrite', 'photoapp-read-write')
+
+  run_queries(iterations)
+  print()
+  ok = check_plans()
+
+  return 0 if ok else 1
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv))
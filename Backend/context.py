@@ -0,0 +1,366 @@
+#
+# Application context for PhotoApp.
+#
+# An AppContext holds everything derived from one configuration: the
+# parsed config file, the boto3 session, a pool of database
+# connections and the storage / label detector clients. photoapp's
+# initialize() builds a new context and swaps it in with a single
+# assignment, so requests already running keep using the context they
+# started with while new requests see the new one; nothing is mutated
+# in place (no os.environ or boto3 default session changes).
+#
+# Creating a context is cheap: boto3 and pymysql are imported, and
+# connections and clients created, on first use or by warm().
+#
+
+import collections
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+import uuid
+
+from configparser import ConfigParser
+
+import detectors
+import storage
+
+
+#
+# default # of idle database connections kept per context (override
+# with pool_size in the [rds] section of the config file):
+#
+POOL_SIZE = 4
+
+#
+# idle pooled connections older than this (seconds) are pinged before
+# reuse, in case the server has dropped them:
+#
+MAX_IDLE = 300
+
+
+###################################################################
+#
+# ConnectionPool
+#
+class ConnectionPool:
+    """
+    Keeps up to size idle database connections for reuse. get() never
+    blocks: if no idle connection is available a new one is opened.
+    """
+
+    def __init__(self, connect, size=POOL_SIZE, max_idle=MAX_IDLE):
+        self._connect = connect
+        self.size = size
+        self.max_idle = max_idle
+        self._idle = collections.deque()
+        self._lock = threading.Lock()
+        self.closed = False
+
+    def get(self):
+        """
+        Returns a PooledConnection; its close() returns the underlying
+        connection to the pool.
+        """
+        while True:
+            with self._lock:
+                entry = self._idle.pop() if self._idle else None
+            if entry is None:
+                return PooledConnection(self, self._connect())
+
+            conn, since = entry
+            if time.monotonic() - since <= self.max_idle:
+                return PooledConnection(self, conn)
+            try:
+                conn.ping(reconnect=True)
+                return PooledConnection(self, conn)
+            except Exception:
+                self._discard(conn)
+
+    def put(self, conn):
+        if self.closed or not conn.open:
+            self._discard(conn)
+            return
+
+        try:
+            from pymysql.constants import SERVER_STATUS
+            if conn.server_status & SERVER_STATUS.SERVER_STATUS_IN_TRANS:
+                conn.rollback()
+        except Exception:
+            self._discard(conn)
+            return
+
+        with self._lock:
+            if len(self._idle) < self.size:
+                self._idle.append((conn, time.monotonic()))
+                return
+        self._discard(conn)
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def idle_count(self):
+        with self._lock:
+            return len(self._idle)
+
+    def warm(self, count=None):
+        """
+        Opens connections until count (default: pool size) are idle.
+        """
+        count = self.size if count is None else min(count, self.size)
+        opened = []
+        try:
+            while self.idle_count() + len(opened) < count:
+                opened.append(self._connect())
+        finally:
+            for conn in opened:
+                self.put(conn)
+
+    def close(self):
+        self.closed = True
+        with self._lock:
+            idle, self._idle = list(self._idle), collections.deque()
+        for conn, _ in idle:
+            self._discard(conn)
+
+
+class PooledConnection:
+    """
+    A pymysql connection borrowed from a ConnectionPool; behaves like
+    the connection itself, except close() hands it back to the pool.
+    """
+
+    def __init__(self, pool, conn):
+        self._pool = pool
+        self._conn = conn
+
+    def __getattr__(self, name):
+        conn = self.__dict__.get('_conn')
+        if conn is None:
+            raise AttributeError(f"connection is closed ({name})")
+        return getattr(conn, name)
+
+    @property
+    def open(self):
+        return self._conn is not None and self._conn.open
+
+    def close(self):
+        conn, self._conn = self._conn, None
+        if conn is not None:
+            self._pool.put(conn)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+###################################################################
+#
+# AppContext
+#
+class AppContext:
+    """
+    Configuration, clients and pools for one photoapp configuration.
+
+    Parameters
+    ----------
+    config_file is the name of configuration file, probably 'photoapp-config.ini'
+    s3_profile to use for accessing S3, probably 's3readwrite'
+    mysql_user to use for accessing database, probably 'photoapp-read-write'
+    """
+
+    def __init__(self, config_file, s3_profile, mysql_user):
+        self.config_file = config_file
+        self.s3_profile = s3_profile
+
+        self.config = ConfigParser()
+        self.config.read(config_file)
+
+        #
+        # make sure we can read the necessary configuration info:
+        #
+        self.config.get('s3', 'bucket_name')
+        self.region_name = self.config.get('s3', 'region_name')
+
+        self.db_settings = {
+            'host': self.config.get('rds', 'endpoint'),
+            'port': int(self.config.get('rds', 'port_number')),
+            'user': self.config.get('rds', 'user_name'),
+            'passwd': self.config.get('rds', 'user_pwd'),
+            'database': self.config.get('rds', 'db_name'),
+        }
+
+        if self.db_settings['user'] != mysql_user:
+            raise ValueError("mysql_user does not match user_name in [rds] section of config file")
+
+        self.pool = ConnectionPool(
+            self.connect,
+            size=self.config.getint('rds', 'pool_size', fallback=POOL_SIZE)
+        )
+
+        self._session = None
+        self._storage = None
+        self._detector = None
+        self._lock = threading.RLock()
+
+    def connect(self):
+        """
+        Opens a new (unpooled) pymysql connection.
+        """
+        import pymysql
+
+        return pymysql.connect(
+            **self.db_settings,
+            #
+            # allow execution of a query string with multiple SQL queries:
+            #
+            client_flag=pymysql.constants.CLIENT.MULTI_STATEMENTS
+        )
+
+    def get_dbConn(self):
+        return self.pool.get()
+
+    @property
+    def session(self):
+        """
+        boto3 session using s3_profile from the config file, which
+        doubles as the AWS shared credentials file.
+        """
+        with self._lock:
+            if self._session is None:
+                import boto3
+                import botocore.session
+
+                core = botocore.session.Session()
+                core.set_config_variable('credentials_file', self.config_file)
+                self._session = boto3.Session(botocore_session=core, profile_name=self.s3_profile)
+            return self._session
+
+    def client_config(self):
+        from botocore.client import Config
+
+        return Config(
+            retries={
+                'max_attempts': 3,
+                'mode': 'standard'
+            },
+            max_pool_connections=self.config.getint('s3', 'max_pool_connections', fallback=10)
+        )
+
+    def rekognition(self):
+        return self.session.client('rekognition', region_name=self.region_name, config=self.client_config())
+
+    def storage(self):
+        with self._lock:
+            if self._storage is None:
+                backend = self.config.get('storage', 'backend', fallback='s3').strip().lower()
+                if backend == 's3':
+                    self._storage = storage.S3Storage(
+                        self.config.get('s3', 'bucket_name'),
+                        self.region_name,
+                        session=self.session
+                    )
+                else:
+                    self._storage = storage.from_config(self.config)
+            return self._storage
+
+    def detector(self):
+        with self._lock:
+            if self._detector is None:
+                self._detector = detectors.from_config(self.config, self.rekognition)
+            return self._detector
+
+    def warm(self):
+        """
+        Pre-creates the database connections and clients (loading the
+        boto service models and the SDKs themselves), so the first
+        requests served with this context don't pay for them. Returns
+        {'db_connections', 'seconds'}.
+        """
+        start = time.perf_counter()
+        self.pool.warm()
+        self.storage()
+        self.detector()
+        seconds = time.perf_counter() - start
+        logging.info(f"context: warmed {self.pool.idle_count()} db connections in {seconds:.2f}s")
+        return {'db_connections': self.pool.idle_count(), 'seconds': round(seconds, 3)}
+
+    def close(self):
+        """
+        Closes idle pooled connections; connections still in use are
+        closed when they are returned.
+        """
+        self.pool.close()
+
+
+###################################################################
+#
+# CatalogVersion / SharedCatalogVersion
+#
+# A version string "<epoch>.<counter>" that changes after every
+# change to the catalog (see photoapp.get_catalog_version). The epoch
+# is random, so versions from an earlier run never match.
+#
+class CatalogVersion:
+    """
+    Catalog version held in process memory.
+    """
+
+    def __init__(self):
+        self._epoch = uuid.uuid4().int & 0xFFFFFFFF
+        self._counter = 0
+        self._lock = threading.Lock()
+
+    def get(self):
+        return f"{self._epoch:08x}.{self._counter}"
+
+    def bump(self):
+        with self._lock:
+            self._counter += 1
+
+
+class SharedCatalogVersion:
+    """
+    Catalog version kept in a small memory-mapped file, so every
+    worker process on the host sees every bump. Reads are a plain
+    memory read; bumps take an exclusive file lock.
+    """
+
+    _FORMAT = "<QQ"
+    _SIZE = struct.calcsize(_FORMAT)
+
+    def __init__(self, path):
+        import fcntl
+
+        self._fcntl = fcntl
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            if os.fstat(self._fd).st_size < self._SIZE:
+                epoch = uuid.uuid4().int & 0xFFFFFFFF
+                os.ftruncate(self._fd, 0)
+                os.write(self._fd, struct.pack(self._FORMAT, epoch, 0))
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        self._map = mmap.mmap(self._fd, self._SIZE)
+        self._lock = threading.Lock()
+
+    def get(self):
+        epoch, counter = struct.unpack_from(self._FORMAT, self._map)
+        return f"{epoch:08x}.{counter}"
+
+    def bump(self):
+        with self._lock:
+            self._fcntl.flock(self._fd, self._fcntl.LOCK_EX)
+            try:
+                epoch, counter = struct.unpack_from(self._FORMAT, self._map)
+                struct.pack_into(self._FORMAT, self._map, 0, epoch, counter + 1)
+            finally:
+                self._fcntl.flock(self._fd, self._fcntl.LOCK_UN)
@@ -0,0 +1,311 @@
+#
+# Label detectors for PhotoApp images.
+#
+# post_image labels each uploaded image through the LabelDetector
+# interface below; relabel_pending labels the assets left pending a
+# batch at a time through detect_batch. Rekognition is the default; a
+# local ONNX classifier runs on the CPU with no network calls, and the
+# stub detector returns deterministic labels for tests and benchmarks.
+# The detector is selected by the [labels] section of the app config
+# file:
+#
+#   [labels]
+#   detector = rekognition   # rekognition (default), onnx or stub
+#   max_labels = 100
+#   min_confidence = 80
+#   model_path = models/classifier.onnx   # onnx only
+#   labels_path = models/classes.txt      # onnx only, one name per line
+#   batch_size = 8                        # onnx only
+#   workers = 2                           # onnx only, process pool size
+#
+
+import collections
+import hashlib
+import logging
+import threading
+
+import concurrent.futures
+
+
+#
+# An image to label. bucket/key locate the object in S3 (bucket is
+# None when the object isn't in S3); filename is a local copy of the
+# image bytes, which detectors that need the pixels read.
+#
+ImageInput = collections.namedtuple('ImageInput', ['bucket', 'key', 'filename'])
+
+
+def read_image_bytes(image):
+    with open(image.filename, "rb") as f:
+        return f.read()
+
+
+###################################################################
+#
+# LabelDetector
+#
+class LabelDetector:
+    """
+    Interface for label detection. Labels are returned in the shape
+    Rekognition uses: a list of dicts {'Name': str, 'Confidence': float}
+    with Confidence in the range 0..100, highest confidence first.
+    """
+
+    name = "detector"
+
+    def __init__(self, max_labels=100, min_confidence=80):
+        self.max_labels = max_labels
+        self.min_confidence = min_confidence
+
+    def detect(self, image):
+        """
+        Returns the labels for one ImageInput.
+        """
+        return self.detect_batch([image])[0]
+
+    def detect_batch(self, images):
+        """
+        Returns a list with the labels for each ImageInput, in order.
+        """
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+###################################################################
+#
+# RekognitionDetector
+#
+class RekognitionDetector(LabelDetector):
+    """
+    Labels images with AWS Rekognition detect_labels. Images stored in
+    S3 are passed by reference; others are sent as bytes. Batches are
+    sent concurrently from a small thread pool, since each call is
+    network-bound.
+    """
+
+    name = "rekognition"
+
+    def __init__(self, client, max_labels=100, min_confidence=80, concurrency=4):
+        super().__init__(max_labels, min_confidence)
+        self.client = client
+        self.concurrency = concurrency
+
+    def _detect_one(self, image):
+        if image.bucket is not None:
+            source = {
+                'S3Object': {
+                    'Bucket': image.bucket,
+                    'Name': image.key
+                }
+            }
+        else:
+            source = {'Bytes': read_image_bytes(image)}
+
+        response = self.client.detect_labels(
+            Image=source,
+            MaxLabels=self.max_labels,
+            MinConfidence=self.min_confidence
+        )
+        return response['Labels']
+
+    def detect_batch(self, images):
+        if len(images) <= 1:
+            return [self._detect_one(image) for image in images]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(self.concurrency, len(images))) as pool:
+            return list(pool.map(self._detect_one, images))
+
+
+###################################################################
+#
+# StubDetector
+#
+class StubDetector(LabelDetector):
+    """
+    Deterministic detector for tests and benchmarks: labels are chosen
+    from a fixed vocabulary based on a hash of the image bytes, so the
+    same image always gets the same labels.
+    """
+
+    name = "stub"
+
+    VOCABULARY = [
+        'Animal', 'Building', 'Car', 'Cat', 'City', 'Dog', 'Flower',
+        'Food', 'Landscape', 'Mountain', 'Nature', 'Outdoors', 'Person',
+        'Plant', 'Sky', 'Tree', 'Water',
+    ]
+
+    def _detect_one(self, image):
+        digest = hashlib.sha256(read_image_bytes(image)).digest()
+        labels = {}
+        for i in range(0, len(digest) - 1, 2):
+            name = self.VOCABULARY[digest[i] % len(self.VOCABULARY)]
+            confidence = 50.0 + digest[i + 1] * 50.0 / 255
+            if confidence >= self.min_confidence:
+                labels[name] = max(confidence, labels.get(name, 0.0))
+        ranked = sorted(labels.items(), key=lambda kv: (-kv[1], kv[0]))
+        return [{'Name': name, 'Confidence': confidence}
+                for name, confidence in ranked[:self.max_labels]]
+
+    def detect_batch(self, images):
+        return [self._detect_one(image) for image in images]
+
+
+###################################################################
+#
+# OnnxDetector
+#
+# The model runs in worker processes so several images are classified
+# in parallel without holding the GIL. Each worker loads the model once,
+# in _onnx_init, and classifies a batch of images per call.
+#
+_onnx_session = None
+_onnx_classes = None
+
+
+def _onnx_init(model_path, labels_path):
+    global _onnx_session, _onnx_classes
+    import onnxruntime
+
+    options = onnxruntime.SessionOptions()
+    #
+    # parallelism comes from the process pool, so keep each session
+    # single-threaded to avoid oversubscribing the CPU:
+    #
+    options.intra_op_num_threads = 1
+    _onnx_session = onnxruntime.InferenceSession(model_path, options, providers=['CPUExecutionProvider'])
+    with open(labels_path) as f:
+        _onnx_classes = [line.strip() for line in f if line.strip()]
+
+
+def _onnx_preprocess(filename, size=224):
+    import numpy
+    from PIL import Image
+
+    with Image.open(filename) as img:
+        img = img.convert('RGB').resize((size, size))
+        pixels = numpy.asarray(img, dtype=numpy.float32) / 255.0
+    mean = numpy.array([0.485, 0.456, 0.406], dtype=numpy.float32)
+    std = numpy.array([0.229, 0.224, 0.225], dtype=numpy.float32)
+    return ((pixels - mean) / std).transpose(2, 0, 1)
+
+
+def _onnx_detect_batch(filenames, max_labels, min_confidence):
+    import numpy
+
+    batch = numpy.stack([_onnx_preprocess(f) for f in filenames])
+    input_name = _onnx_session.get_inputs()[0].name
+    logits = _onnx_session.run(None, {input_name: batch})[0]
+
+    logits = logits - logits.max(axis=1, keepdims=True)
+    probs = numpy.exp(logits)
+    probs /= probs.sum(axis=1, keepdims=True)
+
+    results = []
+    for row in probs:
+        top = numpy.argsort(row)[::-1][:max_labels]
+        results.append([
+            {'Name': _onnx_classes[i], 'Confidence': float(row[i] * 100)}
+            for i in top
+            if row[i] * 100 >= min_confidence
+        ])
+    return results
+
+
+class OnnxDetector(LabelDetector):
+    """
+    Labels images on the local CPU with an ONNX image classifier (e.g.
+    a MobileNet / ResNet exported from torchvision) taking a 1x3x224x224
+    ImageNet-normalized input with a dynamic batch dimension. Requires
+    the optional onnxruntime, numpy and Pillow packages.
+    """
+
+    name = "onnx"
+
+    def __init__(self, model_path, labels_path, max_labels=100, min_confidence=80,
+                 batch_size=8, workers=2):
+        super().__init__(max_labels, min_confidence)
+        try:
+            import onnxruntime  # noqa: F401
+            import numpy  # noqa: F401
+            import PIL  # noqa: F401
+        except ImportError as err:
+            raise RuntimeError("onnx detector requires onnxruntime, numpy and Pillow to be installed") from err
+
+        self.batch_size = batch_size
+        self.pool = concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=_onnx_init,
+            initargs=(model_path, labels_path)
+        )
+
+    def detect_batch(self, images):
+        filenames = [image.filename for image in images]
+        batches = [filenames[i:i + self.batch_size]
+                   for i in range(0, len(filenames), self.batch_size)]
+        futures = [self.pool.submit(_onnx_detect_batch, batch, self.max_labels, self.min_confidence)
+                   for batch in batches]
+        results = []
+        for future in futures:
+            results.extend(future.result())
+        return results
+
+    def close(self):
+        self.pool.shutdown(wait=False)
+
+
+###################################################################
+#
+# from_config
+#
+# create and return the detector selected by the [labels] section of
+# the given ConfigParser (Rekognition if there is no such section).
+# Local model detectors own a process pool, so they are created once
+# per distinct configuration and reused.
+#
+_cache = {}
+_cache_lock = threading.Lock()
+
+
+def from_config(configur, rekognition_factory):
+    """
+    Creates the label detector described by the app config.
+
+    Parameters
+    ----------
+    configur is a ConfigParser that has read the app config file
+    rekognition_factory is a function returning a Rekognition client,
+      called only if the Rekognition detector is selected
+
+    Returns
+    -------
+    LabelDetector object
+    """
+
+    backend = configur.get('labels', 'detector', fallback='rekognition').strip().lower()
+    max_labels = configur.getint('labels', 'max_labels', fallback=100)
+    min_confidence = configur.getfloat('labels', 'min_confidence', fallback=80)
+
+    if backend == 'rekognition':
+        return RekognitionDetector(rekognition_factory(), max_labels, min_confidence)
+
+    if backend == 'stub':
+        return StubDetector(max_labels, min_confidence)
+
+    if backend == 'onnx':
+        settings = (
+            configur.get('labels', 'model_path'),
+            configur.get('labels', 'labels_path'),
+            max_labels,
+            min_confidence,
+            configur.getint('labels', 'batch_size', fallback=8),
+            configur.getint('labels', 'workers', fallback=2),
+        )
+        with _cache_lock:
+            if settings not in _cache:
+                logging.info(f"detectors: starting onnx detector {settings[0]}")
+                _cache[settings] = OnnxDetector(*settings)
+            return _cache[settings]
+
+    raise ValueError(f"unknown label detector '{backend}' in [labels] section of config file")
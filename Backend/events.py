@@ -0,0 +1,170 @@
+#
+# In-process publish/subscribe for PhotoApp progress events.
+#
+# photoapp.post_image publishes events (upload-progress, upload-failed,
+# asset-created, labels-ready) from whatever thread it runs in; api.py
+# streams them to clients as Server-Sent Events. The image is stored
+# before its asset row exists, so upload events carry assetid None and
+# identify the upload by its bucketkey. Each subscriber gets
+# its own bounded queue: when a slow client falls behind, its oldest
+# undelivered events are dropped, so memory use stays bounded no matter
+# how slowly clients read.
+#
+# asyncio and json are imported on first use: photoapp publishes
+# events from plain threads, and most processes importing it (the
+# CLI, tests) never subscribe.
+#
+
+import itertools
+import threading
+import time
+
+
+#
+# default per-subscriber queue size:
+#
+QUEUE_SIZE = 256
+
+
+class Subscription:
+    """
+    One subscriber's bounded event queue, consumed from an asyncio
+    event loop. Events published while the queue is full push out the
+    oldest queued event; dropped counts how many were lost.
+    """
+
+    def __init__(self, loop, maxsize=QUEUE_SIZE, predicate=None):
+        import asyncio
+
+        self.loop = loop
+        self.queue = asyncio.Queue(maxsize=maxsize)
+        self.predicate = predicate
+        self.dropped = 0
+
+    def _offer(self, event):
+        # runs on self.loop:
+        if self.queue.full():
+            self.queue.get_nowait()
+            self.dropped += 1
+        self.queue.put_nowait(event)
+
+    def offer(self, event):
+        """
+        Queues event for this subscriber; safe to call from any thread.
+        """
+        if self.predicate is not None and not self.predicate(event):
+            return
+        try:
+            self.loop.call_soon_threadsafe(self._offer, event)
+        except RuntimeError:
+            # loop is closed; the subscriber is going away
+            pass
+
+    async def get(self, timeout=None):
+        """
+        Returns the next event, or None if timeout seconds pass first.
+        """
+        import asyncio
+
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+
+class EventBus:
+    """
+    Fan-out of published events to every current subscriber.
+    """
+
+    def __init__(self):
+        self._subscribers = set()
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+
+    def subscribe(self, maxsize=QUEUE_SIZE, predicate=None):
+        """
+        Registers a new subscriber on the running event loop; pass the
+        result to unsubscribe() when done. predicate, if given, filters
+        the events queued for this subscriber.
+        """
+        import asyncio
+
+        sub = Subscription(asyncio.get_running_loop(), maxsize, predicate)
+        with self._lock:
+            self._subscribers.add(sub)
+        return sub
+
+    def unsubscribe(self, sub):
+        with self._lock:
+            self._subscribers.discard(sub)
+
+    def subscriber_count(self):
+        with self._lock:
+            return len(self._subscribers)
+
+    def publish(self, type, **data):
+        """
+        Publishes an event {'id', 'type', 'time', **data} to every
+        subscriber; safe to call from any thread, and cheap when there
+        are no subscribers.
+        """
+        with self._lock:
+            subscribers = list(self._subscribers)
+        if not subscribers:
+            return
+        event = dict(data, id=next(self._ids), type=type, time=time.time())
+        for sub in subscribers:
+            sub.offer(event)
+
+
+def format_sse(event):
+    """
+    Returns the event encoded as a Server-Sent Events message.
+    """
+    import json
+
+    data = json.dumps(event, separators=(",", ":"), default=str)
+    return f"id: {event['id']}\nevent: {event['type']}\ndata: {data}\n\n"
+
+
+#
+# the process-wide bus photoapp publishes to:
+#
+BUS = EventBus()
+
+
+def publish(type, **data):
+    BUS.publish(type, **data)
+
+
+###################################################################
+#
+# ProgressReporter
+#
+# Upload callback (as passed to Storage.put_stream) that publishes
+# upload-progress events, at most one per `step` fraction of the file
+# plus a final one, so large uploads don't flood subscribers.
+#
+class ProgressReporter:
+
+    def __init__(self, assetid, userid, total, step=0.05, bucketkey=None):
+        self.assetid = assetid
+        self.userid = userid
+        self.bucketkey = bucketkey
+        self.total = total
+        self.sent = 0
+        self._lock = threading.Lock()
+        self._next = 0
+        self._stride = max(1, int(total * step))
+
+    def __call__(self, nbytes):
+        # S3 transfers may report from several threads at once:
+        with self._lock:
+            self.sent += nbytes
+            if self.sent < self._next and self.sent < self.total:
+                return
+            self._next = self.sent + self._stride
+            sent = self.sent
+        publish('upload-progress', assetid=self.assetid, userid=self.userid,
+                bucketkey=self.bucketkey, bytes_sent=sent, total_bytes=self.total)
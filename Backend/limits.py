@@ -0,0 +1,345 @@
+#
+# Admission control for PhotoApp uploads.
+#
+# Uploads are expensive: each one holds a worker thread, an S3
+# connection and a label detection call for seconds at a time, so one
+# busy client could starve everyone else. Before an upload is accepted
+# it must pass
+#
+#   - a per-user token bucket and a global token bucket (rate), and
+#   - a bound on concurrent uploads, with a short bounded wait queue.
+#
+# Rekognition calls are separately bounded (see photoapp.detect_labels).
+# Requests that can't be admitted fail fast with Overloaded, which
+# api.py turns into 429 Too Many Requests with a Retry-After header.
+#
+# Token buckets live in process memory, or in a file shared by the
+# workers on one host (backend = shared in the [limits] section).
+# Concurrency limits are always per worker process.
+#
+
+import contextlib
+import hashlib
+import math
+import mmap
+import os
+import struct
+import threading
+import time
+
+
+#
+# defaults, overridable in the [limits] section of the config file:
+#
+USER_RATE = 2.0            # uploads per second, per user
+USER_BURST = 10
+GLOBAL_RATE = 20.0         # uploads per second, all users
+GLOBAL_BURST = 50
+MAX_UPLOADS = 8            # concurrent uploads per worker
+UPLOAD_QUEUE = 16          # uploads that may wait for a slot
+MAX_REKOGNITION = 4        # concurrent Rekognition calls per worker
+REKOGNITION_QUEUE = 32
+QUEUE_TIMEOUT = 30.0       # seconds a queued request waits for a slot
+RETRY_AFTER = 1.0          # seconds, when shedding for concurrency
+
+#
+# per-user buckets kept in memory before idle (full) ones are evicted:
+#
+MAX_BUCKETS = 10000
+
+
+class Overloaded(Exception):
+    """
+    Raised when a request is not admitted; retry_after is the number of
+    seconds the client should wait before trying again.
+    """
+
+    def __init__(self, reason, retry_after):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+def take(tokens, stamp, now, rate, burst, n=1):
+    """
+    Token bucket step: refills (tokens, stamp) up to now and tries to
+    take n tokens. Returns (tokens, stamp, wait) where wait is 0 if the
+    tokens were taken, else the seconds until they will be available.
+    A negative n gives tokens back.
+    """
+    tokens = min(burst, tokens + max(0.0, now - stamp) * rate)
+    if tokens >= n:
+        return min(burst, tokens - n), now, 0.0
+    return tokens, now, (n - tokens) / rate
+
+
+###################################################################
+#
+# BucketStore / SharedBucketStore
+#
+# Keyed token bucket state. take(key, rate, burst) returns 0 if a
+# token was taken, else the seconds to wait for one.
+#
+class BucketStore:
+    """
+    Token buckets held in process memory.
+    """
+
+    def __init__(self, clock=time.monotonic, max_buckets=MAX_BUCKETS):
+        self.clock = clock
+        self.max_buckets = max_buckets
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def take(self, key, rate, burst, n=1):
+        now = self.clock()
+        with self._lock:
+            tokens, stamp = self._buckets.get(key, (burst, now))
+            tokens, stamp, wait = take(tokens, stamp, now, rate, burst, n)
+            self._buckets[key] = (tokens, stamp)
+            if len(self._buckets) > self.max_buckets:
+                self._evict(now, rate, burst)
+        return wait
+
+    def _evict(self, now, rate, burst):
+        # a bucket that has refilled is indistinguishable from a new one:
+        for key, (tokens, stamp) in list(self._buckets.items()):
+            if tokens + (now - stamp) * rate >= burst:
+                del self._buckets[key]
+
+
+class SharedBucketStore:
+    """
+    Token buckets in a memory-mapped file shared by the worker
+    processes on one host. The file is a fixed table of slots
+    (key hash, tokens, stamp) addressed by key hash; updates take an
+    exclusive file lock. When every probed slot is taken the stalest
+    bucket is reused, which can only make the limit more lenient.
+    """
+
+    _FORMAT = "<Qdd"
+    _SLOT = struct.calcsize(_FORMAT)
+    _PROBES = 8
+
+    def __init__(self, path, slots=4096, clock=time.time):
+        import fcntl
+
+        self._fcntl = fcntl
+        self.clock = clock
+        self.slots = slots
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        size = slots * self._SLOT
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            if os.fstat(self._fd).st_size != size:
+                os.ftruncate(self._fd, 0)
+                os.ftruncate(self._fd, size)
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        self._map = mmap.mmap(self._fd, size)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _hash(key):
+        digest = hashlib.blake2b(str(key).encode("utf-8"), digest_size=8).digest()
+        return int.from_bytes(digest, "little") | 1
+
+    def _slot(self, h):
+        """Returns the offset of key hash h's slot, claiming one if needed."""
+        stalest = None
+        for i in range(self._PROBES):
+            offset = ((h + i) % self.slots) * self._SLOT
+            slot_hash, _, stamp = struct.unpack_from(self._FORMAT, self._map, offset)
+            if slot_hash == h:
+                return offset, True
+            if slot_hash == 0:
+                return offset, False
+            if stalest is None or stamp < stalest[1]:
+                stalest = (offset, stamp)
+        return stalest[0], False
+
+    def take(self, key, rate, burst, n=1):
+        h = self._hash(key)
+        with self._lock:
+            self._fcntl.flock(self._fd, self._fcntl.LOCK_EX)
+            try:
+                now = self.clock()
+                offset, found = self._slot(h)
+                if found:
+                    _, tokens, stamp = struct.unpack_from(self._FORMAT, self._map, offset)
+                else:
+                    tokens, stamp = burst, now
+                tokens, stamp, wait = take(tokens, stamp, now, rate, burst, n)
+                struct.pack_into(self._FORMAT, self._map, offset, h, tokens, stamp)
+            finally:
+                self._fcntl.flock(self._fd, self._fcntl.LOCK_UN)
+        return wait
+
+
+###################################################################
+#
+# ConcurrencyLimit
+#
+class ConcurrencyLimit:
+    """
+    At most limit holders at once; up to queue more may wait (for at
+    most timeout seconds) for a slot. Anything beyond that is refused
+    with Overloaded rather than left to pile up.
+    """
+
+    def __init__(self, name, limit, queue=0, timeout=QUEUE_TIMEOUT, retry_after=RETRY_AFTER):
+        self.name = name
+        self.limit = limit
+        self.queue = queue
+        self.timeout = timeout
+        self.retry_after = retry_after
+        self.active = 0
+        self.waiting = 0
+        self._cond = threading.Condition()
+
+    def saturated(self):
+        """True if a new request would be refused right now."""
+        with self._cond:
+            return self.active >= self.limit and self.waiting >= self.queue
+
+    def try_acquire(self):
+        with self._cond:
+            if self.active < self.limit:
+                self.active += 1
+                return True
+            return False
+
+    def acquire(self, timeout=None):
+        """
+        Takes a slot, waiting in the queue if need be; raises Overloaded
+        if the queue is full or the wait times out.
+        """
+        timeout = self.timeout if timeout is None else timeout
+        with self._cond:
+            if self.active < self.limit:
+                self.active += 1
+                return
+            if self.waiting >= self.queue:
+                raise Overloaded(f"too many concurrent {self.name}", self.retry_after)
+            self.waiting += 1
+            try:
+                if not self._cond.wait_for(lambda: self.active < self.limit, timeout):
+                    raise Overloaded(f"timed out waiting for {self.name}", self.retry_after)
+                self.active += 1
+            finally:
+                self.waiting -= 1
+
+    def release(self):
+        with self._cond:
+            self.active -= 1
+            self._cond.notify()
+
+    @contextlib.contextmanager
+    def slot(self, timeout=None):
+        self.acquire(timeout)
+        try:
+            yield
+        finally:
+            self.release()
+
+
+###################################################################
+#
+# Admission
+#
+class Admission:
+    """
+    The upload admission policy: rate limits plus the upload and
+    Rekognition concurrency limits.
+    """
+
+    def __init__(self,
+                 user_rate=USER_RATE, user_burst=USER_BURST,
+                 global_rate=GLOBAL_RATE, global_burst=GLOBAL_BURST,
+                 max_uploads=MAX_UPLOADS, upload_queue=UPLOAD_QUEUE,
+                 max_rekognition=MAX_REKOGNITION, rekognition_queue=REKOGNITION_QUEUE,
+                 queue_timeout=QUEUE_TIMEOUT, retry_after=RETRY_AFTER,
+                 store=None):
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self.global_rate = global_rate
+        self.global_burst = global_burst
+        self.store = store if store is not None else BucketStore()
+        self.uploads = ConcurrencyLimit("uploads", max_uploads, upload_queue,
+                                        queue_timeout, retry_after)
+        self.rekognition = ConcurrencyLimit("label detection calls", max_rekognition,
+                                            rekognition_queue, queue_timeout, retry_after)
+
+    def check_rate(self, userid):
+        """
+        Takes one token from userid's bucket and the global bucket;
+        raises Overloaded if either is empty, taking neither.
+        """
+        user = f"user:{userid}"
+        wait = self.store.take(user, self.user_rate, self.user_burst)
+        if wait:
+            raise Overloaded(f"upload rate limit exceeded for user {userid}", wait)
+        wait = self.store.take("global", self.global_rate, self.global_burst)
+        if wait:
+            # a request refused for global load doesn't use up the user's rate:
+            self.store.take(user, self.user_rate, self.user_burst, -1)
+            raise Overloaded("upload rate limit exceeded", wait)
+
+    def check_capacity(self):
+        """
+        Raises Overloaded if new uploads would only queue up behind
+        saturated upload or Rekognition limits.
+        """
+        for limit in (self.uploads, self.rekognition):
+            if limit.saturated():
+                raise Overloaded(f"too many concurrent {limit.name}", limit.retry_after)
+
+
+def retry_after_header(seconds):
+    """Retry-After value (whole seconds, at least 1) for a wait in seconds."""
+    return str(max(1, math.ceil(seconds)))
+
+
+def from_config(configur, state_dir=None):
+    """
+    Returns the Admission configured by the [limits] section of the
+    config file; backend = shared keeps the token buckets in state_dir,
+    shared with the other workers on this host.
+    """
+    def number(key, default, kind=float):
+        return kind(configur.get('limits', key, fallback=default))
+
+    store = None
+    backend = configur.get('limits', 'backend', fallback='memory').strip().lower()
+    if backend == 'shared':
+        if state_dir is None:
+            raise ValueError("[limits] backend = shared requires a state directory")
+        store = SharedBucketStore(os.path.join(state_dir, 'rate-limits'))
+    elif backend != 'memory':
+        raise ValueError(f"unknown [limits] backend '{backend}'")
+
+    return Admission(
+        user_rate=number('user_rate', USER_RATE),
+        user_burst=number('user_burst', USER_BURST),
+        global_rate=number('global_rate', GLOBAL_RATE),
+        global_burst=number('global_burst', GLOBAL_BURST),
+        max_uploads=number('max_uploads', MAX_UPLOADS, int),
+        upload_queue=number('upload_queue', UPLOAD_QUEUE, int),
+        max_rekognition=number('max_rekognition', MAX_REKOGNITION, int),
+        rekognition_queue=number('rekognition_queue', REKOGNITION_QUEUE, int),
+        queue_timeout=number('queue_timeout', QUEUE_TIMEOUT),
+        retry_after=number('retry_after', RETRY_AFTER),
+        store=store,
+    )
+
+
+#
+# the process-wide policy; api.py replaces it from the config file on
+# startup:
+#
+ADMISSION = Admission()
+
+
+def configure(admission):
+    global ADMISSION
+    ADMISSION = admission
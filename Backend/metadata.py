@@ -0,0 +1,292 @@
+#
+# Image metadata extraction for PhotoApp.
+#
+# extract() reads the MIME type, pixel dimensions and EXIF capture time
+# / orientation from the first bytes of an image (see HEADER_BYTES) by
+# parsing the container headers directly: JPEG, PNG, GIF, WebP, BMP and
+# TIFF dimensions, plus EXIF from JPEG APP1 segments and TIFF files.
+# No pixels are decoded, so it works on the header captured while an
+# upload streams to storage.
+#
+# perceptual_hash() does decode the image (with PIL, an optional
+# dependency: pip install pillow) to compute a 64-bit difference hash
+# (dHash); similar-looking images have hashes a small Hamming distance
+# apart. Without PIL it returns None.
+#
+
+import datetime
+import logging
+import struct
+
+
+#
+# bytes of the image captured for extract(); enough for the EXIF APP1
+# segment (at most 64 KiB) and the JPEG frame header of nearly every
+# camera / phone image:
+#
+HEADER_BYTES = 256 * 1024
+
+#
+# EXIF tags:
+#
+TAG_WIDTH = 0x0100
+TAG_HEIGHT = 0x0101
+TAG_ORIENTATION = 0x0112
+TAG_DATETIME = 0x0132
+TAG_EXIF_IFD = 0x8769
+TAG_DATETIME_ORIGINAL = 0x9003
+
+#
+# JPEG start-of-frame markers (SOF0..SOF15 except DHT, JPG and DAC):
+#
+_SOF_MARKERS = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+
+def empty():
+    return {'mime': None, 'width': None, 'height': None, 'taken_at': None, 'orientation': None}
+
+
+def sniff_mime(head):
+    """
+    Returns the MIME type indicated by the magic bytes at the start of
+    head, or None if it isn't a recognized image format.
+    """
+    if head.startswith(b"\xff\xd8\xff"):
+        return "image/jpeg"
+    if head.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "image/png"
+    if head[:6] in (b"GIF87a", b"GIF89a"):
+        return "image/gif"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp"
+    if head[:2] == b"BM":
+        return "image/bmp"
+    if head[:4] in (b"II*\x00", b"MM\x00*"):
+        return "image/tiff"
+    if head[4:8] == b"ftyp" and head[8:12] in (b"heic", b"heix", b"mif1", b"msf1"):
+        return "image/heic"
+    return None
+
+
+###################################################################
+#
+# extract
+#
+def extract(head):
+    """
+    Parses the image header bytes head.
+
+    Returns
+    -------
+    dict {'mime', 'width', 'height', 'taken_at', 'orientation'}; values
+    that can't be determined from head (unknown format, truncated
+    header, no EXIF) are None. taken_at is a naive datetime in the
+    camera's local time, as EXIF records it.
+    """
+    head = bytes(head)
+    meta = empty()
+    meta['mime'] = sniff_mime(head)
+
+    try:
+        parse = _PARSERS.get(meta['mime'])
+        if parse is not None:
+            parse(head, meta)
+    except (struct.error, IndexError, ValueError) as err:
+        # truncated or malformed header: keep what was found
+        logging.debug(f"metadata.extract(): {err}")
+
+    return meta
+
+
+def _jpeg(head, meta):
+    pos = 2
+    while pos + 4 <= len(head):
+        if head[pos] != 0xFF:
+            raise ValueError(f"bad JPEG marker at {pos}")
+        marker = head[pos + 1]
+        if marker == 0xFF:              # fill byte
+            pos += 1
+            continue
+        if marker == 0x01 or 0xD0 <= marker <= 0xD8:
+            pos += 2                    # markers without a length
+            continue
+        if marker in (0xD9, 0xDA):      # end of image / start of scan
+            return
+
+        length, = struct.unpack_from(">H", head, pos + 2)
+        segment = head[pos + 4:pos + 2 + length]
+
+        if marker in _SOF_MARKERS:
+            if len(segment) < 5:
+                return
+            meta['height'], meta['width'] = struct.unpack_from(">HH", segment, 1)
+            return
+        if marker == 0xE1 and segment.startswith(b"Exif\x00\x00"):
+            _exif(segment[6:], meta)
+
+        pos += 2 + length
+
+
+def _png(head, meta):
+    if head[12:16] == b"IHDR":
+        meta['width'], meta['height'] = struct.unpack_from(">II", head, 16)
+
+
+def _gif(head, meta):
+    meta['width'], meta['height'] = struct.unpack_from("<HH", head, 6)
+
+
+def _webp(head, meta):
+    chunk = head[12:16]
+    if chunk == b"VP8 ":
+        w, h = struct.unpack_from("<HH", head, 26)
+        meta['width'], meta['height'] = w & 0x3FFF, h & 0x3FFF
+    elif chunk == b"VP8L":
+        bits, = struct.unpack_from("<I", head, 21)
+        meta['width'] = (bits & 0x3FFF) + 1
+        meta['height'] = ((bits >> 14) & 0x3FFF) + 1
+    elif chunk == b"VP8X":
+        meta['width'] = int.from_bytes(head[24:27], "little") + 1
+        meta['height'] = int.from_bytes(head[27:30], "little") + 1
+
+
+def _bmp(head, meta):
+    w, h = struct.unpack_from("<ii", head, 18)
+    meta['width'], meta['height'] = w, abs(h)
+
+
+def _tiff(head, meta):
+    ifd0 = _exif(head, meta)
+    if TAG_WIDTH in ifd0:
+        meta['width'] = _value(head, ifd0[TAG_WIDTH])
+    if TAG_HEIGHT in ifd0:
+        meta['height'] = _value(head, ifd0[TAG_HEIGHT])
+
+
+_PARSERS = {
+    "image/jpeg": _jpeg,
+    "image/png": _png,
+    "image/gif": _gif,
+    "image/webp": _webp,
+    "image/bmp": _bmp,
+    "image/tiff": _tiff,
+}
+
+
+###################################################################
+#
+# EXIF (TIFF structure)
+#
+# An IFD entry is (endian, type, count, offset of the value in tiff);
+# values of up to 4 bytes are stored in the entry itself.
+#
+_TYPE_SIZES = {1: 1, 2: 1, 3: 2, 4: 4, 5: 8, 7: 1, 9: 4, 10: 8}
+
+
+def _ifd(tiff, offset, endian):
+    count, = struct.unpack_from(endian + "H", tiff, offset)
+    entries = {}
+    for i in range(count):
+        entry = offset + 2 + 12 * i
+        tag, type_, n = struct.unpack_from(endian + "HHI", tiff, entry)
+        size = _TYPE_SIZES.get(type_, 1) * n
+        if size <= 4:
+            value_at = entry + 8
+        else:
+            value_at, = struct.unpack_from(endian + "I", tiff, entry + 8)
+        entries[tag] = (endian, type_, n, value_at)
+    return entries
+
+
+def _value(tiff, entry):
+    endian, type_, n, at = entry
+    if type_ == 3:
+        return struct.unpack_from(endian + "H", tiff, at)[0]
+    if type_ in (4, 9):
+        return struct.unpack_from(endian + "I", tiff, at)[0]
+    if type_ == 2:
+        return tiff[at:at + n].split(b"\x00", 1)[0].decode("ascii", "replace")
+    return None
+
+
+def _exif_datetime(text):
+    try:
+        return datetime.datetime.strptime(text.strip(), "%Y:%m:%d %H:%M:%S")
+    except (AttributeError, ValueError):
+        return None
+
+
+def _exif(tiff, meta):
+    """
+    Reads orientation and capture time from the TIFF structure tiff
+    into meta; returns the IFD0 entries.
+    """
+    if tiff[:2] == b"II":
+        endian = "<"
+    elif tiff[:2] == b"MM":
+        endian = ">"
+    else:
+        return {}
+
+    ifd0 = _ifd(tiff, struct.unpack_from(endian + "I", tiff, 4)[0], endian)
+
+    if TAG_ORIENTATION in ifd0:
+        orientation = _value(tiff, ifd0[TAG_ORIENTATION])
+        if orientation in range(1, 9):
+            meta['orientation'] = orientation
+
+    taken = None
+    if TAG_EXIF_IFD in ifd0:
+        exif_ifd = _ifd(tiff, _value(tiff, ifd0[TAG_EXIF_IFD]), endian)
+        if TAG_DATETIME_ORIGINAL in exif_ifd:
+            taken = _exif_datetime(_value(tiff, exif_ifd[TAG_DATETIME_ORIGINAL]))
+    if taken is None and TAG_DATETIME in ifd0:
+        taken = _exif_datetime(_value(tiff, ifd0[TAG_DATETIME]))
+    meta['taken_at'] = taken
+
+    return ifd0
+
+
+###################################################################
+#
+# perceptual hash
+#
+def perceptual_hash(fileobj_or_path):
+    """
+    Returns the 64-bit difference hash of the image as an int, or None
+    if PIL is not installed or the image can't be decoded.
+    """
+    try:
+        from PIL import Image
+    except ImportError:
+        return None
+
+    try:
+        with Image.open(fileobj_or_path) as image:
+            # let JPEG decode at a reduced scale; far faster for photos:
+            image.draft("L", (64, 64))
+            small = image.convert("L").resize((9, 8), Image.BILINEAR)
+            pixels = list(small.getdata())
+    except Exception as err:
+        logging.warning(f"metadata.perceptual_hash(): {err}")
+        return None
+
+    bits = 0
+    for row in range(8):
+        for col in range(8):
+            left = pixels[row * 9 + col]
+            right = pixels[row * 9 + col + 1]
+            bits = (bits << 1) | (left > right)
+    return bits
+
+
+def hamming(a, b):
+    """Hamming distance between two 64-bit hashes."""
+    return bin(a ^ b).count("1")
+
+
+def can_hash():
+    """True if perceptual_hash() is available (PIL is installed)."""
+    import importlib.util
+
+    return importlib.util.find_spec("PIL") is not None
@@ -0,0 +1,356 @@
+#
+# Versioned schema migrations for the photoapp database.
+#
+# Each migration is (version, description, steps); a step is either a
+# SQL string or a function taking a cursor. Applied versions are
+# recorded in the schema_migrations table, so migrate() only runs the
+# steps a database hasn't seen yet. Index and column steps check
+# information_schema first, so databases that were set up by hand
+# (before this module existed) can be migrated safely.
+#
+# Run from the command line with:
+#
+#   python photoapp.py migrate
+#
+
+import logging
+
+
+#
+# assetids start here, both in a fresh database and after
+# delete_images() empties the assets table:
+#
+ASSETID_START = 1001
+
+
+###################################################################
+#
+# step helpers
+#
+def _index_exists(dbCursor, table, index):
+    sql = """
+        SELECT 1 FROM information_schema.statistics
+        WHERE table_schema = DATABASE() AND table_name = %s AND index_name = %s
+        LIMIT 1;
+        """
+    dbCursor.execute(sql, (table, index))
+    return dbCursor.fetchone() is not None
+
+
+def _column_exists(dbCursor, table, column):
+    sql = """
+        SELECT 1 FROM information_schema.columns
+        WHERE table_schema = DATABASE() AND table_name = %s AND column_name = %s
+        LIMIT 1;
+        """
+    dbCursor.execute(sql, (table, column))
+    return dbCursor.fetchone() is not None
+
+
+def add_index(table, index, columns):
+    """
+    Returns a step creating the index if it does not already exist.
+    """
+    def step(dbCursor):
+        if not _index_exists(dbCursor, table, index):
+            dbCursor.execute(f"CREATE INDEX {index} ON {table} ({columns});")
+    step.__doc__ = f"index {index} on {table} ({columns})"
+    return step
+
+
+def add_column(table, column, definition):
+    """
+    Returns a step adding the column if it does not already exist.
+    """
+    def step(dbCursor):
+        if not _column_exists(dbCursor, table, column):
+            dbCursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition};")
+    step.__doc__ = f"column {table}.{column}"
+    return step
+
+
+def set_collation(table, column, definition, collation):
+    """
+    Returns a step redefining the column with the given collation, if
+    it doesn't have it already. definition is the column type and
+    attributes, without the collation.
+    """
+    def step(dbCursor):
+        sql = """
+            SELECT collation_name FROM information_schema.columns
+            WHERE table_schema = DATABASE() AND table_name = %s AND column_name = %s;
+            """
+        dbCursor.execute(sql, (table, column))
+        row = dbCursor.fetchone()
+        if row is not None and row[0] != collation:
+            charset = collation.split('_')[0]
+            dbCursor.execute(f"ALTER TABLE {table} MODIFY {column} {definition} "
+                             f"CHARACTER SET {charset} COLLATE {collation};")
+    step.__doc__ = f"collation {collation} for {table}.{column}"
+    return step
+
+
+###################################################################
+#
+# MIGRATIONS
+#
+# Append new migrations to the end of this list; never edit one that
+# has been released.
+#
+MIGRATIONS = [
+    (1, "base schema: users, assets, assetlabels", [
+        """
+        CREATE TABLE IF NOT EXISTS users
+        (
+            userid      INT NOT NULL AUTO_INCREMENT,
+            username    VARCHAR(64) NOT NULL,
+            pwdhash     VARCHAR(256) NOT NULL DEFAULT '',
+            givenname   VARCHAR(64) NOT NULL,
+            familyname  VARCHAR(64) NOT NULL,
+            PRIMARY KEY (userid),
+            UNIQUE      (username)
+        ) AUTO_INCREMENT = 80001;
+        """,
+        f"""
+        CREATE TABLE IF NOT EXISTS assets
+        (
+            assetid     INT NOT NULL AUTO_INCREMENT,
+            userid      INT NOT NULL,
+            localname   VARCHAR(128) NOT NULL,
+            bucketkey   VARCHAR(256) NOT NULL,
+            PRIMARY KEY (assetid),
+            FOREIGN KEY (userid) REFERENCES users(userid),
+            UNIQUE      (bucketkey)
+        ) AUTO_INCREMENT = {ASSETID_START};
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS assetlabels
+        (
+            assetid     INT NOT NULL,
+            label       VARCHAR(128) NOT NULL,
+            confidence  INT NOT NULL,
+            FOREIGN KEY (assetid) REFERENCES assets(assetid)
+        );
+        """,
+    ]),
+
+    (2, "indexes for the assets / assetlabels query patterns", [
+        # get_images(userid): WHERE userid = ? ORDER BY assetid
+        add_index('assets', 'ix_assets_userid_assetid', 'userid, assetid'),
+        # get_image_labels(assetid): WHERE assetid = ? ORDER BY label
+        add_index('assetlabels', 'ix_assetlabels_assetid_label', 'assetid, label'),
+        # get_images_with_label(label): covering index, label prefix range
+        add_index('assetlabels', 'ix_assetlabels_label_confidence_assetid', 'label, confidence, assetid'),
+    ]),
+
+    (3, "asset columns for content hash, size, upload time and label status", [
+        add_column('assets', 'content_hash', "CHAR(64) NULL"),
+        add_column('assets', 'size', "BIGINT NULL"),
+        add_column('assets', 'created_at', "DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP"),
+        add_column('assets', 'label_status',
+                   "ENUM('pending', 'done', 'failed', 'none') NOT NULL DEFAULT 'pending'"),
+        """
+        UPDATE assets
+        SET label_status = IF(EXISTS(SELECT 1 FROM assetlabels l WHERE l.assetid = assets.assetid),
+                              'done', 'none');
+        """,
+        add_index('assets', 'ix_assets_content_hash', 'content_hash'),
+        add_index('assets', 'ix_assets_userid_created_at', 'userid, created_at'),
+    ]),
+
+    (4, "binary bucketkey order and bucket_stats for the reconciler", [
+        #
+        # the reconciler merge-joins assets ORDER BY bucketkey against the
+        # storage listing, which is in UTF-8 byte order. utf8mb4_0900_bin
+        # sorts by code point (the same order) and, unlike utf8mb4_bin,
+        # does not ignore trailing spaces. The existing UNIQUE (bucketkey)
+        # index serves the ordered, keyset-paginated scan.
+        #
+        set_collation('assets', 'bucketkey', "VARCHAR(256) NOT NULL", 'utf8mb4_0900_bin'),
+        """
+        CREATE TABLE IF NOT EXISTS bucket_stats
+        (
+            location         VARCHAR(512) NOT NULL,
+            object_count     BIGINT NOT NULL,
+            total_bytes      BIGINT NOT NULL,
+            asset_count      BIGINT NOT NULL,
+            orphan_objects   BIGINT NOT NULL,
+            missing_objects  BIGINT NOT NULL,
+            reconciled_at    DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (location)
+        );
+        """,
+    ]),
+
+    (5, "image metadata: type, dimensions, EXIF capture time / orientation, perceptual hash", [
+        add_column('assets', 'mime', "VARCHAR(64) NULL"),
+        add_column('assets', 'width', "INT NULL"),
+        add_column('assets', 'height', "INT NULL"),
+        add_column('assets', 'taken_at', "DATETIME NULL"),
+        add_column('assets', 'orientation', "TINYINT NULL"),
+        add_column('assets', 'phash', "BIGINT UNSIGNED NULL"),
+        # get_images(min_width=...), get_images(taken_after=...):
+        add_index('assets', 'ix_assets_width', 'width'),
+        add_index('assets', 'ix_assets_taken_at', 'taken_at'),
+        # exact duplicates (distance 0) by perceptual hash:
+        add_index('assets', 'ix_assets_phash', 'phash'),
+    ]),
+
+    (6, "index for the pending-labels sweep", [
+        # relabel_pending(): WHERE label_status IN (...) ORDER BY assetid
+        add_index('assets', 'ix_assets_label_status', 'label_status, assetid'),
+    ]),
+]
+
+
+def ensure_migrations_table(dbCursor):
+    dbCursor.execute("""
+        CREATE TABLE IF NOT EXISTS schema_migrations
+        (
+            version      INT NOT NULL,
+            description  VARCHAR(256) NOT NULL,
+            applied_at   DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (version)
+        );
+        """)
+
+
+def current_version(dbConn):
+    """
+    Returns the highest applied migration version, 0 if none.
+    """
+    dbCursor = dbConn.cursor()
+    try:
+        ensure_migrations_table(dbCursor)
+        dbCursor.execute("SELECT COALESCE(MAX(version), 0) FROM schema_migrations;")
+        return dbCursor.fetchone()[0]
+    finally:
+        dbCursor.close()
+
+
+def latest_version():
+    return MIGRATIONS[-1][0]
+
+
+###################################################################
+#
+# migrate
+#
+def migrate(dbConn, target=None):
+    """
+    Applies pending migrations, in order, up to and including target
+    (default: all of them).
+
+    Parameters
+    ----------
+    dbConn is an open pymysql connection
+    target is the version to migrate to, or None for the latest
+
+    Returns
+    -------
+    list of the versions applied (empty if already up to date)
+    """
+
+    applied = []
+    dbCursor = dbConn.cursor()
+
+    try:
+        ensure_migrations_table(dbCursor)
+        dbCursor.execute("SELECT version FROM schema_migrations;")
+        done = {row[0] for row in dbCursor.fetchall()}
+
+        for version, description, steps in MIGRATIONS:
+            if version in done:
+                continue
+            if target is not None and version > target:
+                break
+
+            logging.info(f"migrate: applying {version}: {description}")
+
+            #
+            # NOTE: MySQL commits DDL implicitly, so a failed migration
+            # can leave earlier steps applied; every step is written to
+            # be safe to re-run.
+            #
+            for step in steps:
+                if callable(step):
+                    step(dbCursor)
+                else:
+                    dbCursor.execute(step)
+
+            dbCursor.execute(
+                "INSERT INTO schema_migrations (version, description) VALUES (%s, %s);",
+                (version, description)
+            )
+            dbConn.commit()
+            applied.append(version)
+
+        return applied
+
+    except Exception as err:
+        logging.error("migrate():")
+        logging.error(str(err))
+        try:
+            dbConn.rollback()
+        except:
+            pass
+        raise
+
+    finally:
+        dbCursor.close()
+
+
+###################################################################
+#
+# reset_assets
+#
+# empties assets and assetlabels and restarts assetids at
+# ASSETID_START, using the given cursor (caller commits).
+#
+def reset_assets(dbCursor):
+    dbCursor.execute("""
+        SET foreign_key_checks = 0;
+        TRUNCATE TABLE assetlabels;
+        TRUNCATE TABLE assets;
+        SET foreign_key_checks = 1;
+        """)
+    while dbCursor.nextset():
+        pass
+    dbCursor.execute(f"ALTER TABLE assets AUTO_INCREMENT = {ASSETID_START};")
+
+
+###################################################################
+#
+# check_query_plans
+#
+def check_query_plans(dbConn, queries):
+    """
+    EXPLAINs each query and reports the ones that scan a whole table.
+
+    Parameters
+    ----------
+    dbConn is an open pymysql connection
+    queries is a list of (name, sql, params), e.g. photoapp.HOT_QUERIES
+
+    Returns
+    -------
+    list of (name, table, access type, possible keys) for every full
+    table scan ("ALL") or full index scan ("index") in the plans;
+    empty if every query is served by an index lookup
+    """
+
+    flagged = []
+    dbCursor = dbConn.cursor()
+
+    try:
+        for name, sql, params in queries:
+            dbCursor.execute("EXPLAIN " + sql, params)
+            columns = [d[0].lower() for d in dbCursor.description]
+            for row in dbCursor.fetchall():
+                plan = dict(zip(columns, row))
+                if plan.get('type') in ('ALL', 'index'):
+                    flagged.append((name, plan.get('table'), plan.get('type'), plan.get('possible_keys')))
+        return flagged
+
+    finally:
+        dbCursor.close()
@@ -7,35 +7,112 @@
 #   Northwestern University
 #
 
+import contextlib
+import contextvars
+import json
 import logging
-import pymysql
 import os
-import boto3
+import shutil
+import sys
+import tempfile
+import threading
+import time
 import uuid
+import storage
+import detectors
+import migrations
+import events
+import limits
+import retries
+import reconciler
+import metadata
+import similarity
+import context
 
-from botocore.client import Config
-from configparser import ConfigParser
-from tenacity import retry, stop_after_attempt, wait_exponential
 
 #
 # module-level varibles:
 #
 PHOTOAPP_CONFIG_FILE = 'set via call to initialize()'
 
+#
+# the AppContext (config, pools, clients) installed by initialize(),
+# and the per-request pin set by use_context():
+#
+_context = None
+_context_lock = threading.Lock()
+_pinned_context = contextvars.ContextVar('photoapp_context', default=None)
+
+#
+# catalog version: bumped after every committed change to assets or
+# assetlabels, so callers can tell whether metadata they fetched
+# earlier is still current without asking the database. Kept in
+# process memory, or in a file shared by the workers on this host
+# after use_shared_state().
+#
+_catalog = context.CatalogVersion()
+
+#
+# after use_shared_state(): the file holding the settings of the
+# latest initialize(broadcast=True), and a shared counter bumped with
+# it; _context_generation is the counter value this process's context
+# was built for (see follow_initialize):
+#
+_shared_settings = None
+_context_generation = None
+_follow_lock = threading.Lock()
+
+
+###################################################################
+#
+# get_catalog_version / bump_catalog_version
+#
+def get_catalog_version():
+  """
+  Returns the current catalog version, a string that changes
+  whenever assets or their labels change. Read it *before*
+  querying, so the version never claims newer data than the
+  query saw.
+  """
+  return _catalog.get()
+
+
+def bump_catalog_version():
+  """
+  Advances the catalog version; call after committing a change
+  to assets or assetlabels.
+  """
+  _catalog.bump()
+
+
+def use_shared_state(state_dir):
+  """
+  Shares the catalog version with the other worker processes on
+  this host through a file in state_dir, so an ETag issued by one
+  worker is invalidated by a change made in another.
+  """
+  global _catalog, _shared_settings
+  _catalog = context.SharedCatalogVersion(os.path.join(state_dir, 'catalog-version'))
+  #
+  # the same kind of shared counter announces re-initializations:
+  #
+  _shared_settings = (os.path.join(state_dir, 'settings.json'),
+                      context.SharedCatalogVersion(os.path.join(state_dir, 'settings-version')))
+
 
 ###################################################################
 #
 # get_dbConn
 #
-# create and return connection object, based on configuration
-# information in app config file. You should call close() on 
-# the object when you are done.
+# return a connection object from the current context's connection
+# pool. You should call close() on the object when you are done,
+# which returns it to the pool.
 #
 def get_dbConn():
   """
-  Reads the configuration info from app config file, creates
-  pymysql connection object based on this info, and returns it.
-  You should call close() on the object when you are done.
+  Returns a pymysql connection object, borrowed from the pool of
+  the current context (see initialize). You should call close()
+  on the object when you are done.
 
   Parameters
   ----------
@@ -47,32 +124,7 @@ def get_dbConn():
   """
 
   try:
-    #
-    # obtain database server config info:
-    #  
-    configur = ConfigParser()
-    configur.read(PHOTOAPP_CONFIG_FILE)
-
-    endpoint = configur.get('rds', 'endpoint')
-    portnum = int(configur.get('rds', 'port_number'))
-    username = configur.get('rds', 'user_name')
-    pwd = configur.get('rds', 'user_pwd')
-    dbname = configur.get('rds', 'db_name')
-
-    #
-    # now create connection object and return it:
-    #
-    dbConn = pymysql.connect(host=endpoint,
-                port=portnum,
-                user=username,
-                passwd=pwd,
-                database=dbname,
-                #
-                # allow execution of a query string with multiple SQL queries:
-                #
-                client_flag=pymysql.constants.CLIENT.MULTI_STATEMENTS)
-
-    return dbConn
+    return current_context().get_dbConn()
   
   except Exception as err:
     logging.error("get_dbconn():")
@@ -90,9 +142,9 @@ def get_dbConn():
 #
 def get_bucket():
   """
-  Reads the configuration info from app config file, creates
-  a bucket object based on this info, and returns it. You 
-  should call close() on the object when you are done.
+  Creates a bucket object based on the configuration info of
+  the current context, and returns it. You should call close()
+  on the object when you are done.
 
   Parameters
   ----------
@@ -104,23 +156,13 @@ def get_bucket():
   """
 
   try:
-    #
-    # configure S3 access using config file:
-    #  
-    configur = ConfigParser()
-    configur.read(PHOTOAPP_CONFIG_FILE)
-    bucketname = configur.get('s3', 'bucket_name')
-    regionname = configur.get('s3', 'region_name')
-
-    s3 = boto3.resource(
+    ctx = current_context()
+    bucketname = ctx.config.get('s3', 'bucket_name')
+
+    s3 = ctx.session.resource(
            's3',
-           region_name=regionname,
-           config = Config(
-             retries = {
-               'max_attempts': 3,
-               'mode': 'standard'
-             }
-           )
+           region_name=ctx.region_name,
+           config=ctx.client_config()
          )
 
     bucket = s3.Bucket(bucketname)
@@ -131,8 +173,39 @@ def get_bucket():
     logging.error("get_bucket():")
     logging.error(str(err))
     raise
-  
-@retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=2, max=30), reraise=True)
+
+
+###################################################################
+#
+# get_storage
+#
+# return the storage backend (S3, local filesystem or memory)
+# selected by the [storage] section of the app config file.
+# Defaults to S3 when the section is missing.
+#
+def get_storage():
+  """
+  Returns the storage backend of the current context, creating
+  it on first use.
+
+  Parameters
+  ----------
+  N/A
+
+  Returns
+  -------
+  storage.Storage object
+  """
+
+  try:
+    return current_context().storage()
+
+  except Exception as err:
+    logging.error("get_storage():")
+    logging.error(str(err))
+    raise
+
+@retries.retry()
 def get_users():
     try:
         dbConn = get_dbConn()
@@ -159,18 +232,157 @@ def get_users():
         except:
             pass
 
-@retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=2, max=30), reraise=True)
-def get_images(userid=None):
+
+###################################################################
+#
+# get_users_version
+#
+# users are created outside the API (by SQL scripts), so no write here
+# bumps the catalog version for them. Instead the users table is
+# fingerprinted (row count and an XOR of row checksums), re-read at
+# most every USERS_VERSION_TTL seconds: a conditional GET /users
+# mostly skips MySQL, and sees a change to users within that time.
+#
+USERS_VERSION_TTL = 5.0
+
+_users_version = (None, None, 0.0)   # (context, fingerprint, time.monotonic() read)
+_users_version_lock = threading.Lock()
+
+
+def get_users_version():
+  """
+  Returns a string that changes whenever the users table does.
+  """
+  global _users_version
+
+  ctx = _pinned_context.get() or _context
+  with _users_version_lock:
+    cached_ctx, version, read_at = _users_version
+    if cached_ctx is ctx and version is not None and time.monotonic() - read_at < USERS_VERSION_TTL:
+      return version
+
+  @retries.retry()
+  def fingerprint():
+    dbConn = get_dbConn()
+    try:
+      dbCursor = dbConn.cursor()
+      sql = """
+          SELECT COUNT(*),
+                 COALESCE(BIT_XOR(CRC32(CONCAT_WS(0x1f, userid, username, givenname, familyname))), 0)
+          FROM users;
+          """
+      dbCursor.execute(sql)
+      return dbCursor.fetchone()
+    finally:
+      dbConn.close()
+
+  try:
+    count, checksum = fingerprint()
+  except Exception as err:
+    logging.error("get_users_version():")
+    logging.error(str(err))
+    raise
+
+  version = f"u{int(count):x}.{int(checksum):x}"
+  with _users_version_lock:
+    _users_version = (ctx, version, time.monotonic())
+  return version
+
+
+#
+# columns of the rows returned by get_images():
+#
+IMAGE_COLUMNS = ("assetid", "userid", "localname", "bucketkey",
+                 "size", "mime", "width", "height", "taken_at", "orientation")
+
+#
+# defaults for get_images(similar_to=...) and find_similar(): max
+# Hamming distance between perceptual hashes, and max # of images.
+# Searches within 6 bits take well under a millisecond over a million
+# indexed hashes; each further bit costs several times more (see
+# bench.py similar):
+#
+SIMILAR_DISTANCE = 6
+SIMILAR_LIMIT = 100
+
+
+def image_filters(userid=None, min_width=None, taken_after=None):
+    """
+    The WHERE conditions and parameters for get_images()'s filters.
+    """
+    conditions = []
+    params = []
+    if userid is not None:
+        conditions.append("userid = %s")
+        params.append(userid)
+    if min_width is not None:
+        conditions.append("width >= %s")
+        params.append(min_width)
+    if taken_after is not None:
+        conditions.append("taken_at > %s")
+        params.append(taken_after)
+    return conditions, params
+
+
+def images_sql(conditions):
+    """get_images()'s query for the given WHERE conditions."""
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    return f"SELECT {', '.join(IMAGE_COLUMNS)} FROM assets {where} ORDER BY assetid ASC;"
+
+
+@retries.retry()
+def get_images(userid=None, min_width=None, taken_after=None, similar_to=None,
+               max_distance=SIMILAR_DISTANCE, similar_limit=SIMILAR_LIMIT):
+    """
+    Returns the images (rows of IMAGE_COLUMNS) in assetid order, all of
+    them or those of userid, optionally filtered to images at least
+    min_width pixels wide, taken after the datetime taken_after, or
+    whose perceptual hash is within max_distance bits of the image
+    similar_to's (an assetid; the image itself is not included). With
+    similar_to, only the similar_limit nearest matches are returned.
+    """
     try:
         dbConn = get_dbConn()
         dbCursor = dbConn.cursor()
 
-        if userid is None:
-            sql = "SELECT assetid, userid, localname, bucketkey FROM assets ORDER BY assetid ASC;"
-            dbCursor.execute(sql)
-        else:
-            sql = "SELECT assetid, userid, localname, bucketkey FROM assets WHERE userid = %s ORDER BY assetid ASC;"
-            dbCursor.execute(sql, (userid,))
+        conditions, params = image_filters(userid, min_width, taken_after)
+        columns = ', '.join(IMAGE_COLUMNS)
+
+        if similar_to is not None:
+            _refresh_similar_if_stale()
+            index = _similar
+            h = index.get(similar_to) if index.ready else None
+            if h is not None:
+                #
+                # the candidates, nearest first, a bounded IN list at a
+                # time until similar_limit of them pass the filters:
+                #
+                found = index.search(h, max_distance, exclude=similar_to,
+                                     limit=None if conditions else similar_limit)
+                rank = {assetid: i for i, (_, assetid) in enumerate(found)}
+                rows = []
+                for start in range(0, len(found), similar_limit):
+                    ids = [assetid for _, assetid in found[start:start + similar_limit]]
+                    where = " AND ".join(conditions + [f"assetid IN ({', '.join(['%s'] * len(ids))})"])
+                    dbCursor.execute(f"SELECT {columns} FROM assets WHERE {where};", params + ids)
+                    rows.extend(dbCursor.fetchall())
+                    if len(rows) >= similar_limit:
+                        break
+                rows = sorted(rows, key=lambda row: rank[row[0]])[:similar_limit]
+                return sorted(rows, key=lambda row: row[0])
+
+            conditions.append("assetid <> %s AND BIT_COUNT(phash ^ (SELECT phash FROM assets WHERE assetid = %s)) <= %s")
+            params.extend((similar_to, similar_to, max_distance))
+            where = " AND ".join(conditions)
+            sql = f"""
+                SELECT {columns} FROM assets WHERE {where}
+                ORDER BY BIT_COUNT(phash ^ (SELECT phash FROM assets WHERE assetid = %s)) ASC, assetid ASC
+                LIMIT %s;
+                """
+            dbCursor.execute(sql, params + [similar_to, similar_limit])
+            return sorted(dbCursor.fetchall(), key=lambda row: row[0])
+
+        dbCursor.execute(images_sql(conditions), params)
         
         rows = dbCursor.fetchall()
 
@@ -190,149 +402,294 @@ def get_images(userid=None):
             dbConn.close()
         except:
             pass
+
+
+###################################################################
+#
+# detect_labels
+#
+# runs the configured label detector on an uploaded object; never
+# raises, since an image without labels is still a valid upload.
+#
+def detect_labels(store, bucketkey, local_filename=None):
+  """
+  Labels the object stored under bucketkey.
+
+  Parameters
+  ----------
+  store is the storage.Storage holding the object
+  bucketkey is the object's key
+  local_filename is a local copy of the image, or None; if a copy is
+    needed (the detector reads pixels, or the object isn't in S3) and
+    none is given, the object is downloaded to a temporary file
+
+  Returns
+  -------
+  (labels, label_status) where labels is a list of {'Name', 'Confidence'}
+  dicts and label_status is 'done', 'none' (no labels found), 'failed',
+  or 'pending' if too many Rekognition calls were already in flight
+  (relabel_pending() labels those later)
+  """
+
+  tmpdir = None
+
+  try:
+    bucketname = store.bucket_name if isinstance(store, storage.S3Storage) else None
+    detector = get_detector()
+
+    by_reference = isinstance(detector, detectors.RekognitionDetector) and bucketname is not None
+    if local_filename is None and not by_reference:
+      tmpdir = tempfile.mkdtemp(prefix="photoapp-")
+      local_filename = os.path.join(tmpdir, "image")
+      store.download_to(bucketkey, local_filename)
+
+    image = detectors.ImageInput(bucketname, bucketkey, local_filename)
+    if isinstance(detector, detectors.RekognitionDetector):
+      with limits.ADMISSION.rekognition.slot():
+        labels = detector.detect(image)
+    else:
+      labels = detector.detect(image)
+
+    return labels, ('done' if labels else 'none')
+
+  except limits.Overloaded as err:
+    logging.warning(f"detect_labels(): {err}, leaving labels pending")
+    return [], 'pending'
+
+  except Exception as err:
+    logging.warning("detect_labels(): label detection failed")
+    logging.warning(str(err))
+    return [], 'failed'
+
+  finally:
+    if tmpdir is not None:
+      shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+###################################################################
+#
+# extract_metadata
+#
+# reads an uploaded image's type, dimensions and EXIF data from its
+# header bytes, and its perceptual hash; never raises, since an image
+# without metadata is still a valid upload.
+#
+def extract_metadata(store, bucketkey, head=None, local_filename=None):
+  """
+  Parameters
+  ----------
+  store is the storage.Storage holding the object
+  bucketkey is the object's key
+  head is the image's first metadata.HEADER_BYTES bytes, or None to
+    read them from storage
+  local_filename is a local copy of the image, or None; the perceptual
+    hash needs the whole image, so without one the object is downloaded
+    to a temporary file (only if PIL is installed)
+
+  Returns
+  -------
+  dict {'mime', 'width', 'height', 'taken_at', 'orientation', 'phash'},
+  None for anything that could not be determined
+  """
+
+  tmpdir = None
+
+  try:
+    if head is None:
+      head = store.get_range(bucketkey, 0, metadata.HEADER_BYTES - 1)
+    meta = metadata.extract(head)
+    meta['phash'] = None
+
+    if meta['mime'] is not None and metadata.can_hash():
+      if local_filename is None:
+        tmpdir = tempfile.mkdtemp(prefix="photoapp-")
+        local_filename = os.path.join(tmpdir, "image")
+        store.download_to(bucketkey, local_filename)
+      meta['phash'] = metadata.perceptual_hash(local_filename)
+
+    return meta
+
+  except Exception as err:
+    logging.warning("extract_metadata(): metadata extraction failed")
+    logging.warning(str(err))
+    return dict(metadata.empty(), phash=None)
+
+  finally:
+    if tmpdir is not None:
+      shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+###################################################################
+#
+# store_labels
+#
+# stores an asset's labels, content hash, label status and metadata
+# (as returned by extract_metadata, or None) in one round trip on the
+# given connection, and commits. With replace, any labels the asset
+# already has are deleted first.
+#
+METADATA_COLUMNS = ('mime', 'width', 'height', 'taken_at', 'orientation', 'phash')
+
+
+def store_labels(dbConn, assetid, labels, label_status, content_hash, meta=None, replace=False):
+  dbCursor = dbConn.cursor()
+
+  try:
+    meta = meta or {}
+    updates = "".join(f", {c} = COALESCE(%s, {c})" for c in METADATA_COLUMNS)
+    sql = f"""
+        UPDATE assets SET content_hash = COALESCE(%s, content_hash), label_status = %s{updates}
+        WHERE assetid = %s;
+        """
+    params = [content_hash, label_status] + [meta.get(c) for c in METADATA_COLUMNS] + [assetid]
+
+    if labels:
+      # Properly processes a dictionary as returned by Rekognition
+      values = ", ".join(["(%s, %s, %s)"] * len(labels))
+      sql = f"INSERT INTO assetlabels (assetid, label, confidence) VALUES {values};" + sql
+      label_params = []
+      for label in labels:
+        label_params.extend((assetid, label.get('Name'), int(label.get('Confidence'))))
+      params = label_params + params
+
+    if replace:
+      sql = "DELETE FROM assetlabels WHERE assetid = %s;" + sql
+      params = [assetid] + params
+
+    dbCursor.execute(sql, params)
+
+    dbConn.commit()
+    bump_catalog_version()
+
+  finally:
+    dbCursor.close()
+
+
+def publish_labels_ready(assetid, userid, labels, label_status):
+  events.publish('labels-ready', assetid=assetid, userid=userid, label_status=label_status,
+                 labels=[(l.get('Name'), int(l.get('Confidence'))) for l in labels])
+
+
 def post_image(userid, local_filename):
-    @retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=2, max=30), reraise=True)
+    #
+    # one database connection serves the whole upload; it is only
+    # replaced if an error leaves it unusable (so a retry starts
+    # from a fresh connection):
+    #
+    dbConn = None
+
+    def connection():
+        nonlocal dbConn
+        if dbConn is None or not dbConn.open:
+            dbConn = get_dbConn()
+        return dbConn
+
+    def discard_connection():
+        nonlocal dbConn
+        try:
+            dbConn.close()
+        except:
+            pass
+        dbConn = None
+
+    @retries.retry(give_up_on=ValueError)
     def get_username():
         try:
-            dbConn = get_dbConn()
-            dbCursor = dbConn.cursor()
+          dbCursor = connection().cursor()
+          dbCursor.execute("SELECT username FROM users WHERE userid = %s;", (userid,))
+          row = dbCursor.fetchone()
 
-            sql = "SELECT username FROM users WHERE userid = %s;"
-            dbCursor.execute(sql, (userid,))
-            row = dbCursor.fetchone()
+          if row is None:
+            raise ValueError("no such userid")
 
-            if row is None:
-              raise ValueError("no such userid")
-            
-            return row[0]
+          return row[0]
+
+        except ValueError:
+          raise
 
         except Exception as err:
-            logging.error("post_image.get_username():")
-            logging.error(str(err))
-            raise
-        
-        finally:
-            try: 
-                dbCursor.close()
-            except: 
-                pass
-            try:
-                dbConn.close()
-            except:
-                pass
+          logging.error("post_image.get_username():")
+          logging.error(str(err))
+          discard_connection()
+          raise
 
-    @retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=2, max=30), reraise=True)
-    def insert_db(bucketkey):
+    @retries.retry()
+    def insert_db(bucketkey, size):
         try:
-          dbConn = get_dbConn()
-          dbCursor = dbConn.cursor()
-
-          dbConn.begin()
+          dbCursor = connection().cursor()
 
           sql = """
-              INSERT INTO assets (userid, localname, bucketkey)
-              VALUES (%s, %s, %s);
+              INSERT INTO assets (userid, localname, bucketkey, size, label_status)
+              VALUES (%s, %s, %s, %s, 'pending');
               """
-            
-          dbCursor.execute(sql, (userid, local_filename, bucketkey))
+          dbCursor.execute(sql, (userid, local_filename, bucketkey, size))
+          assetid = dbCursor.lastrowid
 
-          sql = "SELECT LAST_INSERT_ID();"
-          dbCursor.execute(sql)
-          row = dbCursor.fetchone()
-          assetid = row[0]
-            
           dbConn.commit()
-            
+          bump_catalog_version()
+
           return assetid
 
         except Exception as err:
           logging.error("post_image.insert_db():")
           logging.error(str(err))
-          try:
-            dbConn.rollback()
-          except:
-            pass
+          discard_connection()
           raise
-        
-        finally:
-          try: 
-            dbCursor.close()
-          except: 
-            pass
-          try:
-            dbConn.close()
-          except:
-            pass
 
-    @retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=2, max=30), reraise=True)
-    def insert_labels(assetid, labels):
+    @retries.retry()
+    def insert_labels(assetid, labels, label_status, content_hash, meta):
         try:
-          dbConn = get_dbConn()
-          dbCursor = dbConn.cursor()
-
-          dbConn.begin()
-
-          insert_assetlabel_sql = """
-              INSERT INTO assetlabels (assetid, label, confidence)
-              VALUES (%s, %s, %s);
-            """
-          # Properly processes a dictionary as returned by Rekognition
-          for label in labels:
-            label_name = label.get('Name')
-            confidence = label.get('Confidence')
-            dbCursor.execute(insert_assetlabel_sql, (assetid, label_name, int(confidence)))
-
-          dbConn.commit()
-
+          store_labels(connection(), assetid, labels, label_status, content_hash, meta)
         except Exception as err:
           logging.error("post_image.insert_labels():")
           logging.error(str(err))
-          try:
-            dbConn.rollback()
-          except:
-            pass
+          discard_connection()
           raise
-        
-        finally:
-          try: 
-            dbCursor.close()
-          except: 
-            pass
-          try:
-            dbConn.close()
-          except:
-            pass
-    
+
     try:
-        username = get_username()
-        
-        unique_part = str(uuid.uuid4())
-        bucketkey = f"{username}/{unique_part}-{local_filename}"
-        
-        bucket = get_bucket()
-        bucket.upload_file(local_filename, bucketkey)
-        
-        assetid = insert_db(bucketkey)
-        
+        size = os.path.getsize(local_filename)
+        #
+        # the object is stored before the asset row is inserted, so
+        # the asset never appears in listings without its image; the
+        # upload is identified by its bucketkey until then:
+        #
+        bucketkey = f"{get_username()}/{uuid.uuid4()}-{local_filename}"
+
+        store = get_storage()
         try:
-            rekognition = get_rekognition()
-            response = rekognition.detect_labels(
-              Image={
-                'S3Object': {
-                  'Bucket': bucket.name,
-                  'Name': bucketkey
-                }
-              },
-              MaxLabels=100,
-              MinConfidence=80
-            )
-            labels = response['Labels']
-            
-            if labels:
-              insert_labels(assetid, labels)
+            with open(local_filename, "rb") as f:
+                reader = storage.DigestReader(f, keep=metadata.HEADER_BYTES)
+                progress = events.ProgressReporter(None, userid, size, bucketkey=bucketkey)
+                store.put_stream(bucketkey, reader, callback=progress)
+        except Exception as err:
+            events.publish('upload-failed', assetid=None, userid=userid, bucketkey=bucketkey,
+                           error=str(err))
+            raise
+
+        try:
+            assetid = insert_db(bucketkey, size)
+        except Exception:
+            #
+            # don't leave an object behind that no asset points at:
+            #
+            store.delete_many([bucketkey])
+            raise
+
+        events.publish('asset-created', assetid=assetid, userid=userid,
+                       localname=local_filename, bucketkey=bucketkey, size=size)
+
+        labels, label_status = detect_labels(store, bucketkey, local_filename)
+        meta = extract_metadata(store, bucketkey, reader.head, local_filename)
+
+        try:
+            insert_labels(assetid, labels, label_status, reader.hexdigest(), meta)
+            index_similar(assetid, meta['phash'])
         except Exception as err:
-            logging.warning("post_image: Rekognition failed")
+            logging.warning("post_image: storing labels failed")
             logging.warning(str(err))
+            label_status = 'failed'
+
+        publish_labels_ready(assetid, userid, labels, label_status)
         
         return assetid
     
@@ -340,9 +697,372 @@ def post_image(userid, local_filename):
         logging.error("post_image():")
         logging.error(str(err))
         raise
+
+    finally:
+        if dbConn is not None:
+            discard_connection()
     
+###################################################################
+#
+# chunked uploads
+#
+# A large image can be uploaded in parts: begin_upload() validates the
+# user and starts a multipart upload in storage, upload_part() stores
+# one part (retrying a part replaces it), assemble_upload() builds the
+# object from the parts and complete_upload() inserts the asset and
+# labels it. Callers (see uploads.py) track which parts have arrived
+# and which phase has finished.
+#
+def begin_upload(userid, local_filename):
+  """
+  Starts a chunked upload of local_filename for the given user.
+
+  Parameters
+  ----------
+  userid of the user uploading the image
+  local_filename is the image's file name (no data is read)
+
+  Returns
+  -------
+  (bucketkey, upload_id); raises ValueError if there is no such userid
+  """
+
+  @retries.retry(give_up_on=ValueError)
+  def get_username():
+    try:
+      dbConn = get_dbConn()
+      dbCursor = dbConn.cursor()
+
+      sql = "SELECT username FROM users WHERE userid = %s;"
+      dbCursor.execute(sql, (userid,))
+      row = dbCursor.fetchone()
+
+      if row is None:
+        raise ValueError("no such userid")
+
+      return row[0]
+
+    finally:
+      try:
+        dbCursor.close()
+      except:
+        pass
+      try:
+        dbConn.close()
+      except:
+        pass
+
+  try:
+    username = get_username()
+    bucketkey = f"{username}/{uuid.uuid4()}-{local_filename}"
+
+    upload_id = get_storage().create_multipart(bucketkey)
+
+    return bucketkey, upload_id
+
+  except Exception as err:
+    logging.error("begin_upload():")
+    logging.error(str(err))
+    raise
+
+
+def upload_part(bucketkey, upload_id, part_number, data):
+  """
+  Stores bytes data as part part_number (from 1) of a chunked upload
+  and returns the part's ETag.
+  """
+  try:
+    return get_storage().upload_part(bucketkey, upload_id, part_number, data)
+
+  except Exception as err:
+    logging.error("upload_part():")
+    logging.error(str(err))
+    raise
+
+
+def abort_upload(bucketkey, upload_id, assembled=False):
+  """
+  Abandons a chunked upload, discarding the parts stored so far, or
+  the object once assemble_upload() has built it.
+  """
+  try:
+    store = get_storage()
+    if assembled:
+      store.delete_many([bucketkey])
+    else:
+      store.abort_multipart(bucketkey, upload_id)
+
+  except Exception as err:
+    logging.error("abort_upload():")
+    logging.error(str(err))
+    raise
+
+
+def assemble_upload(bucketkey, upload_id, parts):
+  """
+  First phase of finishing a chunked upload: assembles the object
+  from its parts, after which upload_id no longer exists in storage.
+
+  Parameters
+  ----------
+  bucketkey, upload_id as returned by begin_upload()
+  parts is a list of (part_number, etag) tuples in ascending order
+  """
+  try:
+    get_storage().complete_multipart(bucketkey, upload_id, parts)
+
+  except Exception as err:
+    logging.error("assemble_upload():")
+    logging.error(str(err))
+    raise
+
+
+def complete_upload(userid, local_filename, bucketkey, size, content_hash=None):
+  """
+  Second phase of finishing a chunked upload: inserts the asset for
+  the object assemble_upload() built and labels it, as post_image()
+  does. Safe to retry: if the asset was already inserted, its assetid
+  is returned (its labels, if still pending, are left to
+  relabel_pending()).
+
+  Parameters
+  ----------
+  userid, local_filename, bucketkey as for begin_upload()
+  size is the total # of bytes uploaded
+  content_hash is the SHA-256 hex digest of the image, if known
+
+  Returns
+  -------
+  the assetid; raises ValueError if the user no longer exists
+  """
+
+  @retries.retry(give_up_on=ValueError)
+  def insert_db():
+    try:
+      dbConn = get_dbConn()
+      dbCursor = dbConn.cursor()
+
+      sql = """
+          INSERT INTO assets (userid, localname, bucketkey, size, content_hash, label_status)
+          SELECT userid, %s, %s, %s, %s, 'pending'
+          FROM users
+          WHERE userid = %s
+            AND NOT EXISTS (SELECT 1 FROM assets WHERE bucketkey = %s);
+          SELECT assetid FROM assets WHERE bucketkey = %s;
+          """
+      dbCursor.execute(sql, (local_filename, bucketkey, size, content_hash, userid,
+                             bucketkey, bucketkey))
+
+      if dbCursor.rowcount == 1:
+        assetid = dbCursor.lastrowid
+        dbConn.commit()
+        bump_catalog_version()
+        return assetid, True
+
+      dbCursor.nextset()
+      row = dbCursor.fetchone()
+      dbConn.rollback()
+
+      if row is None:
+        raise ValueError("no such userid")
+
+      return row[0], False
+
+    finally:
+      try:
+        dbCursor.close()
+      except:
+        pass
+      try:
+        dbConn.close()
+      except:
+        pass
+
+  @retries.retry()
+  def insert_labels(assetid, labels, label_status, meta):
+    dbConn = get_dbConn()
+    try:
+      store_labels(dbConn, assetid, labels, label_status, None, meta)
+    finally:
+      dbConn.close()
+
+  try:
+    assetid, created = insert_db()
+    if not created:
+      return assetid
+
+    events.publish('asset-created', assetid=assetid, userid=userid,
+                   localname=local_filename, bucketkey=bucketkey, size=size)
+
+    store = get_storage()
+    labels, label_status = detect_labels(store, bucketkey)
+    meta = extract_metadata(store, bucketkey)
+
+    try:
+      insert_labels(assetid, labels, label_status, meta)
+      index_similar(assetid, meta['phash'])
+    except Exception as err:
+      logging.warning("complete_upload: storing labels failed")
+      logging.warning(str(err))
+      label_status = 'failed'
+
+    publish_labels_ready(assetid, userid, labels, label_status)
+
+    return assetid
+
+  except Exception as err:
+    logging.error("complete_upload():")
+    logging.error(str(err))
+    raise
+
+
+###################################################################
+#
+# relabel_pending
+#
+# labels the assets whose labels are still pending: detection was shed
+# because too many Rekognition calls were in flight, or storing the
+# labels failed. Images are labeled a batch at a time through the
+# detector's detect_batch, which the ONNX detector spreads over its
+# process pool and Rekognition sends concurrently. The API runs it
+# every RELABEL_INTERVAL seconds ([labels] relabel_interval); the
+# relabel command runs it by hand.
+#
+RELABEL_INTERVAL = 300
+RELABEL_LIMIT = 100
+RELABEL_BATCH = 8
+#
+# assets younger than this (seconds) may still be mid-upload:
+#
+RELABEL_GRACE = 300
+
+
+def pending_labels_sql(statuses):
+  """relabel_pending()'s query for assets with any of the statuses."""
+  return f"""
+      SELECT assetid, userid, bucketkey FROM assets
+      WHERE label_status IN ({', '.join(['%s'] * len(statuses))})
+        AND created_at < NOW() - INTERVAL %s SECOND
+      ORDER BY assetid ASC LIMIT %s;
+      """
+
+
+def relabel_pending(limit=RELABEL_LIMIT, batch_size=RELABEL_BATCH, grace=RELABEL_GRACE,
+                    statuses=('pending',), lock_path=None):
+  """
+  Detects and stores labels for up to limit assets whose label_status
+  is one of statuses, oldest assetid first. lock_path is a lock file
+  shared by the workers on this host; if another process holds it,
+  the call returns None immediately.
+
+  Returns
+  -------
+  dict {'relabeled': # of assets labeled, 'failed': # whose detection
+  failed, 'overloaded': True if the sweep stopped early because label
+  detection was at capacity}, or None if skipped
+  """
+
+  @retries.retry()
+  def load_pending():
+    dbConn = get_dbConn()
+    try:
+      dbCursor = dbConn.cursor()
+      dbCursor.execute(pending_labels_sql(statuses), (*statuses, grace, limit))
+      return dbCursor.fetchall()
+    finally:
+      dbConn.close()
+
+  @retries.retry()
+  def save(results):
+    dbConn = get_dbConn()
+    try:
+      for (assetid, userid, _), (labels, label_status) in results:
+        store_labels(dbConn, assetid, labels, label_status, None, replace=True)
+    finally:
+      dbConn.close()
+
+  report = {'relabeled': 0, 'failed': 0, 'overloaded': False}
+
+  with contextlib.ExitStack() as stack:
+    if lock_path is not None and not stack.enter_context(reconciler.exclusive(lock_path)):
+      logging.info("relabel_pending(): already running in another process")
+      return None
+
+    try:
+      rows = load_pending()
+      if not rows:
+        return report
+
+      store = get_storage()
+      detector = get_detector()
+      bucketname = store.bucket_name if isinstance(store, storage.S3Storage) else None
+      rekognition = isinstance(detector, detectors.RekognitionDetector)
+      if rekognition:
+        # a batch holds one Rekognition slot per image:
+        batch_size = max(1, min(batch_size, limits.ADMISSION.rekognition.limit))
+
+      for start in range(0, len(rows), batch_size):
+        batch = rows[start:start + batch_size]
+
+        tmpdir = tempfile.mkdtemp(prefix="photoapp-")
+        try:
+          images = []
+          for assetid, _, bucketkey in batch:
+            filename = None
+            if not (rekognition and bucketname is not None):
+              filename = os.path.join(tmpdir, str(assetid))
+              store.download_to(bucketkey, filename)
+            images.append(detectors.ImageInput(bucketname, bucketkey, filename))
+
+          with contextlib.ExitStack() as slots:
+            if rekognition:
+              for _ in images:
+                slots.enter_context(limits.ADMISSION.rekognition.slot())
+            try:
+              found = detector.detect_batch(images)
+            except Exception as err:
+              #
+              # one bad image fails the whole batch; label the images
+              # one by one so only the bad ones are marked failed:
+              #
+              logging.warning(f"relabel_pending(): batch failed ({err}), retrying one by one")
+              found = []
+              for image in images:
+                try:
+                  found.append(detector.detect(image))
+                except Exception as err:
+                  logging.warning(f"relabel_pending(): {image.key}: {err}")
+                  found.append(None)
+        finally:
+          shutil.rmtree(tmpdir, ignore_errors=True)
+
+        results = []
+        for row, labels in zip(batch, found):
+          if labels is None:
+            results.append((row, ([], 'failed')))
+          else:
+            results.append((row, (labels, 'done' if labels else 'none')))
+        save(results)
+
+        for (assetid, userid, _), (labels, label_status) in results:
+          publish_labels_ready(assetid, userid, labels, label_status)
+          report['relabeled' if label_status != 'failed' else 'failed'] += 1
+
+      return report
+
+    except limits.Overloaded as err:
+      logging.warning(f"relabel_pending(): {err}, stopping")
+      report['overloaded'] = True
+      return report
+
+    except Exception as err:
+      logging.error("relabel_pending():")
+      logging.error(str(err))
+      raise
+
+
 def get_image(assetid, local_filename=None):
-    @retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=2, max=30), reraise=True)
+    @retries.retry()
     def get_bucketkey_and_localname():
         try:
             dbConn = get_dbConn()
@@ -381,8 +1101,8 @@ def get_image(assetid, local_filename=None):
         if local_filename is None:
             local_filename = db_local_filename
         
-        bucket = get_bucket()
-        bucket.download_file(bucketkey, local_filename)
+        store = get_storage()
+        store.download_to(bucketkey, local_filename)
         
         return local_filename
 
@@ -392,9 +1112,51 @@ def get_image(assetid, local_filename=None):
         raise
 
 
+OPEN_IMAGE_SQL = "SELECT bucketkey, localname, mime FROM assets WHERE assetid = %s;"
+
+
+def open_image(assetid):
+  """
+  Looks up image assetid for serving it.
+
+  Returns
+  -------
+  (localname, mime, source) where source is the path of the stored
+  file if the storage backend keeps objects as local files (so it can
+  be sent from disk as is), else a readable file object the caller
+  must close(). Raises ValueError if there is no such assetid, and
+  storage.NoSuchKey if its object is missing.
+  """
+
+  @retries.retry()
+  def get_asset():
+    dbConn = get_dbConn()
+    try:
+      dbCursor = dbConn.cursor()
+      dbCursor.execute(OPEN_IMAGE_SQL, (assetid,))
+      return dbCursor.fetchone()
+    finally:
+      dbConn.close()
+
+  try:
+    row = get_asset()
+    if row is None:
+      raise ValueError("no such assetid")
+    bucketkey, localname, mime = row
+
+    store = get_storage()
+    path = store.local_path(bucketkey)
+    return localname, mime, (path if path is not None else store.get_stream(bucketkey))
+
+  except Exception as err:
+    logging.error("open_image():")
+    logging.error(str(err))
+    raise
+
+
 def delete_images():
-  @retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=2, max=30), reraise=True)
-  def delete_all_images():
+  @retries.retry()
+  def delete_all_images(location):
     try:
       dbConn = get_dbConn()
       dbCursor = dbConn.cursor()
@@ -404,16 +1166,15 @@ def delete_images():
       dbCursor.execute("SELECT bucketkey FROM assets;")
       keys = [row[0] for row in dbCursor.fetchall()]
 
-      sql = """
-        SET foreign_key_checks = 0;
-        TRUNCATE TABLE assetlabels;
-        TRUNCATE TABLE assets;
-        SET foreign_key_checks = 1;
-        ALTER TABLE assets AUTO_INCREMENT = 1001;
-        """
-      dbCursor.execute(sql)
+      migrations.reset_assets(dbCursor)
+      #
+      # the recorded bucket stats are stale now; get_ping() lists
+      # storage until the next reconcile():
+      #
+      dbCursor.execute("DELETE FROM bucket_stats WHERE location = %s;", (location,))
 
       dbConn.commit()
+      bump_catalog_version()
 
       return keys
 
@@ -437,47 +1198,118 @@ def delete_images():
         pass
     
   try:
-    bucketkeys = delete_all_images()
+    store = get_storage()
+    bucketkeys = delete_all_images(store.location)
+    clear_similar()
+
+    if bucketkeys:
+      failed = store.delete_many(bucketkeys)
+      if failed:
+        logging.warning(f"delete_images: {len(failed)} objects could not be deleted")
+
+    return True
+
+  except Exception as err:
+    logging.error("delete_images():")
+    logging.error(str(err))
+    raise
+
+
+#
+# the LEFT JOIN checks the asset exists and fetches its labels in one
+# round trip: no rows means no such asset, a single row with a NULL
+# label means an asset without labels.
+#
+IMAGE_LABELS_SQL = """
+  SELECT a.assetid, l.label, l.confidence
+  FROM assets a
+  LEFT JOIN assetlabels l ON l.assetid = a.assetid
+  WHERE a.assetid = %s
+  ORDER BY l.label ASC;
+  """
+
+
+@retries.retry(give_up_on=ValueError)
+def get_image_labels(assetid):
+  try:
+    dbConn = get_dbConn()
+    dbCursor = dbConn.cursor()
+
+    dbCursor.execute(IMAGE_LABELS_SQL, (assetid,))
+    rows = dbCursor.fetchall()
+
+    if not rows:
+      raise ValueError("no such assetid")
+
+    return [(row[1], row[2]) for row in rows if row[1] is not None]
+
+  except Exception as err:
+    logging.error("get_image_labels():")
+    logging.error(str(err))
+    raise
+
+  finally:
+    try:
+      dbCursor.close()
+    except:
+      pass
+    try:
+      dbConn.close()
+    except:
+      pass
+
+
+#
+# max # of assetids per IN (...) list in get_labels_for_assets:
+#
+LABELS_BATCH_SIZE = 1000
 
-    if bucketkeys:
-      objects_to_delete = [{'Key': key} for key in bucketkeys]
-      bucket = get_bucket()
-      bucket.delete_objects(Delete={'Objects': objects_to_delete})
 
-    return True
+@retries.retry()
+def get_labels_for_assets(assetids):
+  """
+  Retrieves the labels of many assets at once, using one
+  WHERE assetid IN (...) query per LABELS_BATCH_SIZE assetids.
 
-  except Exception as err:
-    logging.error("delete_images():")
-    logging.error(str(err))
-    raise
+  Parameters
+  ----------
+  assetids is a list of asset ids
+
+  Returns
+  -------
+  dict mapping each requested assetid to its list of (label, confidence)
+  tuples, in label order; the list is empty for assets without labels
+  (or that do not exist)
+  """
 
+  labels = {assetid: [] for assetid in assetids}
+  if not labels:
+    return labels
 
-@retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=2, max=30), reraise=True)
-def get_image_labels(assetid):
   try:
     dbConn = get_dbConn()
     dbCursor = dbConn.cursor()
 
-    sql = "SELECT assetid FROM assets WHERE assetid = %s;"
-    dbCursor.execute(sql, (assetid,))
-    row = dbCursor.fetchone()
-        
-    if row is None:
-      raise ValueError("no such assetid")
+    ids = list(labels)
+    for i in range(0, len(ids), LABELS_BATCH_SIZE):
+      batch = ids[i:i + LABELS_BATCH_SIZE]
+      placeholders = ", ".join(["%s"] * len(batch))
 
-    sql = """
-      SELECT label, confidence
-      FROM assetlabels
-      WHERE assetid = %s
-      ORDER BY label ASC;
-      """
-    dbCursor.execute(sql, (assetid,))
-    rows = dbCursor.fetchall()
+      sql = f"""
+        SELECT assetid, label, confidence
+        FROM assetlabels
+        WHERE assetid IN ({placeholders})
+        ORDER BY assetid ASC, label ASC;
+        """
+      dbCursor.execute(sql, batch)
 
-    return list(rows)
+      for assetid, label, confidence in dbCursor.fetchall():
+        labels[assetid].append((label, confidence))
+
+    return labels
 
   except Exception as err:
-    logging.error("get_image_labels():")
+    logging.error("get_labels_for_assets():")
     logging.error(str(err))
     raise
 
@@ -492,21 +1324,36 @@ def get_image_labels(assetid):
       pass
 
 
-@retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=2, max=30), reraise=True)
+###################################################################
+#
+# get_images_with_label
+#
+# labels matching a prefix of the search text (case-insensitively, as
+# the column collation compares); a prefix LIKE is a range scan on the
+# (label, confidence, assetid) index, where a substring match would
+# scan the whole table.
+#
+LABEL_SEARCH_SQL = """
+  SELECT assetid, label, confidence
+  FROM assetlabels
+  WHERE label LIKE %s
+  ORDER BY assetid ASC, label ASC;
+  """
+
+
+def label_search_pattern(label):
+  """LIKE pattern matching labels that start with label, taken literally."""
+  escaped = str(label).replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+  return escaped + "%"
+
+
+@retries.retry()
 def get_images_with_label(label):
   try:
     dbConn = get_dbConn()
     dbCursor = dbConn.cursor()
 
-    search_pattern = "%" + str(label) + "%"
-    
-    sql = """
-      SELECT assetid, label, confidence
-      FROM assetlabels
-      WHERE label LIKE %s
-      ORDER BY assetid ASC, label ASC;
-      """
-    dbCursor.execute(sql, [search_pattern])
+    dbCursor.execute(LABEL_SEARCH_SQL, [label_search_pattern(label)])
     rows = dbCursor.fetchall()
 
     return list(rows)
@@ -526,6 +1373,32 @@ def get_images_with_label(label):
     except:
       pass
 
+
+###################################################################
+#
+# HOT_QUERIES
+#
+# The queries run per request or per sweep, with sample parameters,
+# for migrations.check_query_plans(). Each is built from the same SQL
+# the code executes, so the plans checked are the ones served.
+#
+def _images_query(name, **filters):
+  conditions, params = image_filters(**filters)
+  return (name, images_sql(conditions), tuple(params))
+
+
+HOT_QUERIES = [
+  _images_query("get_images(userid)", userid=80001),
+  _images_query("get_images(min_width)", min_width=4000),
+  _images_query("get_images(taken_after)", taken_after='2030-01-01'),
+  ("open_image(assetid)", OPEN_IMAGE_SQL, (migrations.ASSETID_START,)),
+  ("get_image_labels(assetid)", IMAGE_LABELS_SQL, (migrations.ASSETID_START,)),
+  ("get_images_with_label(label)", LABEL_SEARCH_SQL, (label_search_pattern('Anim'),)),
+  ("relabel_pending", pending_labels_sql(('pending',)), ('pending', RELABEL_GRACE, RELABEL_LIMIT)),
+  ("reconciler assets page", reconciler.ASSETS_PAGE_SQL, ('', reconciler.PAGE_SIZE)),
+]
+
+
 ###################################################################
 #
 # get_rekognition
@@ -536,8 +1409,8 @@ def get_images_with_label(label):
 #
 def get_rekognition():
   """
-  Reads the configuration info from app config file, creates
-  a rekognition object based on this info, and returns it.
+  Creates a rekognition object based on the configuration info
+  of the current context, and returns it.
   You should call close() on the object when you are done.
 
   Parameters
@@ -550,25 +1423,7 @@ def get_rekognition():
   """
 
   try:
-    #
-    # configure S3 access using config file:
-    #  
-    configur = ConfigParser()
-    configur.read(PHOTOAPP_CONFIG_FILE)
-    regionname = configur.get('s3', 'region_name')
-
-    rekognition = boto3.client(
-                    'rekognition', 
-                    region_name=regionname,
-                    config = Config(
-                      retries = {
-                        'max_attempts': 3,
-                        'mode': 'standard'
-                      }
-                    )
-                  )
-
-    return rekognition
+    return current_context().rekognition()
   
   except Exception as err:
     logging.error("get_rekognition():")
@@ -576,29 +1431,67 @@ def get_rekognition():
     raise
 
 
+###################################################################
+#
+# get_detector
+#
+# return the label detector (Rekognition, local ONNX model or stub)
+# selected by the [labels] section of the app config file, along
+# with its MaxLabels / MinConfidence settings. Defaults to
+# Rekognition when the section is missing.
+#
+def get_detector():
+  """
+  Returns the label detector of the current context, creating
+  it on first use.
+
+  Parameters
+  ----------
+  N/A
+
+  Returns
+  -------
+  detectors.LabelDetector object
+  """
+
+  try:
+    return current_context().detector()
+
+  except Exception as err:
+    logging.error("get_detector():")
+    logging.error(str(err))
+    raise
+
+
 ###################################################################
 #
 # initialize
 #
-# Initializes local environment need to access AWS, based on
-# given configuration file and user profiles. Call this function
-# only once, and call before calling any other API functions.
+# Initializes the context needed to access AWS and the database,
+# based on given configuration file and user profiles. Call before
+# calling any other API functions. Calling it again (e.g. to switch
+# configuration files) builds a new context and swaps it in
+# atomically: requests already running finish with the old one.
 #
 # NOTE: does not check to make sure we can actually reach and
-# login to S3 and database server. Call get_ping() to check.
+# login to S3 and database server. Call get_ping() to check, or
+# pass warm=True to open the database connections up front.
 #
-def initialize(config_file, s3_profile, mysql_user):
+def initialize(config_file, s3_profile, mysql_user, warm=False, broadcast=False):
   """
-  Initializes local environment for AWS access, returning True
-  if successful and raising an exception if not. Call this 
-  function only once, and call before calling any other API
-  functions.
+  Initializes the context for AWS and database access, returning
+  True if successful and raising an exception if not. Call this
+  function before calling any other API functions.
   
   Parameters
   ----------
   config_file is the name of configuration file, probably 'photoapp-config.ini'
   s3_profile to use for accessing S3, probably 's3readwrite'
   mysql_user to use for accessing database, probably 'photoapp-read-write'
+  warm is True to pre-create pooled connections and clients before
+    the new context is used
+  broadcast is True to have the other worker processes sharing state
+    (see use_shared_state) switch to the same configuration
   
   Returns
   -------
@@ -606,40 +1499,30 @@ def initialize(config_file, s3_profile, mysql_user):
   """
 
   try:
-    #
-    # save name of config file for other API functions:
-    #
-    global PHOTOAPP_CONFIG_FILE
-    PHOTOAPP_CONFIG_FILE = config_file
+    global _context, PHOTOAPP_CONFIG_FILE
 
-    #
-    # configure boto for S3 access, make sure we can read necessary
-    # configuration info:
-    #
-    os.environ['AWS_SHARED_CREDENTIALS_FILE'] = config_file
+    ctx = context.AppContext(config_file, s3_profile, mysql_user)
+    if warm:
+      ctx.warm()
+      retries.preload()
+
+    with _context_lock:
+      old, _context = _context, ctx
+      PHOTOAPP_CONFIG_FILE = config_file
 
-    boto3.setup_default_session(profile_name=s3_profile)
+    if old is not None:
+      old.close()
+      #
+      # the new configuration may name another database or bucket:
+      # catalog ETags and the similarity index describe the old one:
+      #
+      bump_catalog_version()
+      reset_similar()
+      start_similarity_rebuild()
 
-    configur = ConfigParser()
-    configur.read(config_file)
-    bucketname = configur.get('s3', 'bucket_name')
-    regionname = configur.get('s3', 'region_name')
+    if broadcast and _shared_settings is not None:
+      _announce_settings(config_file, s3_profile, mysql_user)
 
-    #
-    # also check to make sure we can read database server config info:
-    #
-    endpoint = configur.get('rds', 'endpoint')
-    portnum = int(configur.get('rds', 'port_number'))
-    username = configur.get('rds', 'user_name')
-    pwd = configur.get('rds', 'user_pwd')
-    dbname = configur.get('rds', 'db_name')
-
-    if username == mysql_user:
-      # we have password, all is good:
-      pass
-    else:
-      raise ValueError("mysql_user does not match user_name in [rds] section of config file")
-    
     #
     # success:
     #
@@ -651,6 +1534,123 @@ def initialize(config_file, s3_profile, mysql_user):
     raise
 
 
+def _announce_settings(config_file, s3_profile, mysql_user):
+  global _context_generation
+  path, generation = _shared_settings
+  settings = {'config_file': os.path.abspath(config_file),
+              's3_profile': s3_profile, 'mysql_user': mysql_user}
+  with _follow_lock:
+    temp = f"{path}.{os.getpid()}"
+    with open(temp, 'w', encoding='utf-8') as f:
+      json.dump(settings, f)
+    os.replace(temp, path)
+    generation.bump()
+    current = generation.get()
+    with open(path, encoding='utf-8') as f:
+      #
+      # if another worker broadcast meanwhile, follow it instead:
+      #
+      if json.load(f) == settings:
+        _context_generation = current
+
+
+def context_outdated():
+  """
+  True if another worker process has re-initialized with broadcast
+  since this one built its context; a plain memory read.
+  """
+  return _shared_settings is not None and _shared_settings[1].get() != _context_generation
+
+
+def follow_initialize():
+  """
+  Re-initializes this process with the settings another worker
+  broadcast (see initialize), if any it hasn't followed yet. Returns
+  True if the context was replaced.
+  """
+  global _context_generation
+  if _shared_settings is None:
+    return False
+  path, generation = _shared_settings
+
+  with _follow_lock:
+    current = generation.get()
+    if current == _context_generation:
+      return False
+    #
+    # whatever happens, don't try this generation again on every
+    # request:
+    #
+    _context_generation = current
+    try:
+      with open(path, encoding='utf-8') as f:
+        settings = json.load(f)
+    except FileNotFoundError:
+      return False  # nothing was ever broadcast
+
+    try:
+      initialize(settings['config_file'], settings['s3_profile'], settings['mysql_user'], warm=True)
+    except Exception as err:
+      logging.error(f"follow_initialize(): keeping the current context: {err}")
+      return False
+
+    return True
+
+
+###################################################################
+#
+# current_context / use_context
+#
+def current_context():
+  """
+  Returns the AppContext in effect: the one pinned by use_context()
+  for the current request, if any, else the one installed by the
+  latest initialize().
+  """
+  ctx = _pinned_context.get() or _context
+  if ctx is None:
+    raise RuntimeError("photoapp is not initialized: call initialize() first")
+  return ctx
+
+
+@contextlib.contextmanager
+def use_context(ctx=None):
+  """
+  Pins ctx (default: the current context) for the duration of the
+  with block, so every call made for one request uses the same
+  context even if initialize() swaps in a new one meanwhile. The pin
+  follows contextvars, so it carries into worker threads started via
+  asyncio / anyio.
+  """
+  token = _pinned_context.set(ctx or _pinned_context.get() or _context)
+  try:
+    yield
+  finally:
+    _pinned_context.reset(token)
+
+
+def warm_up():
+  """
+  Pre-creates the current context's pooled database connections and
+  storage / label detector clients, and loads the SDKs they need.
+  Returns {'db_connections', 'seconds'}.
+  """
+  stats = current_context().warm()
+  retries.preload()
+  return stats
+
+
+def shutdown():
+  """
+  Releases the current context's pooled connections.
+  """
+  global _context
+  with _context_lock:
+    old, _context = _context, None
+  if old is not None:
+    old.close()
+
+
 ###################################################################
 #
 # get_ping
@@ -668,10 +1668,13 @@ def initialize(config_file, s3_profile, mysql_user):
 #
 def get_ping():
   """
-  Based on the configuration file, retrieves the # of items in the S3 bucket and
-  the # of users in the photoapp.users table. Both values are returned as a tuple
-  (M, N), where M or N are replaced by error messages if an error occurs or a
-  service is not accessible.
+  Based on the configuration file, retrieves the # of items in storage (the S3
+  bucket by default) and the # of users in the photoapp.users table. Both values
+  are returned as a tuple (M, N), where M or N are replaced by error messages if
+  an error occurs or a service is not accessible.
+
+  M is the object count recorded by the latest reconcile() if there is
+  one, so the bucket needn't be listed; otherwise storage is listed.
   
   Parameters
   ----------
@@ -690,24 +1693,29 @@ def get_ping():
       #
       # access S3 and obtain the # of items in the bucket:
       #
-      bucket = get_bucket()
+      store = get_storage()
+
+      try:
+        dbConn = get_dbConn()
+        try:
+          stats = reconciler.read_stats(dbConn, store.location)
+        finally:
+          dbConn.close()
+      except Exception as err:
+        logging.warning(f"get_ping.get_M(): no bucket stats ({err}), listing storage")
+        stats = None
 
-      assets = bucket.objects.all()
+      if stats is not None:
+        return stats['object_count']
 
-      M = len(list(assets))
+      M = store.count()
       return M
 
     except Exception as err:
       logging.error("get_ping.get_M():")
       logging.error(str(err))
       raise
-
-    finally:
-      try:
-        bucket.close()
-      except:
-        pass
-  @retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=2, max=30), reraise=True)
+  @retries.retry()
   def get_N():
     try:
       #
@@ -760,3 +1768,386 @@ def get_ping():
     N = str(err)
 
   return (M, N)
+
+
+###################################################################
+#
+# similar images
+#
+# An in-memory similarity.SimilarityIndex over the assets' perceptual
+# hashes answers "images like this one" without scanning the assets
+# table. It is loaded by rebuild_similarity_index() (in the background
+# on API startup) and kept current by post_image, complete_upload and
+# delete_images. Until it is loaded, queries fall back to SQL.
+#
+# With several worker processes (see use_shared_state) each worker
+# has its own index and can't see the others' uploads, so a worker
+# rebuilds its index when the shared catalog version has moved on,
+# at most once per SIMILAR_REFRESH seconds.
+#
+SIMILAR_REFRESH = 60
+SIMILAR_PAGE_SIZE = 10000
+
+_similar = similarity.SimilarityIndex()
+_similar_lock = threading.Lock()
+#
+# changes made while a rebuild runs, replayed onto the new index;
+# None when no rebuild is running:
+#
+_similar_changes = None
+
+
+def index_similar(assetid, phash):
+  """
+  Adds (or, if phash is None, removes) an asset in the similarity index.
+  """
+  with _similar_lock:
+    if phash is None:
+      _similar.remove(assetid)
+    else:
+      _similar.add(assetid, phash)
+    if _similar_changes is not None:
+      _similar_changes.append((assetid, phash))
+
+
+def clear_similar():
+  with _similar_lock:
+    _similar.clear()
+    if _similar_changes is not None:
+      _similar_changes.append((None, None))
+
+
+def reset_similar():
+  """
+  Replaces the similarity index with an empty one that isn't ready,
+  so similarity queries fall back to SQL until the next rebuild.
+  """
+  global _similar
+  with _similar_lock:
+    _similar = similarity.SimilarityIndex()
+    if _similar_changes is not None:
+      _similar_changes.append((None, None))
+
+
+def rebuild_similarity_index():
+  """
+  Loads every asset's perceptual hash into a new similarity index, a
+  page at a time, and swaps it in. Returns False if a rebuild was
+  already running.
+  """
+  global _similar, _similar_changes
+
+  with _similar_lock:
+    if _similar_changes is not None:
+      return False
+    _similar_changes = []
+
+  @retries.retry()
+  def load_page(after):
+    dbConn = get_dbConn()
+    try:
+      dbCursor = dbConn.cursor()
+      sql = """
+          SELECT assetid, phash FROM assets
+          WHERE assetid > %s AND phash IS NOT NULL
+          ORDER BY assetid ASC LIMIT %s;
+          """
+      dbCursor.execute(sql, (after, SIMILAR_PAGE_SIZE))
+      return dbCursor.fetchall()
+    finally:
+      dbConn.close()
+
+  try:
+    start = time.perf_counter()
+    version = get_catalog_version()
+    index = similarity.SimilarityIndex()
+
+    after = 0
+    while True:
+      rows = load_page(after)
+      index.add_many(rows)
+      if len(rows) < SIMILAR_PAGE_SIZE:
+        break
+      after = rows[-1][0]
+
+    with _similar_lock:
+      for assetid, phash in _similar_changes:
+        if assetid is None:
+          index.clear()
+        elif phash is None:
+          index.remove(assetid)
+        else:
+          index.add(assetid, phash)
+      index.ready = True
+      index.version = version
+      index.built_at = time.monotonic()
+      _similar = index
+
+    logging.info(f"rebuild_similarity_index(): {len(index)} assets in "
+                 f"{time.perf_counter() - start:.2f}s")
+    return True
+
+  except Exception as err:
+    logging.error("rebuild_similarity_index():")
+    logging.error(str(err))
+    raise
+
+  finally:
+    with _similar_lock:
+      _similar_changes = None
+
+
+def start_similarity_rebuild():
+  """
+  Runs rebuild_similarity_index() in a background thread.
+  """
+  def run():
+    try:
+      rebuild_similarity_index()
+    except Exception:
+      pass  # logged by rebuild_similarity_index; the old index stays
+
+  threading.Thread(target=run, name="similarity-rebuild", daemon=True).start()
+
+
+def _refresh_similar_if_stale():
+  index = _similar
+  if (index.ready and isinstance(_catalog, context.SharedCatalogVersion)
+      and index.version != get_catalog_version()
+      and time.monotonic() - index.built_at > SIMILAR_REFRESH):
+    index.built_at = time.monotonic()  # one refresh at a time
+    start_similarity_rebuild()
+
+
+@retries.retry(give_up_on=ValueError)
+def find_similar(assetid, max_distance=SIMILAR_DISTANCE, limit=SIMILAR_LIMIT):
+  """
+  Finds the images that look like image assetid: those whose
+  perceptual hash is within max_distance bits of its hash.
+
+  Parameters
+  ----------
+  assetid of the image to compare with
+  max_distance in bits, 0..64; beyond similarity.MAX_DISTANCE
+    searches approach a scan of every hash
+  limit is the max # of images returned
+
+  Returns
+  -------
+  list of rows (IMAGE_COLUMNS + distance), nearest first; empty if the
+  image has no perceptual hash. Raises ValueError if there is no such
+  assetid.
+  """
+
+  _refresh_similar_if_stale()
+  index = _similar
+
+  try:
+    dbConn = get_dbConn()
+    dbCursor = dbConn.cursor()
+
+    h = index.get(assetid) if index.ready else None
+    if h is None:
+      dbCursor.execute("SELECT phash FROM assets WHERE assetid = %s;", (assetid,))
+      row = dbCursor.fetchone()
+      if row is None:
+        raise ValueError("no such assetid")
+      h = row[0]
+      if h is None:
+        return []
+
+    columns = ", ".join(IMAGE_COLUMNS)
+
+    if not index.ready:
+      sql = f"""
+          SELECT {columns}, BIT_COUNT(phash ^ %s) AS distance
+          FROM assets
+          WHERE assetid <> %s AND BIT_COUNT(phash ^ %s) <= %s
+          ORDER BY distance ASC, assetid ASC
+          LIMIT %s;
+          """
+      dbCursor.execute(sql, (h, assetid, h, max_distance, limit))
+      return list(dbCursor.fetchall())
+
+    found = index.search(h, max_distance, exclude=assetid, limit=limit)
+    if not found:
+      return []
+
+    ids = [i for _, i in found]
+    sql = f"SELECT {columns} FROM assets WHERE assetid IN ({', '.join(['%s'] * len(ids))});"
+    dbCursor.execute(sql, ids)
+    rows = {row[0]: row for row in dbCursor.fetchall()}
+
+    # assets deleted behind the index's back are simply left out:
+    return [rows[i] + (distance,) for distance, i in found if i in rows]
+
+  except Exception as err:
+    logging.error("find_similar():")
+    logging.error(str(err))
+    raise
+
+  finally:
+    try:
+      dbCursor.close()
+    except:
+      pass
+    try:
+      dbConn.close()
+    except:
+      pass
+
+
+###################################################################
+#
+# reconcile
+#
+def reconcile(cleanup=False, grace=reconciler.GRACE, lock_path=None):
+  """
+  Compares storage with the assets table, reports orphan objects and
+  assets whose object is missing, and records the bucket's object
+  count and size for get_ping().
+
+  Parameters
+  ----------
+  cleanup is True to delete orphan objects and the assets (and labels)
+    whose object is missing
+  grace is the age in seconds below which objects and assets are
+    assumed to belong to uploads in progress, and left alone
+  lock_path is a lock file shared by the workers on this host; if
+    another process holds it, the call returns None immediately
+
+  Returns
+  -------
+  the report dict from reconciler.reconcile(), or None if skipped
+  """
+
+  try:
+    with contextlib.ExitStack() as stack:
+      if lock_path is not None and not stack.enter_context(reconciler.exclusive(lock_path)):
+        logging.info("reconcile(): already running in another process")
+        return None
+
+      store = get_storage()
+      dbConn = stack.enter_context(contextlib.closing(get_dbConn()))
+
+      report = reconciler.reconcile(store, dbConn, cleanup=cleanup, grace=grace)
+
+    if report['deleted_assets']:
+      bump_catalog_version()
+      start_similarity_rebuild()
+    return report
+
+  except Exception as err:
+    logging.error("reconcile():")
+    logging.error(str(err))
+    raise
+
+
+###################################################################
+#
+# main
+#
+# Command-line administration:
+#
+#   python photoapp.py migrate [--to VERSION]
+#   python photoapp.py explain
+#   python photoapp.py reconcile [--cleanup] [--grace SECONDS]
+#
+def main(argv=None):
+  import argparse
+
+  parser = argparse.ArgumentParser(prog="photoapp", description="PhotoApp administration")
+  parser.add_argument('--config', default='photoapp-config.ini')
+  parser.add_argument('--s3-profile', default='s3readwrite')
+  parser.add_argument('--mysql-user', default='photoapp-read-write')
+  parser.add_argument('--state-dir', default=os.environ.get('PHOTOAPP_STATE_DIR'),
+                      help="the API workers' state directory (see serve.py), so they see the "
+                           "changes made here (default: $PHOTOAPP_STATE_DIR)")
+  commands = parser.add_subparsers(dest='command', required=True)
+
+  migrate_cmd = commands.add_parser('migrate', help="apply pending database migrations")
+  migrate_cmd.add_argument('--to', type=int, default=None, help="stop after this version")
+  migrate_cmd.add_argument('--status', action='store_true', help="show the current version only")
+
+  commands.add_parser('explain', help="EXPLAIN the hot queries and flag full scans")
+
+  reconcile_cmd = commands.add_parser('reconcile', help="find (and delete) orphan objects and assets")
+  reconcile_cmd.add_argument('--cleanup', action='store_true', help="delete the orphans found")
+  reconcile_cmd.add_argument('--grace', type=int, default=reconciler.GRACE,
+                             help="ignore objects and assets younger than this (seconds)")
+
+  relabel_cmd = commands.add_parser('relabel', help="label the assets whose labels are pending")
+  relabel_cmd.add_argument('--limit', type=int, default=RELABEL_LIMIT, help="max # of assets to label")
+  relabel_cmd.add_argument('--failed', action='store_true', help="also retry assets whose labeling failed")
+
+  args = parser.parse_args(argv)
+
+  #
+  # commands that change the catalog bump its version; the API workers
+  # only see that (and drop their cached ETags and similarity index)
+  # through their shared state directory:
+  #
+  if args.state_dir:
+    use_shared_state(args.state_dir)
+
+  def lock_path(name):
+    if not args.state_dir:
+      print("note: no --state-dir, so running API workers won't notice these changes",
+            file=sys.stderr)
+      return None
+    return os.path.join(args.state_dir, name)
+
+  initialize(args.config, args.s3_profile, args.mysql_user)
+
+  if args.command == 'reconcile':
+    report = reconcile(cleanup=args.cleanup, grace=args.grace,
+                       lock_path=lock_path('reconcile.lock') if args.cleanup else None)
+    if report is None:
+      print("reconcile is already running in another process")
+      return 1
+    print(f"{report['location']}: {report['objects']} objects, {report['bytes']} bytes, "
+          f"{report['assets']} assets")
+    for kind in ('orphan_objects', 'missing_objects'):
+      print(f"{kind.replace('_', ' ')}: {report[kind]}")
+      for key in report['samples'][kind]:
+        print(f"  {key}")
+    print(f"deleted: {report['deleted_objects']} objects, {report['deleted_assets']} assets")
+    return 0
+
+  if args.command == 'relabel':
+    statuses = ('pending', 'failed') if args.failed else ('pending',)
+    report = relabel_pending(limit=args.limit, statuses=statuses, lock_path=lock_path('relabel.lock'))
+    if report is None:
+      print("relabel is already running in another process")
+      return 1
+    print(f"relabeled: {report['relabeled']}, failed: {report['failed']}"
+          + (" (stopped: label detection at capacity)" if report['overloaded'] else ""))
+    return 0
+
+  dbConn = get_dbConn()
+  try:
+    if args.command == 'migrate':
+      if args.status:
+        print(f"schema version {migrations.current_version(dbConn)} (latest {migrations.latest_version()})")
+        return 0
+      applied = migrations.migrate(dbConn, target=args.to)
+      if applied:
+        print(f"applied migrations: {', '.join(str(v) for v in applied)}")
+      else:
+        print("already up to date")
+      return 0
+
+    if args.command == 'explain':
+      flagged = migrations.check_query_plans(dbConn, HOT_QUERIES)
+      for name, table, access, keys in flagged:
+        print(f"FULL SCAN: {name}: table {table}, type {access}, possible keys {keys}")
+      if not flagged:
+        print("all hot queries use indexes")
+      return 1 if flagged else 0
+
+  finally:
+    dbConn.close()
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,381 @@
+#
+# Storage / database consistency reconciler.
+#
+# Every image is an object in storage plus a row in assets. A failure
+# between the two steps of an upload or a delete leaves one without the
+# other:
+#
+#   orphan object    an object no asset row refers to (e.g. a failed
+#                    delete_images(), or an upload whose insert failed
+#                    after the object was written)
+#   missing object   an asset row whose object is gone
+#
+# reconcile() finds both by walking the storage listing and the assets
+# table side by side, each in ascending key order one page at a time
+# (a streaming merge-join), so memory use is O(page) however large the
+# bucket. It records the object count and total bytes in bucket_stats,
+# which get_ping() reads instead of listing the bucket, and optionally
+# deletes the orphans.
+#
+# Objects and rows younger than the grace period are left alone: they
+# may belong to an upload that is still in progress. Cleanup waits
+# longer still before deleting an orphan object (UPLOAD_GRACE): the
+# object of a chunked upload is assembled before its asset row is
+# created, and the upload may take up to its TTL to finish.
+#
+# Run from the command line with:
+#
+#   python photoapp.py [--state-dir DIR] reconcile [--cleanup]
+#
+# or from the API every [reconcile] interval seconds (off by default;
+# cleanup there requires the workers' shared state directory, whose
+# lock file keeps the deletes to one process; the command line takes
+# the same lock when given the directory).
+#
+
+import contextlib
+import logging
+import os
+import time
+
+
+#
+# keys fetched per storage listing / assets query:
+#
+PAGE_SIZE = 1000
+
+#
+# seconds an object or asset row must have existed before it counts
+# as orphaned / missing:
+#
+GRACE = 3600
+
+#
+# seconds an orphan object must have existed before cleanup deletes
+# it; at least uploads.UPLOAD_TTL, the longest an assembled chunked
+# upload's object may wait for its asset row:
+#
+UPLOAD_GRACE = 24 * 60 * 60
+
+#
+# orphans of each kind listed by key in the report:
+#
+SAMPLE_SIZE = 20
+
+
+#
+# keyset pagination over the unique bucketkey index (the second page
+# on start after the last key of the previous one):
+#
+ASSETS_FIRST_PAGE_SQL = """
+    SELECT assetid, bucketkey, created_at FROM assets
+    ORDER BY bucketkey ASC LIMIT %s;
+    """
+ASSETS_PAGE_SQL = """
+    SELECT assetid, bucketkey, created_at FROM assets
+    WHERE bucketkey > %s ORDER BY bucketkey ASC LIMIT %s;
+    """
+
+
+def iter_assets(dbConn, page_size=PAGE_SIZE):
+    """
+    Yields (assetid, bucketkey, created_at) for every asset in bucketkey
+    order, fetching page_size rows per query (keyset pagination on the
+    unique bucketkey index).
+    """
+    dbCursor = dbConn.cursor()
+    try:
+        after = None
+        while True:
+            if after is None:
+                dbCursor.execute(ASSETS_FIRST_PAGE_SQL, (page_size,))
+            else:
+                dbCursor.execute(ASSETS_PAGE_SQL, (after, page_size))
+            rows = dbCursor.fetchall()
+            yield from rows
+            if len(rows) < page_size:
+                return
+            after = rows[-1][1]
+    finally:
+        dbCursor.close()
+
+
+def _ascending(items, key, what):
+    """
+    Passes items through, checking they are in strictly ascending key
+    order; the merge-join is only correct if both sides agree on it.
+    """
+    previous = None
+    for item in items:
+        k = key(item)
+        if previous is not None and not previous < k:
+            raise RuntimeError(f"{what} not in ascending binary key order at {k!r} "
+                               f"(after {previous!r}); is the database migrated?")
+        previous = k
+        yield item
+
+
+def merge(objects, assets):
+    """
+    Merge-joins (key, size) objects with (assetid, bucketkey, created_at)
+    rows, both in ascending key order. Yields (key, size, row) with size
+    None for a row without an object and row None for an object without
+    a row.
+    """
+    objects = iter(objects)
+    assets = iter(assets)
+    obj = next(objects, None)
+    row = next(assets, None)
+
+    while obj is not None or row is not None:
+        if row is None or (obj is not None and obj[0] < row[1]):
+            yield obj[0], obj[1], None
+            obj = next(objects, None)
+        elif obj is None or row[1] < obj[0]:
+            yield row[1], None, row
+            row = next(assets, None)
+        else:
+            yield obj[0], obj[1], row
+            obj = next(objects, None)
+            row = next(assets, None)
+
+
+###################################################################
+#
+# reconcile
+#
+def reconcile(store, dbConn, cleanup=False, grace=GRACE, page_size=PAGE_SIZE,
+              upload_grace=UPLOAD_GRACE):
+    """
+    Compares storage with the assets table and records bucket_stats.
+
+    Parameters
+    ----------
+    store is the storage.Storage holding the images
+    dbConn is an open connection to the photoapp database
+    cleanup is True to delete orphan objects and the asset rows (and
+      labels) of missing objects
+    grace is the age in seconds below which objects / rows are ignored
+    page_size is the # of keys fetched per listing / query
+    upload_grace is the age in seconds below which orphan objects are
+      reported but not deleted
+
+    Returns
+    -------
+    a report dict: objects, bytes and assets (after cleanup), the #
+    of orphan_objects and missing_objects found, the # deleted of each,
+    and up to SAMPLE_SIZE keys of each kind under 'samples'
+    """
+    report = {
+        'location': store.location,
+        'objects': 0,
+        'bytes': 0,
+        'assets': 0,
+        'orphan_objects': 0,
+        'missing_objects': 0,
+        'deleted_objects': 0,
+        'deleted_assets': 0,
+        'samples': {'orphan_objects': [], 'missing_objects': []},
+    }
+
+    dbCursor = dbConn.cursor()
+    dbCursor.execute("SELECT NOW() - INTERVAL %s SECOND;", (grace,))
+    row_cutoff = dbCursor.fetchone()[0]
+    dbCursor.close()
+    object_cutoff = time.time() - grace
+    delete_cutoff = time.time() - max(grace, upload_grace)
+
+    orphans = []   # (key, size)
+    missing = []   # (assetid, bucketkey)
+
+    def flush_orphans():
+        found = []
+        expired = []
+        for key, size in orphans:
+            try:
+                modified = store.head(key)['modified']
+            except KeyError:
+                continue  # already gone
+            if modified <= object_cutoff:
+                found.append((key, size))
+            if modified <= delete_cutoff:
+                expired.append((key, size))
+        orphans.clear()
+        _note(report, 'orphan_objects', [key for key, _ in found])
+        if cleanup and expired:
+            deleted = _delete_orphan_objects(store, dbConn, expired)
+            report['deleted_objects'] += len(deleted)
+            report['objects'] -= len(deleted)
+            report['bytes'] -= sum(size for _, size in deleted)
+
+    def flush_missing():
+        found = list(missing)
+        missing.clear()
+        _note(report, 'missing_objects', [key for _, key in found])
+        if cleanup and found:
+            deleted = _delete_missing_assets(store, dbConn, found)
+            report['deleted_assets'] += deleted
+            report['assets'] -= deleted
+
+    objects = _ascending(store.iter_objects(page_size), lambda o: o[0], "storage listing")
+    assets = _ascending(iter_assets(dbConn, page_size), lambda r: r[1], "assets")
+
+    for key, size, row in merge(objects, assets):
+        if size is not None:
+            report['objects'] += 1
+            report['bytes'] += size
+        if row is not None:
+            report['assets'] += 1
+
+        if row is None:
+            orphans.append((key, size))
+            if len(orphans) >= page_size:
+                flush_orphans()
+        elif size is None and row[2] <= row_cutoff:
+            missing.append((row[0], key))
+            if len(missing) >= page_size:
+                flush_missing()
+
+    flush_orphans()
+    flush_missing()
+
+    write_stats(dbConn, report)
+
+    logging.info(f"reconcile: {report['objects']} objects, {report['bytes']} bytes, "
+                 f"{report['assets']} assets, {report['orphan_objects']} orphan objects, "
+                 f"{report['missing_objects']} missing objects")
+    return report
+
+
+def _note(report, kind, keys):
+    report[kind] += len(keys)
+    samples = report['samples'][kind]
+    samples.extend(keys[:SAMPLE_SIZE - len(samples)])
+
+
+def _delete_orphan_objects(store, dbConn, orphans):
+    """
+    Deletes the orphan (key, size) objects that still have no asset row;
+    returns the ones deleted.
+    """
+    keys = [key for key, _ in orphans]
+    #
+    # end the transaction the scan runs in, so the check sees asset
+    # rows committed since its snapshot was taken:
+    #
+    dbConn.commit()
+    dbCursor = dbConn.cursor()
+    try:
+        placeholders = ", ".join(["%s"] * len(keys))
+        dbCursor.execute(f"SELECT bucketkey FROM assets WHERE bucketkey IN ({placeholders});", keys)
+        claimed = {row[0] for row in dbCursor.fetchall()}
+    finally:
+        dbCursor.close()
+
+    orphans = [(key, size) for key, size in orphans if key not in claimed]
+    failed = set(store.delete_many([key for key, _ in orphans]))
+    if failed:
+        logging.warning(f"reconcile: {len(failed)} orphan objects could not be deleted")
+    return [(key, size) for key, size in orphans if key not in failed]
+
+
+def _delete_missing_assets(store, dbConn, missing):
+    """
+    Deletes the (assetid, bucketkey) asset rows, and their labels, whose
+    object is still missing; returns the # deleted.
+    """
+    assetids = []
+    for assetid, key in missing:
+        try:
+            store.head(key)
+        except KeyError:
+            assetids.append(assetid)
+    if not assetids:
+        return 0
+
+    dbCursor = dbConn.cursor()
+    try:
+        placeholders = ", ".join(["%s"] * len(assetids))
+        dbConn.begin()
+        dbCursor.execute(f"DELETE FROM assetlabels WHERE assetid IN ({placeholders});", assetids)
+        dbCursor.execute(f"DELETE FROM assets WHERE assetid IN ({placeholders});", assetids)
+        deleted = dbCursor.rowcount
+        dbConn.commit()
+        return deleted
+    except Exception:
+        dbConn.rollback()
+        raise
+    finally:
+        dbCursor.close()
+
+
+###################################################################
+#
+# bucket_stats
+#
+def write_stats(dbConn, report):
+    dbCursor = dbConn.cursor()
+    try:
+        sql = """
+            INSERT INTO bucket_stats
+              (location, object_count, total_bytes, asset_count, orphan_objects, missing_objects)
+            VALUES (%s, %s, %s, %s, %s, %s)
+            ON DUPLICATE KEY UPDATE
+              object_count = VALUES(object_count), total_bytes = VALUES(total_bytes),
+              asset_count = VALUES(asset_count), orphan_objects = VALUES(orphan_objects),
+              missing_objects = VALUES(missing_objects), reconciled_at = CURRENT_TIMESTAMP;
+            """
+        dbCursor.execute(sql, (
+            report['location'], report['objects'], report['bytes'], report['assets'],
+            report['orphan_objects'] - report['deleted_objects'],
+            report['missing_objects'] - report['deleted_assets'],
+        ))
+        dbConn.commit()
+    finally:
+        dbCursor.close()
+
+
+def read_stats(dbConn, location):
+    """
+    Returns the bucket_stats row for location as a dict, or None if the
+    location has not been reconciled yet.
+    """
+    dbCursor = dbConn.cursor()
+    try:
+        sql = """
+            SELECT object_count, total_bytes, asset_count, orphan_objects, missing_objects, reconciled_at
+            FROM bucket_stats WHERE location = %s;
+            """
+        dbCursor.execute(sql, (location,))
+        row = dbCursor.fetchone()
+    finally:
+        dbCursor.close()
+    if row is None:
+        return None
+    columns = ('object_count', 'total_bytes', 'asset_count', 'orphan_objects',
+               'missing_objects', 'reconciled_at')
+    return dict(zip(columns, row))
+
+
+@contextlib.contextmanager
+def exclusive(path):
+    """
+    Non-blocking exclusive lock on the file at path, so only one worker
+    process on the host reconciles at a time. Yields True if the lock
+    was taken, False if another process holds it.
+    """
+    import fcntl
+
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+    finally:
+        os.close(fd)
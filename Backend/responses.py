@@ -0,0 +1,275 @@
+#
+# Fast JSON responses for the PhotoApp list endpoints.
+#
+# The list endpoints return photoapp row tuples. Rather than building
+# dicts for FastAPI's jsonable_encoder to walk, rows_response() encodes
+# the rows itself (with orjson when it is installed; see dumps_rows),
+# optionally in a columnar layout:
+#
+#   rows:      {"users": [{"userid": 1, "username": "a"}, ...]}
+#   columnar:  {"users": {"userid": [1, ...], "username": ["a", ...]}}
+#
+# and compresses the body with brotli or gzip when the client's
+# Accept-Encoding allows it.
+#
+
+import datetime
+import decimal
+import gzip
+import hashlib
+import itertools
+import json
+
+from fastapi.responses import Response
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+#
+# bodies smaller than this are sent uncompressed; compressing them
+# costs more CPU than the bytes saved:
+#
+MIN_COMPRESS_SIZE = 1024
+
+GZIP_LEVEL = 5
+BROTLI_QUALITY = 4
+
+FORMATS = ("rows", "columnar")
+
+
+def _default(obj):
+    if isinstance(obj, (datetime.date, datetime.datetime)):
+        return obj.isoformat()
+    if isinstance(obj, decimal.Decimal):
+        return float(obj)
+    raise TypeError(f"{type(obj).__name__} is not JSON serializable")
+
+
+def dumps(obj):
+    """
+    Serializes obj to compact JSON bytes.
+    """
+    if orjson is not None:
+        return orjson.dumps(obj, default=_default)
+    return json.dumps(obj, separators=(",", ":"), ensure_ascii=False, default=_default).encode("utf-8")
+
+
+#
+# rows turned into objects per orjson call; the dicts of one chunk are
+# all that is held at a time:
+#
+ROWS_CHUNK = 1024
+
+#
+# value types serialized as bare JSON numbers / literals:
+#
+_SCALARS = {int, float, bool, type(None)}
+
+
+def dumps_rows(columns, rows):
+    """
+    Serializes the rows (sequences of values, in columns order) to a
+    JSON array of objects, as bytes.
+
+    With orjson, each chunk of rows is turned into dicts by C-level
+    map / zip and serialized in one call; splicing the keys into
+    orjson's output for the tuples takes more Python-level work per
+    row than the dicts do. Without it, json encodes the tuples column
+    by column (_dumps_rows_by_column), far faster than json walking
+    a dict per row.
+    """
+    if not rows:
+        return b"[]"
+    if orjson is None:
+        return _dumps_rows_by_column(columns, rows)
+
+    chunks = []
+    for start in range(0, len(rows), ROWS_CHUNK):
+        chunk = rows[start:start + ROWS_CHUNK]
+        objects = list(map(dict, map(zip, itertools.repeat(columns), chunk)))
+        chunks.append(orjson.dumps(objects, default=_default)[1:-1])
+    return b"[" + b",".join(chunks) + b"]"
+
+
+def _dumps_rows_by_column(columns, rows):
+    """
+    dumps_rows() for the json module: each column's values are encoded
+    in one json call and split back into cells (numbers at ',', strings
+    at '","', which can't occur inside an encoded string), then the
+    cells are interleaved with the constant '"key":' pieces and joined.
+    """
+    n, k = len(rows), len(columns)
+    width = 2 * k
+    pieces = [None] * (n * width)
+    quotes = []
+
+    for j, values in enumerate(zip(*rows)):
+        kinds = set(map(type, values))
+        if kinds <= _SCALARS:
+            pieces[2 * j + 1::width] = dumps(values)[1:-1].split(b",")
+            quotes.append(b"")
+        elif kinds == {str}:
+            pieces[2 * j + 1::width] = dumps(values)[2:-2].split(b'","')
+            quotes.append(b'"')
+        else:
+            pieces[2 * j + 1::width] = list(map(dumps, values))
+            quotes.append(b"")
+
+    keys = [dumps(column) + b":" for column in columns]
+    close = quotes[-1] + b"}"
+    pieces[0::width] = [close + b",{" + keys[0] + quotes[0]] * n
+    for j in range(1, k):
+        pieces[2 * j::width] = [quotes[j - 1] + b"," + keys[j] + quotes[j]] * n
+    pieces[0] = b"{" + keys[0] + quotes[0]
+
+    return b"[" + b"".join(pieces) + close + b"]"
+
+
+def encode_rows(columns, rows, format="rows"):
+    """
+    Returns the rows (sequences of values, in columns order) as a list
+    of objects, or as a dict of parallel arrays if format is "columnar".
+    """
+    if format == "columnar":
+        if not rows:
+            return {column: [] for column in columns}
+        return {column: list(values) for column, values in zip(columns, zip(*rows))}
+    return [dict(zip(columns, row)) for row in rows]
+
+
+def _accepts(accept_encoding, coding):
+    """
+    True if the Accept-Encoding value accepts coding: it is listed, or
+    "*" (any coding not listed) is, with a non-zero q-value.
+    """
+    qvalues = {}
+    for part in accept_encoding.split(","):
+        name, _, params = part.strip().partition(";")
+        q = 1.0
+        for param in params.split(";"):
+            key, _, value = param.strip().partition("=")
+            if key.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        qvalues[name.strip().lower()] = q
+    q = qvalues.get(coding, qvalues.get("*", 0.0))
+    return q > 0
+
+
+def compress(body, accept_encoding):
+    """
+    Returns (body, content_encoding) compressed with the best coding
+    the client accepts, or (body, None) if none applies.
+    """
+    if len(body) < MIN_COMPRESS_SIZE or not accept_encoding:
+        return body, None
+    if brotli is not None and _accepts(accept_encoding, "br"):
+        return brotli.compress(body, quality=BROTLI_QUALITY), "br"
+    if _accepts(accept_encoding, "gzip"):
+        return gzip.compress(body, compresslevel=GZIP_LEVEL), "gzip"
+    return body, None
+
+
+def json_response(request, payload, headers=None):
+    """
+    Returns a Response with payload encoded as JSON, compressed
+    according to the request's Accept-Encoding.
+    """
+    return _response(request, dumps(payload), headers)
+
+
+def _response(request, body, headers):
+    body, encoding = compress(body, request.headers.get("accept-encoding", ""))
+    headers = dict(headers or {})
+    headers["Vary"] = "Accept-Encoding"
+    if encoding is not None:
+        headers["Content-Encoding"] = encoding
+    return Response(content=body, media_type="application/json", headers=headers)
+
+
+def rows_response(request, key, columns, rows, format=None, extra=None, headers=None):
+    """
+    Returns a JSON Response {**extra, key: rows} with the rows encoded
+    by dumps_rows, or by encode_rows in the columnar format.
+
+    Parameters
+    ----------
+    request is the incoming starlette Request
+    key is the name of the list in the response, e.g. "users"
+    columns are the names of the row values, in order
+    rows is a list of row tuples as returned by photoapp
+    format is "rows" (default) or "columnar"
+    extra is an optional dict of other top-level fields
+    headers is an optional dict of extra response headers
+    """
+    format = format or "rows"
+    if format not in FORMATS:
+        raise ValueError(f"format must be one of {', '.join(FORMATS)}")
+
+    payload = dict(extra or {})
+    if format == "columnar":
+        payload[key] = encode_rows(columns, rows, format)
+        payload["format"] = "columnar"
+        return json_response(request, payload, headers)
+
+    # splice the rows into the other fields' JSON object:
+    payload.pop(key, None)
+    head = dumps(payload)[:-1]
+    body = head + (b"," if payload else b"") + dumps(key) + b":" + dumps_rows(columns, rows) + b"}"
+    return _response(request, body, headers)
+
+
+###################################################################
+#
+# ETags
+#
+# Metadata responses carry a weak ETag built from a version string
+# (photoapp's catalog version) and the request path + query, so a
+# client revalidating with If-None-Match gets a 304 until the
+# version changes.
+#
+CACHE_CONTROL = "no-cache"
+
+
+def etag(request, version):
+    """
+    Returns the weak ETag for this request's URL at the given version.
+    """
+    url = f"{request.url.path}?{request.url.query}"
+    digest = hashlib.sha1(url.encode("utf-8")).hexdigest()[:16]
+    return f'W/"{version}-{digest}"'
+
+
+def cache_headers(tag):
+    return {"ETag": tag, "Cache-Control": CACHE_CONTROL}
+
+
+def not_modified(request, tag):
+    """
+    Returns a 304 Response if the request's If-None-Match matches tag
+    (weak comparison), else None.
+    """
+    header = request.headers.get("if-none-match")
+    if not header:
+        return None
+    opaque = tag[2:] if tag.startswith("W/") else tag
+    for candidate in header.split(","):
+        candidate = candidate.strip()
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate == "*" or candidate == opaque:
+            # the same validators / Vary as the 200 it stands for:
+            headers = cache_headers(tag)
+            headers["Vary"] = "Accept-Encoding"
+            return Response(status_code=304, headers=headers)
+    return None
@@ -0,0 +1,43 @@
+#
+# Retry decorator for the photoapp API functions.
+#
+# Same policy as decorating with tenacity directly (3 attempts,
+# exponential backoff between 2 and 30 seconds, re-raising the last
+# error), but tenacity is imported on the first call rather than at
+# module load, so importing photoapp stays cheap.
+#
+
+import functools
+
+
+def retry(attempts=3, min_wait=2, max_wait=30, give_up_on=()):
+    """
+    Decorator retrying the function on any exception except instances
+    of give_up_on (an exception type or tuple of types), which are
+    raised immediately.
+    """
+    def decorate(fn):
+        retrying = None
+
+        @functools.wraps(fn)
+        def call(*args, **kwargs):
+            nonlocal retrying
+            if retrying is None:
+                import tenacity
+
+                retrying = tenacity.retry(
+                    stop=tenacity.stop_after_attempt(attempts),
+                    wait=tenacity.wait_exponential(multiplier=1, min=min_wait, max=max_wait),
+                    retry=tenacity.retry_if_not_exception_type(give_up_on),
+                    reraise=True
+                )(fn)
+            return retrying(*args, **kwargs)
+
+        return call
+
+    return decorate
+
+
+def preload():
+    """Imports tenacity now, so the first retried call doesn't pay for it."""
+    import tenacity  # noqa: F401
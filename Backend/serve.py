@@ -0,0 +1,80 @@
+#
+# Multi-worker launcher for the PhotoApp API.
+#
+# Runs api:app in several worker processes. Each worker builds its own
+# photoapp context on startup and, with --prewarm (the default), opens
+# its pooled database connections and clients before serving, so the
+# first requests don't pay for them. The workers share the catalog
+# version (and so ETags) and chunked upload state, and optionally the
+# rate limits, through files in a state directory. Pass the same
+# directory to photoapp.py (--state-dir) so that changes made by its
+# admin commands (relabel, reconcile --cleanup) reach the workers.
+#
+# Uses gunicorn with uvicorn workers when gunicorn is installed, else
+# uvicorn's own process manager.
+#
+#   python serve.py [--workers N] [--host H] [--port P] [--no-prewarm]
+#                   [--config F] [--s3-profile P] [--mysql-user U]
+#
+# NOTE: the /events stream is per worker: run a single worker, or
+# route by client, when using it.
+#
+
+import argparse
+import os
+import sys
+import tempfile
+
+
+def parse_args(argv):
+  parser = argparse.ArgumentParser(prog="serve.py")
+  parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+  parser.add_argument("--host", default="127.0.0.1")
+  parser.add_argument("--port", type=int, default=8000)
+  parser.add_argument("--no-prewarm", dest="prewarm", action="store_false")
+  parser.add_argument("--config", default="photoapp-config.ini")
+  parser.add_argument("--s3-profile", default="s3readwrite")
+  parser.add_argument("--mysql-user", default="photoapp-read-write")
+  parser.add_argument("--state-dir", default=None,
+                      help="directory for state shared by the workers (default: a new temp dir)")
+  return parser.parse_args(argv)
+
+
+def main(argv):
+  args = parse_args(argv)
+
+  #
+  # the workers read their configuration from the environment
+  # (see api.lifespan):
+  #
+  os.environ["PHOTOAPP_CONFIG"] = os.path.abspath(args.config)
+  os.environ["PHOTOAPP_S3_PROFILE"] = args.s3_profile
+  os.environ["PHOTOAPP_MYSQL_USER"] = args.mysql_user
+  os.environ["PHOTOAPP_PREWARM"] = "1" if args.prewarm else "0"
+  os.environ["PHOTOAPP_STATE_DIR"] = args.state_dir or tempfile.mkdtemp(prefix="photoapp-")
+  # photoapp.py's admin commands need it to reach the workers:
+  print(f"serve.py: state directory {os.environ['PHOTOAPP_STATE_DIR']}", file=sys.stderr)
+
+  try:
+    from gunicorn.app.wsgiapp import run
+  except ImportError:
+    run = None
+
+  if run is not None:
+    sys.argv = [
+      "gunicorn", "api:app",
+      "--worker-class", "uvicorn.workers.UvicornWorker",
+      "--workers", str(args.workers),
+      "--bind", f"{args.host}:{args.port}",
+      "--graceful-timeout", "30",
+    ]
+    return run()
+
+  import uvicorn
+
+  uvicorn.run("api:app", host=args.host, port=args.port, workers=args.workers)
+  return 0
+
+
+if __name__ == "__main__":
+  sys.exit(main(sys.argv[1:]))
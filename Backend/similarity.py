@@ -0,0 +1,184 @@
+#
+# In-memory near-duplicate index over 64-bit perceptual hashes.
+#
+# SimilarityIndex finds every hash within Hamming distance d of a
+# query using multi-index hashing: each hash is split into 4 bands of
+# 16 bits, and each band value maps to the hashes having it. Write
+# d = 4r + a with a < 4. If two hashes differ in at most d bits, then
+# by the pigeonhole principle one of bands 0..a differs in at most r
+# bits or one of the other bands in at most r - 1, so only the band
+# values that close to the query's bands need probing (1 + 16 values
+# for radius 1, 137 for radius 2) and only the hashes found there
+# comparing. With a million assets a search for d = 4 checks a few
+# hundred hashes instead of all of them.
+#
+# photoapp keeps one index per process, rebuilt from the database on
+# startup and updated as images are uploaded and deleted.
+#
+
+import heapq
+import itertools
+import threading
+
+
+BANDS = 4
+BAND_BITS = 16
+BAND_MASK = (1 << BAND_BITS) - 1
+
+#
+# band values probed per band with radius k is C(16, <=k); beyond
+# this radius a linear scan of all hashes is cheaper:
+#
+MAX_BAND_RADIUS = 4
+
+#
+# widest search the bands serve well (radius MAX_BAND_RADIUS in
+# every band); callers taking a distance from clients cap it here,
+# since wider ones degrade towards a scan of every hash:
+#
+MAX_DISTANCE = BANDS * MAX_BAND_RADIUS
+
+
+def _popcount(x):
+    return bin(x).count("1")
+
+
+popcount = getattr(int, "bit_count", _popcount)
+
+
+def _masks(radius):
+    """All BAND_BITS-bit values with at most radius bits set."""
+    masks = []
+    for k in range(radius + 1):
+        for bits in itertools.combinations(range(BAND_BITS), k):
+            masks.append(sum(1 << b for b in bits))
+    return masks
+
+
+_MASKS = [_masks(k) for k in range(MAX_BAND_RADIUS + 1)]
+
+
+def bands(h):
+    return [(h >> (BAND_BITS * i)) & BAND_MASK for i in range(BANDS)]
+
+
+def radii(max_distance):
+    """
+    The probe radius of each band for a search within max_distance
+    bits (-1: the band needn't be probed).
+    """
+    r, a = divmod(max_distance, BANDS)
+    return [r if i <= a else r - 1 for i in range(BANDS)]
+
+
+class SimilarityIndex:
+    """
+    Perceptual hashes by assetid, searchable by Hamming distance.
+    Safe to use from several threads.
+    """
+
+    def __init__(self):
+        self._hashes = {}
+        #
+        # per band, band value -> ([hash], [assetid]); the hashes are
+        # kept alongside the ids so candidates are checked without
+        # another lookup:
+        #
+        self._bands = [{} for _ in range(BANDS)]
+        self._lock = threading.Lock()
+        #
+        # True once the index holds every asset (see photoapp's
+        # rebuild_similarity_index):
+        #
+        self.ready = False
+        #
+        # catalog version and time.monotonic() when it was built:
+        #
+        self.version = None
+        self.built_at = 0.0
+
+    def __len__(self):
+        return len(self._hashes)
+
+    def get(self, assetid):
+        """The hash of assetid, or None if it isn't indexed."""
+        return self._hashes.get(assetid)
+
+    def add(self, assetid, h):
+        with self._lock:
+            self._remove(assetid)
+            self._hashes[assetid] = h
+            for table, band in zip(self._bands, bands(h)):
+                entry = table.get(band)
+                if entry is None:
+                    entry = table[band] = ([], [])
+                entry[0].append(h)
+                entry[1].append(assetid)
+
+    def add_many(self, items):
+        """Adds (assetid, hash) pairs."""
+        for assetid, h in items:
+            self.add(assetid, h)
+
+    def remove(self, assetid):
+        with self._lock:
+            self._remove(assetid)
+
+    def _remove(self, assetid):
+        h = self._hashes.pop(assetid, None)
+        if h is None:
+            return
+        for table, band in zip(self._bands, bands(h)):
+            hashes, ids = table[band]
+            i = ids.index(assetid)
+            del hashes[i], ids[i]
+            if not ids:
+                del table[band]
+
+    def clear(self):
+        with self._lock:
+            self._hashes = {}
+            self._bands = [{} for _ in range(BANDS)]
+
+    def search(self, h, max_distance, exclude=None, limit=None):
+        """
+        Returns [(distance, assetid)] for every indexed hash within
+        max_distance bits of h, nearest first (then by assetid),
+        leaving out assetid exclude; only the limit nearest if limit
+        is given.
+        """
+        found = {}
+        radius = radii(max_distance)
+        scan = None
+
+        with self._lock:
+            if radius[0] > MAX_BAND_RADIUS or len(self._hashes) <= BANDS * len(_MASKS[radius[0]]):
+                #
+                # compared outside the lock, so a wide search doesn't
+                # hold up uploads:
+                #
+                scan = list(self._hashes.items())
+            else:
+                for table, band, r in zip(self._bands, bands(h), radius):
+                    if r < 0:
+                        continue
+                    for mask in _MASKS[r]:
+                        entry = table.get(band ^ mask)
+                        if entry is None:
+                            continue
+                        for other, assetid in zip(*entry):
+                            distance = popcount(other ^ h)
+                            if distance <= max_distance:
+                                found[assetid] = distance
+
+        if scan is not None:
+            for assetid, other in scan:
+                distance = popcount(other ^ h)
+                if distance <= max_distance:
+                    found[assetid] = distance
+
+        found.pop(exclude, None)
+        pairs = ((distance, assetid) for assetid, distance in found.items())
+        if limit is not None:
+            return heapq.nsmallest(limit, pairs)
+        return sorted(pairs)
@@ -0,0 +1,686 @@
+#
+# Storage backends for PhotoApp image objects.
+#
+# photoapp.py talks to object storage only through the small interface
+# defined by Storage below, so the same API functions can run against
+# S3 (production), a local directory (on-prem / edge deployments) or
+# process memory (tests and benchmarks). The backend is selected by the
+# [storage] section of the app config file:
+#
+#   [storage]
+#   backend = s3          # s3 (default), local or memory
+#   root = ./photoapp-data  # local backend only
+#
+
+import hashlib
+import logging
+import mmap
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+
+#
+# objects are copied in chunks of this size when streaming:
+#
+CHUNK_SIZE = 1024 * 1024
+
+#
+# S3 DeleteObjects accepts at most this many keys per call:
+#
+DELETE_BATCH_SIZE = 1000
+
+
+class NoSuchKey(KeyError):
+    """Raised when the requested object does not exist in storage."""
+
+
+class DigestReader:
+    """
+    Wraps a readable binary file object, computing the SHA-256 and
+    byte count of everything read through it, so an upload can be
+    hashed while it streams to storage. The first keep bytes read are
+    kept in head (e.g. for metadata.extract).
+    """
+
+    def __init__(self, fileobj, keep=0):
+        self.fileobj = fileobj
+        self.size = 0
+        self.keep = keep
+        self.head = bytearray()
+        self._sha256 = hashlib.sha256()
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self._sha256.update(data)
+        if len(self.head) < self.keep:
+            self.head += data[:self.keep - len(self.head)]
+        self.size += len(data)
+        return data
+
+    def hexdigest(self):
+        return self._sha256.hexdigest()
+
+
+class FileChain:
+    """
+    Readable binary file object over the concatenation of several
+    files, opened one at a time.
+    """
+
+    def __init__(self, filenames):
+        self.filenames = list(filenames)
+        self.current = None
+
+    def read(self, size=-1):
+        while True:
+            if self.current is None:
+                if not self.filenames:
+                    return b""
+                self.current = open(self.filenames.pop(0), "rb")
+            data = self.current.read(size)
+            if data:
+                return data
+            self.current.close()
+            self.current = None
+
+
+###################################################################
+#
+# Storage
+#
+# Base class / interface implemented by every backend. Keys are
+# strings of the form "username/uuid-filename"; listings are always
+# returned in ascending key order (the order S3 uses).
+#
+class Storage:
+    """
+    Interface for PhotoApp object storage.
+
+    Subclasses implement put_stream, get_stream, get_range, head,
+    delete_many and list_page; the remaining methods are built on
+    top of those.
+    """
+
+    name = "storage"
+
+    #
+    # identifies the bucket / directory this instance stores into,
+    # e.g. for recording statistics about it (see reconcile.py):
+    #
+    location = None
+
+    def put_stream(self, key, fileobj, callback=None):
+        """
+        Stores the contents of the readable binary file object under
+        key, replacing any existing object. If callback is given it
+        is called with the number of bytes sent after each chunk.
+        """
+        raise NotImplementedError
+
+    def get_stream(self, key):
+        """
+        Returns a readable binary file object for the object stored
+        under key; the caller must close() it. Raises NoSuchKey if
+        the object does not exist.
+        """
+        raise NotImplementedError
+
+    def get_range(self, key, start, end):
+        """
+        Returns bytes start..end (inclusive, as in an HTTP Range
+        header) of the object stored under key.
+        """
+        raise NotImplementedError
+
+    def head(self, key):
+        """
+        Returns a dict {'key': key, 'size': N, 'modified': T} describing
+        the object, T being its last-modified time in seconds since the
+        epoch, or raises NoSuchKey if it does not exist.
+        """
+        raise NotImplementedError
+
+    def delete_many(self, keys):
+        """
+        Deletes the given keys; keys that do not exist are ignored.
+        Returns the list of keys that could not be deleted.
+        """
+        raise NotImplementedError
+
+    def list_page(self, start_after=None, max_keys=1000):
+        """
+        Returns (objects, next_start_after) where objects is a list of
+        up to max_keys (key, size) tuples with key > start_after, in
+        ascending key order. next_start_after is None on the last page.
+        """
+        raise NotImplementedError
+
+    #
+    # multipart uploads: an object assembled from separately uploaded
+    # parts, numbered from 1. Uploading a part number again replaces
+    # that part, so a failed part can simply be retried.
+    #
+    def create_multipart(self, key):
+        """
+        Starts a multipart upload for key and returns its upload id.
+        """
+        raise NotImplementedError
+
+    def upload_part(self, key, upload_id, part_number, data):
+        """
+        Stores bytes data as part part_number and returns its ETag.
+        """
+        raise NotImplementedError
+
+    def complete_multipart(self, key, upload_id, parts):
+        """
+        Assembles the object from parts, a list of (part_number, etag)
+        tuples in ascending part order.
+        """
+        raise NotImplementedError
+
+    def abort_multipart(self, key, upload_id):
+        """
+        Discards a multipart upload and any parts stored for it.
+        """
+        raise NotImplementedError
+
+    def local_path(self, key):
+        """
+        Returns the path of the file holding the object stored under
+        key if this backend keeps objects as plain local files (so it
+        can be served straight from disk), else None. Raises NoSuchKey
+        if the object does not exist.
+        """
+        return None
+
+    def download_to(self, key, local_filename):
+        """
+        Copies the object stored under key into local_filename.
+        """
+        with self.get_stream(key) as src, open(local_filename, "wb") as dst:
+            shutil.copyfileobj(src, dst, CHUNK_SIZE)
+
+    def upload_from(self, local_filename, key, callback=None):
+        """
+        Stores the contents of local_filename under key.
+        """
+        with open(local_filename, "rb") as f:
+            self.put_stream(key, f, callback=callback)
+
+    def iter_objects(self, page_size=1000):
+        """
+        Yields (key, size) for every object, one page at a time.
+        """
+        start_after = None
+        while True:
+            objects, start_after = self.list_page(start_after, page_size)
+            yield from objects
+            if start_after is None:
+                return
+
+    def count(self):
+        """
+        Returns the # of objects in storage.
+        """
+        return sum(1 for _ in self.iter_objects())
+
+
+###################################################################
+#
+# S3Storage
+#
+class S3Storage(Storage):
+    """
+    Storage backed by an S3 bucket. Uses the low-level S3 client,
+    which (unlike boto3 resources) is safe to share across threads.
+    """
+
+    name = "s3"
+
+    def __init__(self, bucket_name, region_name, session=None):
+        import boto3
+        from botocore.client import Config
+
+        session = session or boto3
+        self.bucket_name = bucket_name
+        self.region_name = region_name
+        self.location = f"s3://{bucket_name}"
+        self.client = session.client(
+            's3',
+            region_name=region_name,
+            config=Config(
+                retries={
+                    'max_attempts': 3,
+                    'mode': 'standard'
+                }
+            )
+        )
+
+    def _is_missing(self, err):
+        code = str(getattr(err, 'response', {}).get('Error', {}).get('Code', ''))
+        return code in ('404', 'NoSuchKey', 'NotFound')
+
+    def put_stream(self, key, fileobj, callback=None):
+        self.client.upload_fileobj(fileobj, self.bucket_name, key, Callback=callback)
+
+    def get_stream(self, key):
+        try:
+            response = self.client.get_object(Bucket=self.bucket_name, Key=key)
+        except Exception as err:
+            if self._is_missing(err):
+                raise NoSuchKey(key) from err
+            raise
+        return response['Body']
+
+    def get_range(self, key, start, end):
+        try:
+            response = self.client.get_object(
+                Bucket=self.bucket_name,
+                Key=key,
+                Range=f"bytes={start}-{end}"
+            )
+        except Exception as err:
+            if self._is_missing(err):
+                raise NoSuchKey(key) from err
+            raise
+        with response['Body'] as body:
+            return body.read()
+
+    def head(self, key):
+        try:
+            response = self.client.head_object(Bucket=self.bucket_name, Key=key)
+        except Exception as err:
+            if self._is_missing(err):
+                raise NoSuchKey(key) from err
+            raise
+        return {'key': key, 'size': response['ContentLength'],
+                'modified': response['LastModified'].timestamp()}
+
+    def delete_many(self, keys):
+        failed = []
+        keys = list(keys)
+        for i in range(0, len(keys), DELETE_BATCH_SIZE):
+            batch = keys[i:i + DELETE_BATCH_SIZE]
+            response = self.client.delete_objects(
+                Bucket=self.bucket_name,
+                Delete={
+                    'Objects': [{'Key': key} for key in batch],
+                    'Quiet': True
+                }
+            )
+            failed.extend(e['Key'] for e in response.get('Errors', []))
+        return failed
+
+    def list_page(self, start_after=None, max_keys=1000):
+        kwargs = {'Bucket': self.bucket_name, 'MaxKeys': max_keys}
+        if start_after is not None:
+            kwargs['StartAfter'] = start_after
+        response = self.client.list_objects_v2(**kwargs)
+        objects = [(o['Key'], o['Size']) for o in response.get('Contents', [])]
+        if response.get('IsTruncated') and objects:
+            return objects, objects[-1][0]
+        return objects, None
+
+    def create_multipart(self, key):
+        response = self.client.create_multipart_upload(Bucket=self.bucket_name, Key=key)
+        return response['UploadId']
+
+    def upload_part(self, key, upload_id, part_number, data):
+        response = self.client.upload_part(
+            Bucket=self.bucket_name,
+            Key=key,
+            UploadId=upload_id,
+            PartNumber=part_number,
+            Body=data
+        )
+        return response['ETag']
+
+    def complete_multipart(self, key, upload_id, parts):
+        self.client.complete_multipart_upload(
+            Bucket=self.bucket_name,
+            Key=key,
+            UploadId=upload_id,
+            MultipartUpload={
+                'Parts': [{'PartNumber': n, 'ETag': etag} for n, etag in parts]
+            }
+        )
+
+    def abort_multipart(self, key, upload_id):
+        self.client.abort_multipart_upload(Bucket=self.bucket_name, Key=key, UploadId=upload_id)
+
+    def download_to(self, key, local_filename):
+        #
+        # a single GET; download_file() would HEAD the object first:
+        #
+        with self.get_stream(key) as src, open(local_filename, "wb") as dst:
+            shutil.copyfileobj(src, dst, CHUNK_SIZE)
+
+
+###################################################################
+#
+# LocalStorage
+#
+class LocalStorage(Storage):
+    """
+    Storage backed by a directory on the local filesystem; each key
+    maps to a file below root. Downloads use os.sendfile() so the
+    bytes are copied in the kernel, and ranged reads use mmap.
+    """
+
+    name = "local"
+
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+        self.location = f"file://{self.root}"
+        os.makedirs(self.root, exist_ok=True)
+
+    def path(self, key):
+        """
+        Returns the filesystem path for key, refusing keys that would
+        escape the storage root.
+        """
+        path = os.path.abspath(os.path.join(self.root, key))
+        if os.path.commonpath([self.root, path]) != self.root or path == self.root:
+            raise ValueError(f"invalid storage key: {key}")
+        return path
+
+    def _existing_path(self, key):
+        path = self.path(key)
+        if not os.path.isfile(path):
+            raise NoSuchKey(key)
+        return path
+
+    def put_stream(self, key, fileobj, callback=None):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        #
+        # write to a temp file and rename so readers never see a
+        # partially written object:
+        #
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".upload-")
+        try:
+            with os.fdopen(fd, "wb") as dst:
+                while True:
+                    chunk = fileobj.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    dst.write(chunk)
+                    if callback is not None:
+                        callback(len(chunk))
+            os.replace(tmp, path)
+        except BaseException:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            raise
+
+    def get_stream(self, key):
+        return open(self._existing_path(key), "rb")
+
+    def local_path(self, key):
+        return self._existing_path(key)
+
+    def get_range(self, key, start, end):
+        with open(self._existing_path(key), "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if size == 0 or start >= size:
+                return b""
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                return m[start:end + 1]
+
+    def head(self, key):
+        st = os.stat(self._existing_path(key))
+        return {'key': key, 'size': st.st_size, 'modified': st.st_mtime}
+
+    def delete_many(self, keys):
+        failed = []
+        for key in keys:
+            try:
+                os.remove(self.path(key))
+            except FileNotFoundError:
+                pass
+            except (OSError, ValueError) as err:
+                logging.warning(f"LocalStorage.delete_many: {key}: {err}")
+                failed.append(key)
+        return failed
+
+    def _entries(self, start_after=None, directory=None, prefix=""):
+        """
+        Yields (key, DirEntry) for the objects below directory in key
+        order, after start_after. Directories holding only keys up to
+        start_after are not walked into, and a caller that stops early
+        leaves the rest of the tree unread.
+        """
+        try:
+            with os.scandir(directory or self.root) as it:
+                entries = []
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        # skip in-progress multipart uploads (.multipart):
+                        if not entry.name.startswith("."):
+                            entries.append((entry.name + "/", entry))
+                    elif entry.is_file() and not entry.name.startswith(".upload-"):
+                        entries.append((entry.name, entry))
+        except FileNotFoundError:
+            return
+        #
+        # a directory sorts as its name plus "/", which is where its
+        # keys fall among the others ("a-b" < "a/b" < "a0"):
+        #
+        entries.sort(key=lambda item: item[0])
+
+        for name, entry in entries:
+            key = prefix + name
+            if name.endswith("/"):
+                if start_after is not None and key < start_after and not start_after.startswith(key):
+                    continue  # every key below sorts before start_after
+                yield from self._entries(start_after, entry.path, key)
+            elif start_after is None or key > start_after:
+                yield key, entry
+
+    def list_page(self, start_after=None, max_keys=1000):
+        import itertools
+
+        # one past the page, to tell whether there are more:
+        found = list(itertools.islice(self._entries(start_after), max_keys + 1))
+        objects = [(key, entry.stat().st_size) for key, entry in found[:max_keys]]
+        more = len(found) > max_keys
+        return objects, (objects[-1][0] if more and objects else None)
+
+    def _parts_dir(self, upload_id):
+        if not upload_id or not all(c in "0123456789abcdef" for c in upload_id):
+            raise ValueError(f"invalid upload id: {upload_id}")
+        return os.path.join(self.root, ".multipart", upload_id)
+
+    def create_multipart(self, key):
+        self.path(key)
+        upload_id = uuid.uuid4().hex
+        os.makedirs(self._parts_dir(upload_id))
+        return upload_id
+
+    def upload_part(self, key, upload_id, part_number, data):
+        parts_dir = self._parts_dir(upload_id)
+        if not os.path.isdir(parts_dir):
+            raise NoSuchKey(upload_id)
+        with open(os.path.join(parts_dir, f"{part_number}.tmp"), "wb") as f:
+            f.write(data)
+        os.replace(os.path.join(parts_dir, f"{part_number}.tmp"), os.path.join(parts_dir, str(part_number)))
+        return hashlib.md5(data).hexdigest()
+
+    def complete_multipart(self, key, upload_id, parts):
+        parts_dir = self._parts_dir(upload_id)
+
+        names = [os.path.join(parts_dir, str(n)) for n, _ in parts]
+        self.put_stream(key, FileChain(names))
+        shutil.rmtree(parts_dir, ignore_errors=True)
+
+    def abort_multipart(self, key, upload_id):
+        shutil.rmtree(self._parts_dir(upload_id), ignore_errors=True)
+
+    def download_to(self, key, local_filename):
+        with open(self._existing_path(key), "rb") as src, open(local_filename, "wb") as dst:
+            size = os.fstat(src.fileno()).st_size
+            try:
+                offset = 0
+                while offset < size:
+                    sent = os.sendfile(dst.fileno(), src.fileno(), offset, size - offset)
+                    if sent == 0:
+                        break
+                    offset += sent
+            except (AttributeError, OSError):
+                #
+                # sendfile not available for this platform / file pair:
+                #
+                src.seek(0)
+                dst.seek(0)
+                dst.truncate()
+                shutil.copyfileobj(src, dst, CHUNK_SIZE)
+
+
+###################################################################
+#
+# MemoryStorage
+#
+class MemoryStorage(Storage):
+    """
+    Storage held in process memory; contents are lost on exit. One
+    shared instance exists per name so every call in the process sees
+    the same objects.
+    """
+
+    name = "memory"
+
+    _instances = {}
+    _instances_lock = threading.Lock()
+
+    def __init__(self, location="memory:"):
+        self.location = location
+        self._objects = {}
+        self._modified = {}
+        self._multipart = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def shared(cls, name="default"):
+        with cls._instances_lock:
+            if name not in cls._instances:
+                cls._instances[name] = cls(f"memory:{name}")
+            return cls._instances[name]
+
+    def _get(self, key):
+        with self._lock:
+            try:
+                return self._objects[key]
+            except KeyError:
+                raise NoSuchKey(key) from None
+
+    def put_stream(self, key, fileobj, callback=None):
+        chunks = []
+        while True:
+            chunk = fileobj.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            if callback is not None:
+                callback(len(chunk))
+        data = b"".join(chunks)
+        with self._lock:
+            self._objects[key] = data
+            self._modified[key] = time.time()
+
+    def get_stream(self, key):
+        import io
+        return io.BytesIO(self._get(key))
+
+    def get_range(self, key, start, end):
+        return self._get(key)[start:end + 1]
+
+    def head(self, key):
+        with self._lock:
+            if key not in self._objects:
+                raise NoSuchKey(key)
+            return {'key': key, 'size': len(self._objects[key]), 'modified': self._modified[key]}
+
+    def delete_many(self, keys):
+        with self._lock:
+            for key in keys:
+                self._objects.pop(key, None)
+                self._modified.pop(key, None)
+        return []
+
+    def list_page(self, start_after=None, max_keys=1000):
+        with self._lock:
+            keys = sorted(k for k in self._objects if start_after is None or k > start_after)
+            page = keys[:max_keys]
+            objects = [(key, len(self._objects[key])) for key in page]
+        more = len(keys) > max_keys
+        return objects, (page[-1] if more else None)
+
+    def create_multipart(self, key):
+        upload_id = uuid.uuid4().hex
+        with self._lock:
+            self._multipart[upload_id] = {}
+        return upload_id
+
+    def upload_part(self, key, upload_id, part_number, data):
+        with self._lock:
+            if upload_id not in self._multipart:
+                raise NoSuchKey(upload_id)
+            self._multipart[upload_id][part_number] = bytes(data)
+        return hashlib.md5(data).hexdigest()
+
+    def complete_multipart(self, key, upload_id, parts):
+        with self._lock:
+            stored = self._multipart.pop(upload_id)
+            self._objects[key] = b"".join(stored[n] for n, _ in parts)
+            self._modified[key] = time.time()
+
+    def abort_multipart(self, key, upload_id):
+        with self._lock:
+            self._multipart.pop(upload_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._objects.clear()
+
+
+###################################################################
+#
+# from_config
+#
+# create and return the storage backend selected by the [storage]
+# section of the given ConfigParser (S3 if there is no such section).
+#
+def from_config(configur):
+    """
+    Creates the storage backend described by the app config.
+
+    Parameters
+    ----------
+    configur is a ConfigParser that has read the app config file
+
+    Returns
+    -------
+    Storage object
+    """
+
+    backend = configur.get('storage', 'backend', fallback='s3').strip().lower()
+
+    if backend == 's3':
+        bucketname = configur.get('s3', 'bucket_name')
+        regionname = configur.get('s3', 'region_name')
+        return S3Storage(bucketname, regionname)
+
+    if backend == 'local':
+        root = configur.get('storage', 'root', fallback='photoapp-data')
+        return LocalStorage(root)
+
+    if backend == 'memory':
+        return MemoryStorage.shared(configur.get('storage', 'name', fallback='default'))
+
+    raise ValueError(f"unknown storage backend '{backend}' in [storage] section of config file")
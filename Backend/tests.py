@@ -7,8 +7,27 @@
 #
 
 import photoapp
+import storage
+import detectors
+import migrations
+import responses
+import events
+import uploads
+import context
+import limits
+import reconciler
+import metadata
+import similarity
+import io
+import os
+import subprocess
+import sys
+import tempfile
+import time
 import unittest
 
+from unittest import mock
+
 
 ############################################################
 #
@@ -54,6 +73,1356 @@ class PhotoappTests(unittest.TestCase):
 
     print("test passed!")
 
+  def test_04(self):
+    print()
+    print("** test_04: schema migrations and query plans **")
+
+    dbConn = photoapp.get_dbConn()
+    try:
+      migrations.migrate(dbConn)
+      self.assertEqual(migrations.current_version(dbConn), migrations.latest_version())
+      self.assertEqual(migrations.check_query_plans(dbConn, photoapp.HOT_QUERIES), [])
+    finally:
+      dbConn.close()
+
+    print("test passed!")
+
+
+############################################################
+#
+# Storage backend tests (no AWS access required)
+#
+class StorageTests(unittest.TestCase):
+
+  def check_backend(self, store):
+    store.put_stream("u/b.jpg", io.BytesIO(b"0123456789"))
+    store.put_stream("u/a.jpg", io.BytesIO(b"abc"))
+    store.put_stream("u-x.jpg", io.BytesIO(b""))
+
+    self.assertEqual(store.head("u/b.jpg")['size'], 10)
+    self.assertEqual(store.get_range("u/b.jpg", 2, 4), b"234")
+    with store.get_stream("u/a.jpg") as f:
+      self.assertEqual(f.read(), b"abc")
+
+    objects, next_key = store.list_page(max_keys=2)
+    self.assertEqual(objects, [("u-x.jpg", 0), ("u/a.jpg", 3)])
+    objects, next_key = store.list_page(next_key, max_keys=2)
+    self.assertEqual(objects, [("u/b.jpg", 10)])
+    self.assertIsNone(next_key)
+    self.assertEqual(store.count(), 3)
+
+    with tempfile.TemporaryDirectory() as tmp:
+      filename = os.path.join(tmp, "out.jpg")
+      store.download_to("u/b.jpg", filename)
+      with open(filename, "rb") as f:
+        self.assertEqual(f.read(), b"0123456789")
+
+    self.assertEqual(store.delete_many(["u/a.jpg", "missing"]), [])
+    with self.assertRaises(storage.NoSuchKey):
+      store.head("u/a.jpg")
+
+  def test_01(self):
+    print()
+    print("** storage test_01: memory backend **")
+
+    self.check_backend(storage.MemoryStorage())
+
+    print("test passed!")
+
+  def test_02(self):
+    print()
+    print("** storage test_02: local backend **")
+
+    with tempfile.TemporaryDirectory() as root:
+      store = storage.LocalStorage(root)
+      self.check_backend(store)
+      with self.assertRaises(ValueError):
+        store.path("../escape.jpg")
+
+      # pages walk only the directories they need, in key order
+      # (here not "u", past the end of the page):
+      for key in ("a/1.jpg", "a/2.jpg", "a-b.jpg", "b/c/3.jpg", "b0.jpg"):
+        store.put_stream(key, io.BytesIO(b"x"))
+      keys = [key for key, _ in store.iter_objects(page_size=2)]
+      self.assertEqual(keys, sorted(keys))
+      with mock.patch.object(storage.os, 'scandir', wraps=os.scandir) as scandir:
+        objects, next_key = store.list_page("a/2.jpg", max_keys=1)
+      self.assertEqual(objects, [("b/c/3.jpg", 1)])
+      self.assertEqual(next_key, "b/c/3.jpg")
+      self.assertEqual([os.path.relpath(call.args[0], root) for call in scandir.call_args_list],
+                       [".", "a", "b", os.path.join("b", "c")])
+      # and skip the directories wholly before start_after:
+      with mock.patch.object(storage.os, 'scandir', wraps=os.scandir) as scandir:
+        objects, next_key = store.list_page("b/c/3.jpg", max_keys=1)
+      self.assertEqual(objects, [("b0.jpg", 1)])
+      self.assertNotIn(os.path.join(root, "a"), [call.args[0] for call in scandir.call_args_list])
+
+    print("test passed!")
+
+
+  def test_03(self):
+    print()
+    print("** storage test_03: downloads sent from the stored file, or streamed **")
+
+    from fastapi.testclient import TestClient
+    import api
+
+    client = TestClient(api.app)
+    row = ("u/cat.jpg", "cat.jpg", "image/jpeg")
+
+    with tempfile.TemporaryDirectory() as root:
+      for store in (storage.LocalStorage(root), storage.MemoryStorage()):
+        store.put_stream("u/cat.jpg", io.BytesIO(b"meow" * 1000))
+        with mock.patch.object(photoapp, 'get_dbConn', return_value=FakeConnection([[{'rows': [row]}]])), \
+             mock.patch.object(photoapp, 'get_storage', return_value=store), \
+             mock.patch.object(store, 'download_to', side_effect=AssertionError("copied")):
+          response = client.get("/images/1001/download")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, b"meow" * 1000)
+        self.assertEqual(response.headers["content-type"], "image/jpeg")
+        self.assertIn("cat.jpg", response.headers["content-disposition"])
+
+      with mock.patch.object(photoapp, 'get_dbConn', return_value=FakeConnection([[{'rows': []}]])):
+        self.assertEqual(client.get("/images/1002/download").status_code, 404)
+
+    print("test passed!")
+
+############################################################
+#
+# Label detector tests (no AWS access required)
+#
+class DetectorTests(unittest.TestCase):
+
+  def test_01(self):
+    print()
+    print("** detector test_01: stub detector from config **")
+
+    from configparser import ConfigParser
+    configur = ConfigParser()
+    configur.read_string("[labels]\ndetector = stub\nmax_labels = 3\nmin_confidence = 60\n")
+
+    detector = detectors.from_config(configur, rekognition_factory=None)
+    self.assertIsInstance(detector, detectors.StubDetector)
+
+    with tempfile.TemporaryDirectory() as tmp:
+      images = []
+      for i in range(2):
+        filename = os.path.join(tmp, f"{i}.jpg")
+        with open(filename, "wb") as f:
+          f.write(bytes([i]) * 100)
+        images.append(detectors.ImageInput(None, f"u/{i}.jpg", filename))
+
+      batch = detector.detect_batch(images)
+      self.assertEqual(batch[0], detector.detect(images[0]))
+
+    for labels in batch:
+      self.assertLessEqual(len(labels), 3)
+      for label in labels:
+        self.assertGreaterEqual(label['Confidence'], 60)
+
+    print("test passed!")
+
+
+############################################################
+#
+# Round-trip tests: photoapp functions run against a scripted
+# fake database connection that counts round trips.
+#
+class FakeCursor:
+
+  def __init__(self, conn):
+    self.conn = conn
+    self.sets = []
+
+  def execute(self, sql, params=None):
+    self.conn.round_trips += 1
+    self.conn.executed.append(sql)
+    self.sets = list(self.conn.results.pop(0))
+    self.load(self.sets.pop(0))
+
+  def load(self, result):
+    self.rows = list(result.get('rows', []))
+    self.rowcount = result.get('rowcount', len(self.rows))
+    self.lastrowid = result.get('lastrowid')
+
+  def nextset(self):
+    if not self.sets:
+      return None
+    self.load(self.sets.pop(0))
+    return True
+
+  def fetchone(self):
+    return self.rows.pop(0) if self.rows else None
+
+  def fetchall(self):
+    rows, self.rows = self.rows, []
+    return tuple(rows)
+
+  def close(self):
+    pass
+
+
+class FakeConnection:
+
+  def __init__(self, results):
+    self.results = list(results)
+    self.round_trips = 0
+    self.executed = []
+    self.open = True
+
+  def cursor(self):
+    return FakeCursor(self)
+
+  def begin(self):
+    self.round_trips += 1
+
+  def commit(self):
+    self.round_trips += 1
+
+  def rollback(self):
+    self.round_trips += 1
+
+  def close(self):
+    self.open = False
+
+
+class RoundTripTests(unittest.TestCase):
+
+  def connect(self, *results):
+    self.connections = []
+    def get_dbConn():
+      conn = FakeConnection(results)
+      self.connections.append(conn)
+      return conn
+    return mock.patch.object(photoapp, 'get_dbConn', get_dbConn)
+
+  def test_01(self):
+    print()
+    print("** round trips test_01: get_image_labels **")
+
+    with self.connect([{'rows': [(1001, 'Cat', 95), (1001, 'Dog', 88)]}]):
+      labels = photoapp.get_image_labels(1001)
+
+    self.assertEqual(labels, [('Cat', 95), ('Dog', 88)])
+    self.assertEqual(len(self.connections), 1)
+    self.assertEqual(self.connections[0].round_trips, 1)
+
+    with self.connect([{'rows': [(1001, None, None)]}]):
+      self.assertEqual(photoapp.get_image_labels(1001), [])
+
+    with self.connect([{'rows': []}]):
+      with self.assertRaises(ValueError):
+        photoapp.get_image_labels(1002)
+    self.assertEqual(len(self.connections), 1)
+
+    print("test passed!")
+
+  def test_02(self):
+    print()
+    print("** round trips test_02: post_image **")
+
+    store = storage.MemoryStorage()
+    detector = detectors.StubDetector(max_labels=5, min_confidence=0)
+
+    with tempfile.TemporaryDirectory() as tmp:
+      filename = os.path.join(tmp, "cat.jpg")
+      with open(filename, "wb") as f:
+        f.write(b"not really a jpeg")
+
+      username = [{'rows': [("p_sarkar",)]}]
+      insert = [{'rowcount': 1, 'lastrowid': 1001}]
+      update = [{'rowcount': 1}]
+
+      with self.connect(username, insert, update), \
+           mock.patch.object(photoapp, 'get_storage', lambda: store), \
+           mock.patch.object(photoapp, 'get_detector', lambda: detector):
+        assetid = photoapp.post_image(80001, filename)
+
+    self.assertEqual(assetid, 1001)
+    (key, size), = store.iter_objects()
+    self.assertTrue(key.startswith("p_sarkar/"))
+    self.assertEqual(size, 17)
+    self.assertEqual(len(self.connections), 1)
+    # username, insert + commit, labels/status update + commit:
+    self.assertEqual(self.connections[0].round_trips, 5)
+
+    print("test passed!")
+
+  def test_03(self):
+    print()
+    print("** round trips test_03: post_image with unknown userid **")
+
+    store = storage.MemoryStorage()
+    with tempfile.NamedTemporaryFile() as f, \
+         self.connect([{'rows': []}]), \
+         mock.patch.object(photoapp, 'get_storage', lambda: store):
+      with self.assertRaises(ValueError):
+        photoapp.post_image(99999, f.name)
+
+    # no retries for a missing user, and nothing stored:
+    self.assertEqual(len(self.connections), 1)
+    self.assertEqual(self.connections[0].round_trips, 1)
+    self.assertEqual(store.count(), 0)
+
+    print("test passed!")
+
+  def test_04(self):
+    print()
+    print("** round trips test_04: get_labels_for_assets **")
+
+    rows = [(1001, 'Cat', 95), (1001, 'Pet', 90), (1003, 'Tree', 85)]
+    with self.connect([{'rows': rows}]):
+      labels = photoapp.get_labels_for_assets([1001, 1002, 1003])
+
+    self.assertEqual(labels, {1001: [('Cat', 95), ('Pet', 90)], 1002: [], 1003: [('Tree', 85)]})
+    self.assertEqual(self.connections[0].round_trips, 1)
+
+    print("test passed!")
+
+  def test_05(self):
+    print()
+    print("** round trips test_05: relabel_pending labels in batches **")
+
+    store = storage.MemoryStorage()
+    for i in range(3):
+      store.put_stream(f"u/{i}.jpg", io.BytesIO(bytes([i]) * 100))
+    detector = detectors.StubDetector(max_labels=5, min_confidence=0)
+
+    pending = [(1001 + i, 80001, f"u/{i}.jpg") for i in range(3)]
+    load = FakeConnection([[{'rows': pending}]])
+    save = FakeConnection([[{'rowcount': 1}]] * 3)
+
+    with mock.patch.object(photoapp, 'get_dbConn', side_effect=[load, save, save]), \
+         mock.patch.object(photoapp, 'get_storage', lambda: store), \
+         mock.patch.object(photoapp, 'get_detector', lambda: detector), \
+         mock.patch.object(detector, 'detect_batch', wraps=detector.detect_batch) as batches:
+      report = photoapp.relabel_pending(batch_size=2)
+
+    self.assertEqual(report, {'relabeled': 3, 'failed': 0, 'overloaded': False})
+    self.assertEqual([len(call.args[0]) for call in batches.call_args_list], [2, 1])
+    # one labels/status update + commit per asset:
+    self.assertEqual(save.round_trips, 6)
+
+    # with another worker sweeping, the database isn't touched:
+    with tempfile.TemporaryDirectory() as d:
+      lock_path = os.path.join(d, 'relabel.lock')
+      with reconciler.exclusive(lock_path), \
+           mock.patch.object(photoapp, 'get_dbConn', side_effect=AssertionError):
+        self.assertIsNone(photoapp.relabel_pending(lock_path=lock_path))
+
+    print("test passed!")
+
+  def test_06(self):
+    print()
+    print("** round trips test_06: the hot queries are the SQL photoapp runs **")
+
+    hot = {name: sql for name, sql, _ in photoapp.HOT_QUERIES}
+    calls = {
+      "get_images(userid)": lambda: photoapp.get_images(userid=80001),
+      "get_images(min_width)": lambda: photoapp.get_images(min_width=4000),
+      "get_images(taken_after)": lambda: photoapp.get_images(taken_after='2030-01-01'),
+      "get_image_labels(assetid)": lambda: photoapp.get_image_labels(1001),
+      "get_images_with_label(label)": lambda: photoapp.get_images_with_label("Anim"),
+      "relabel_pending": lambda: photoapp.relabel_pending(),
+    }
+    for name, call in calls.items():
+      conn = FakeConnection([[{'rows': [(1001, None, None)]}]])
+      with mock.patch.object(photoapp, 'get_dbConn', return_value=conn), \
+           mock.patch.object(photoapp, 'get_storage'), \
+           mock.patch.object(photoapp, 'get_detector'):
+        try:
+          call()
+        except Exception:
+          pass  # only the first statement matters here
+      self.assertEqual(conn.executed[0], hot[name], name)
+
+    print("test passed!")
+
+  def test_07(self):
+    print()
+    print("** round trips test_07: post_image removes the object if the insert fails **")
+
+    store = storage.MemoryStorage()
+    stored = []
+    put_stream = store.put_stream
+
+    def record_put(*args, **kwargs):
+      put_stream(*args, **kwargs)
+      stored.append(len(self.connections[0].executed))
+
+    store.put_stream = record_put
+
+    # no result for the insert, so it fails (without retries):
+    with tempfile.NamedTemporaryFile() as f, \
+         self.connect([{'rows': [("p_sarkar",)]}]), \
+         mock.patch.object(photoapp.retries, 'retry', lambda **kwargs: (lambda fn: fn)), \
+         mock.patch.object(photoapp, 'get_storage', lambda: store):
+      with self.assertRaises(IndexError):
+        photoapp.post_image(80001, f.name)
+
+    # the object was stored after the username lookup, before the insert:
+    self.assertEqual(stored, [1])
+    self.assertEqual(len(self.connections[0].executed), 2)
+    self.assertEqual(store.count(), 0)
+
+    print("test passed!")
+
+
+############################################################
+#
+# Response encoding tests
+#
+class ResponseTests(unittest.TestCase):
+
+  def test_01(self):
+    print()
+    print("** response test_01: row and columnar encoding **")
+
+    import gzip
+    import json
+
+    columns = ("assetid", "label", "confidence")
+    rows = [(1001, "Cat", 95), (1002, "Dog", 88)]
+
+    self.assertEqual(responses.encode_rows(columns, rows),
+                     [{"assetid": 1001, "label": "Cat", "confidence": 95},
+                      {"assetid": 1002, "label": "Dog", "confidence": 88}])
+    self.assertEqual(responses.encode_rows(columns, rows, "columnar"),
+                     {"assetid": [1001, 1002], "label": ["Cat", "Dog"], "confidence": [95, 88]})
+
+    body = responses.dumps({"images": responses.encode_rows(columns, rows * 100)})
+    compressed, encoding = responses.compress(body, "gzip, deflate")
+    self.assertEqual(encoding, "gzip")
+    self.assertEqual(json.loads(gzip.decompress(compressed)), json.loads(body))
+    self.assertEqual(responses.compress(body, "gzip;q=0")[1], None)
+    self.assertEqual(responses.compress(body, "*")[1], "gzip")
+    self.assertEqual(responses.compress(body, "gzip;q=0, *")[1], None)
+    self.assertEqual(responses.compress(b"{}", "gzip")[1], None)
+
+    print("test passed!")
+
+  def test_02(self):
+    print()
+    print("** response test_02: rows serialized straight from tuples **")
+
+    import datetime
+    import json
+
+    columns = ("assetid", "localname", "size", "taken_at", "mime")
+    rows = [
+      (1001, 'a "quoted", name.jpg', 10, datetime.datetime(2024, 5, 17, 10, 30), "image/jpeg"),
+      (1002, 'back\\slash\\","', None, None, None),
+      (1003, "", 2.5, None, "image/png"),
+    ]
+    expected = [dict(zip(columns, r)) for r in rows]
+    expected[0]['taken_at'] = "2024-05-17T10:30:00"
+
+    self.assertEqual(json.loads(responses.dumps_rows(columns, rows)), expected)
+    with mock.patch.object(responses, 'orjson', None):
+      self.assertEqual(json.loads(responses.dumps_rows(columns, rows)), expected)
+    self.assertEqual(responses.dumps_rows(columns, []), b"[]")
+
+    request = mock.Mock(headers={})
+    response = responses.rows_response(request, "images", columns, rows, extra={"label": "x"})
+    self.assertEqual(json.loads(response.body), {"label": "x", "images": expected})
+
+    print("test passed!")
+
+
+############################################################
+#
+# Conditional request tests: ETag / If-None-Match on the metadata
+# endpoints, through the FastAPI app (no AWS or MySQL access).
+#
+class ETagTests(unittest.TestCase):
+
+  def setUp(self):
+    from fastapi.testclient import TestClient
+    import api
+
+    self.client = TestClient(api.app)
+    photoapp._users_version = (None, None, 0.0)
+
+  def test_01(self):
+    print()
+    print("** etag test_01: a matching If-None-Match is a 304 without touching MySQL **")
+
+    row = (1001, 80001, "cat.jpg", "u/cat.jpg", 10, None, None, None, None, None)
+    with mock.patch.object(photoapp, 'get_dbConn', side_effect=AssertionError("MySQL touched")), \
+         mock.patch.object(photoapp, 'get_images', return_value=[row]) as get_images:
+      first = self.client.get("/images")
+      self.assertEqual(first.status_code, 200)
+      tag = first.headers["etag"]
+
+      cached = self.client.get("/images", headers={"If-None-Match": tag})
+      self.assertEqual(cached.status_code, 304)
+      self.assertEqual(cached.headers["etag"], tag)
+      self.assertEqual(cached.headers["vary"], first.headers["vary"])
+      self.assertEqual(get_images.call_count, 1)
+
+      # another URL, another tag:
+      self.assertEqual(self.client.get("/images?userid=80001", headers={"If-None-Match": tag}).status_code, 200)
+
+      photoapp.bump_catalog_version()
+      fresh = self.client.get("/images", headers={"If-None-Match": tag})
+      self.assertEqual(fresh.status_code, 200)
+      self.assertNotEqual(fresh.headers["etag"], tag)
+
+    print("test passed!")
+
+  def test_02(self):
+    print()
+    print("** etag test_02: writes bump the catalog version, user changes the /users tag **")
+
+    store = storage.MemoryStorage()
+    detector = detectors.StubDetector(max_labels=5, min_confidence=0)
+    before = photoapp.get_catalog_version()
+
+    with tempfile.TemporaryDirectory() as tmp:
+      filename = os.path.join(tmp, "cat.jpg")
+      with open(filename, "wb") as f:
+        f.write(b"not really a jpeg")
+      conn = FakeConnection([
+        [{'rows': [("p_sarkar",)]}],
+        [{'rowcount': 1, 'lastrowid': 1001}],
+        [{'rowcount': 1}],
+      ])
+      with mock.patch.object(photoapp, 'get_dbConn', return_value=conn), \
+           mock.patch.object(photoapp, 'get_storage', lambda: store), \
+           mock.patch.object(photoapp, 'get_detector', lambda: detector):
+        photoapp.post_image(80001, filename)
+
+    self.assertNotEqual(photoapp.get_catalog_version(), before)
+
+    users = [(80001, "p_sarkar", "Pooja", "Sarkar")]
+    with mock.patch.object(photoapp, 'get_users', return_value=users), \
+         mock.patch.object(photoapp, 'get_dbConn', return_value=FakeConnection([[{'rows': [(1, 0x1234)]}]])):
+      first = self.client.get("/users")
+    tag = first.headers["etag"]
+
+    # catalog writes don't change it, and within the TTL the
+    # fingerprint is not re-read:
+    photoapp.bump_catalog_version()
+    with mock.patch.object(photoapp, 'get_dbConn', side_effect=AssertionError("MySQL touched")):
+      self.assertEqual(self.client.get("/users", headers={"If-None-Match": tag}).status_code, 304)
+
+    # a new user does:
+    with mock.patch.object(photoapp, 'USERS_VERSION_TTL', 0), \
+         mock.patch.object(photoapp, 'get_users', return_value=users * 2), \
+         mock.patch.object(photoapp, 'get_dbConn', return_value=FakeConnection([[{'rows': [(2, 0x5678)]}]])):
+      changed = self.client.get("/users", headers={"If-None-Match": tag})
+    self.assertEqual(changed.status_code, 200)
+    self.assertNotEqual(changed.headers["etag"], tag)
+
+    print("test passed!")
+
+
+############################################################
+#
+# Event bus tests
+#
+class EventTests(unittest.TestCase):
+
+  def test_01(self):
+    print()
+    print("** event test_01: bounded subscriber queues **")
+
+    import asyncio
+    import threading
+
+    async def run():
+      bus = events.EventBus()
+      slow = bus.subscribe(maxsize=3)
+      only_user = bus.subscribe(predicate=lambda e: e.get('userid') == 80002)
+
+      def publish():
+        for i in range(10):
+          bus.publish('upload-progress', userid=80001 + i % 2, n=i)
+
+      t = threading.Thread(target=publish)
+      t.start()
+      t.join()
+      await asyncio.sleep(0.01)
+
+      async def drain(sub):
+        got = []
+        while (event := await sub.get(timeout=0.01)) is not None:
+          got.append(event['n'])
+        return got
+
+      self.assertEqual(await drain(slow), [7, 8, 9])
+      self.assertEqual(slow.dropped, 7)
+      self.assertEqual(await drain(only_user), [1, 3, 5, 7, 9])
+
+      bus.unsubscribe(slow)
+      bus.unsubscribe(only_user)
+      self.assertEqual(bus.subscriber_count(), 0)
+
+    asyncio.run(run())
+
+    print("test passed!")
+
+
+############################################################
+#
+# Chunked upload tests, against a memory-storage backend
+#
+class FakeUploadBackend:
+
+  def __init__(self):
+    self.store = storage.MemoryStorage()
+    self.completed = []
+
+  def begin_upload(self, userid, filename):
+    bucketkey = f"user{userid}/{filename}"
+    return bucketkey, self.store.create_multipart(bucketkey)
+
+  def upload_part(self, bucketkey, upload_id, part_number, data):
+    return self.store.upload_part(bucketkey, upload_id, part_number, data)
+
+  def abort_upload(self, bucketkey, upload_id, assembled=False):
+    if assembled:
+      self.store.delete_many([bucketkey])
+    else:
+      self.store.abort_multipart(bucketkey, upload_id)
+
+  def assemble_upload(self, bucketkey, upload_id, parts):
+    self.store.complete_multipart(bucketkey, upload_id, parts)
+
+  def complete_upload(self, userid, filename, bucketkey, size, content_hash):
+    self.completed.append((bucketkey, size, content_hash))
+    return 1001
+
+
+class UploadTests(unittest.TestCase):
+
+  def test_01(self):
+    print()
+    print("** upload test_01: chunks, retries and completion **")
+
+    import hashlib
+
+    backend = FakeUploadBackend()
+    manager = uploads.UploadManager(chunk_size=4, backend=backend)
+    data = b"0123456789"
+
+    upload = manager.begin(80001, "big.jpg", size=len(data))
+    manager.put_chunk(upload.upload_id, 1, data[0:4])
+    manager.put_chunk(upload.upload_id, 2, data[4:8])
+    # a retried chunk is accepted again:
+    manager.put_chunk(upload.upload_id, 2, data[4:8])
+
+    with self.assertRaises(ValueError):
+      manager.put_chunk(upload.upload_id, 3, b"toolong")
+    with self.assertRaises(ValueError):
+      manager.complete(upload.upload_id)
+    self.assertEqual(manager.status(upload.upload_id)['parts'], [1, 2])
+
+    manager.put_chunk(upload.upload_id, 3, data[8:])
+    self.assertEqual(manager.complete(upload.upload_id), 1001)
+
+    bucketkey, size, content_hash = backend.completed[0]
+    self.assertEqual(size, 10)
+    self.assertEqual(content_hash, hashlib.sha256(data).hexdigest())
+    with backend.store.get_stream(bucketkey) as f:
+      self.assertEqual(f.read(), data)
+    with self.assertRaises(uploads.NoSuchUpload):
+      manager.get(upload.upload_id)
+
+    print("test passed!")
+
+  def test_02(self):
+    print()
+    print("** upload test_02: out-of-order chunks and expiry **")
+
+    now = [0.0]
+    backend = FakeUploadBackend()
+    manager = uploads.UploadManager(chunk_size=4, ttl=100, backend=backend, clock=lambda: now[0])
+
+    upload = manager.begin(80001, "a.jpg")
+    manager.put_chunk(upload.upload_id, 2, b"45")
+    manager.put_chunk(upload.upload_id, 1, b"0123")
+    manager.complete(upload.upload_id)
+    # parts arrived out of order, so no hash was computed:
+    self.assertEqual(backend.completed[0][2], None)
+
+    stale = manager.begin(80001, "b.jpg")
+    manager.put_chunk(stale.upload_id, 1, b"0123")
+    now[0] = 500.0
+    self.assertEqual(manager.expire(), 1)
+    self.assertEqual(backend.store._multipart, {})
+    with self.assertRaises(uploads.NoSuchUpload):
+      manager.put_chunk(stale.upload_id, 2, b"45")
+
+    print("test passed!")
+
+  def test_03(self):
+    print()
+    print("** upload test_03: a failed completion resumes after assembly **")
+
+    backend = FakeUploadBackend()
+    manager = uploads.UploadManager(chunk_size=4, backend=backend)
+
+    upload = manager.begin(80001, "c.jpg")
+    manager.put_chunk(upload.upload_id, 1, b"0123")
+    manager.put_chunk(upload.upload_id, 2, b"45")
+
+    with mock.patch.object(backend, 'complete_upload', side_effect=RuntimeError("db down")):
+      with self.assertRaises(RuntimeError):
+        manager.complete(upload.upload_id)
+
+    # the parts are assembled and the multipart upload is gone:
+    self.assertEqual(backend.store._multipart, {})
+    with self.assertRaises(ValueError):
+      manager.put_chunk(upload.upload_id, 2, b"67")
+
+    # so the retry only creates the asset:
+    with mock.patch.object(backend, 'assemble_upload') as assemble:
+      self.assertEqual(manager.complete(upload.upload_id), 1001)
+    assemble.assert_not_called()
+    with backend.store.get_stream(upload.bucketkey) as f:
+      self.assertEqual(f.read(), b"012345")
+
+    # an assembled upload that expires takes its object with it:
+    now = [0.0]
+    manager = uploads.UploadManager(chunk_size=4, ttl=100, backend=backend, clock=lambda: now[0])
+    upload = manager.begin(80001, "d.jpg")
+    manager.put_chunk(upload.upload_id, 1, b"01")
+    with mock.patch.object(backend, 'complete_upload', side_effect=RuntimeError("db down")):
+      with self.assertRaises(RuntimeError):
+        manager.complete(upload.upload_id)
+    now[0] = 500.0
+    self.assertEqual(manager.expire(), 1)
+    with self.assertRaises(storage.NoSuchKey):
+      backend.store.head(upload.bucketkey)
+
+    print("test passed!")
+
+  def test_04(self):
+    print()
+    print("** upload test_04: workers sharing upload state **")
+
+    import hashlib
+
+    backend = FakeUploadBackend()
+    with tempfile.TemporaryDirectory() as state_dir:
+      path = os.path.join(state_dir, "uploads")
+      worker1 = uploads.UploadManager(chunk_size=4, backend=backend, store=uploads.SharedUploadStore(path))
+      worker2 = uploads.UploadManager(chunk_size=4, backend=backend, store=uploads.SharedUploadStore(path))
+
+      upload = worker1.begin(80001, "e.jpg", size=6)
+      worker1.put_chunk(upload.upload_id, 1, b"0123")
+      worker2.put_chunk(upload.upload_id, 2, b"45")
+      self.assertEqual(worker1.status(upload.upload_id)['parts'], [1, 2])
+
+      self.assertEqual(worker2.complete(upload.upload_id), 1001)
+      # worker2 didn't see part 1, so it couldn't hash the image:
+      self.assertEqual(backend.completed[-1][2], None)
+      with self.assertRaises(uploads.NoSuchUpload):
+        worker1.get(upload.upload_id)
+
+      # parts that all reach one worker are hashed as before:
+      upload = worker2.begin(80001, "f.jpg")
+      worker2.put_chunk(upload.upload_id, 1, b"0123")
+      worker2.put_chunk(upload.upload_id, 2, b"45")
+      worker1.status(upload.upload_id)
+      worker2.complete(upload.upload_id)
+      self.assertEqual(backend.completed[-1][2], hashlib.sha256(b"012345").hexdigest())
+
+      with self.assertRaises(uploads.NoSuchUpload):
+        worker1.get("../etc")
+
+    print("test passed!")
+
+
+############################################################
+#
+# Context tests: connection pool reuse and context swaps. Offline.
+#
+class FakePoolConnection:
+
+  def __init__(self):
+    self.open = True
+    self.server_status = 0
+
+  def ping(self, reconnect=False):
+    pass
+
+  def rollback(self):
+    pass
+
+  def close(self):
+    self.open = False
+
+
+class ContextTests(unittest.TestCase):
+
+  def test_01(self):
+    print()
+    print("** context test_01: pooled connections are reused **")
+
+    opened = []
+
+    def connect():
+      opened.append(FakePoolConnection())
+      return opened[-1]
+
+    pool = context.ConnectionPool(connect, size=1)
+    pool.warm()
+    self.assertEqual(len(opened), 1)
+
+    a = pool.get()
+    b = pool.get()
+    self.assertEqual(len(opened), 2)
+    a.close()
+    b.close()
+    # only size connections are kept idle:
+    self.assertEqual(pool.idle_count(), 1)
+    self.assertFalse(opened[1].open)
+
+    with pool.get() as c:
+      self.assertTrue(c.open)
+    self.assertEqual(len(opened), 2)
+
+    pool.close()
+    self.assertFalse(opened[0].open)
+
+    print("test passed!")
+
+  def test_02(self):
+    print()
+    print("** context test_02: pinned context survives a swap **")
+
+    old, new = object(), object()
+
+    with mock.patch.object(photoapp, '_context', old):
+      with photoapp.use_context():
+        with mock.patch.object(photoapp, '_context', new):
+          self.assertIs(photoapp.current_context(), old)
+      self.assertIs(photoapp.current_context(), old)
+
+    with mock.patch.object(photoapp, '_context', None):
+      with self.assertRaises(RuntimeError):
+        photoapp.current_context()
+
+    print("test passed!")
+
+  def test_03(self):
+    print()
+    print("** context test_03: catalog version shared through a file **")
+
+    with tempfile.TemporaryDirectory() as d:
+      path = os.path.join(d, 'catalog-version')
+      a = context.SharedCatalogVersion(path)
+      b = context.SharedCatalogVersion(path)
+      before = b.get()
+      a.bump()
+      self.assertNotEqual(b.get(), before)
+      self.assertEqual(a.get(), b.get())
+
+    print("test passed!")
+
+  def test_04(self):
+    print()
+    print("** context test_04: workers follow a broadcast re-initialize **")
+
+    built = []
+
+    class FakeAppContext:
+      def __init__(self, config_file, s3_profile, mysql_user):
+        built.append((config_file, s3_profile, mysql_user))
+
+      def warm(self):
+        pass
+
+      def close(self):
+        pass
+
+    with tempfile.TemporaryDirectory() as d, \
+         mock.patch.object(context, 'AppContext', FakeAppContext), \
+         mock.patch.object(photoapp.retries, 'preload'), \
+         mock.patch.object(photoapp, 'start_similarity_rebuild'), \
+         mock.patch.object(photoapp, '_context', None), \
+         mock.patch.object(photoapp, '_catalog', photoapp._catalog), \
+         mock.patch.object(photoapp, '_shared_settings', None), \
+         mock.patch.object(photoapp, '_context_generation', None):
+      photoapp.use_shared_state(d)
+      photoapp.initialize('photoapp-config.ini', 's3readwrite', 'photoapp-read-write')
+      # nothing broadcast yet:
+      self.assertFalse(photoapp.follow_initialize())
+      self.assertFalse(photoapp.context_outdated())
+
+      # another worker re-initializes (its generation isn't ours):
+      ours = photoapp._context_generation
+      photoapp.initialize('other.ini', 's3', 'user', broadcast=True)
+      photoapp._context_generation = ours
+
+      self.assertTrue(photoapp.context_outdated())
+      self.assertTrue(photoapp.follow_initialize())
+      self.assertEqual(built[-1], (os.path.abspath('other.ini'), 's3', 'user'))
+      self.assertFalse(photoapp.context_outdated())
+      self.assertFalse(photoapp.follow_initialize())
+      self.assertEqual(len(built), 3)
+
+    print("test passed!")
+
+  def test_05(self):
+    print()
+    print("** context test_05: admin commands bump the workers' catalog version **")
+
+    def relabel(**kwargs):
+      photoapp.bump_catalog_version()  # as store_labels does
+      return {'relabeled': 1, 'failed': 0, 'overloaded': False}
+
+    with tempfile.TemporaryDirectory() as d, \
+         mock.patch.object(photoapp, '_catalog', photoapp._catalog), \
+         mock.patch.object(photoapp, '_shared_settings', None), \
+         mock.patch.object(photoapp, 'initialize'), \
+         mock.patch.object(photoapp, 'relabel_pending', side_effect=relabel) as relabel_pending:
+      worker = context.SharedCatalogVersion(os.path.join(d, 'catalog-version'))
+      before = worker.get()
+      self.assertEqual(photoapp.main(['--state-dir', d, 'relabel']), 0)
+      self.assertNotEqual(worker.get(), before)
+      self.assertEqual(relabel_pending.call_args.kwargs['lock_path'], os.path.join(d, 'relabel.lock'))
+
+    print("test passed!")
+
+  def test_06(self):
+    print()
+    print("** context test_06: re-initializing invalidates the catalog and similarity index **")
+
+    class FakeAppContext:
+      def __init__(self, config_file, s3_profile, mysql_user):
+        pass
+
+      def close(self):
+        pass
+
+    index = similarity.SimilarityIndex()
+    index.add(1001, 0x1234)
+    index.ready = True
+
+    with mock.patch.object(context, 'AppContext', FakeAppContext), \
+         mock.patch.object(photoapp, '_context', None), \
+         mock.patch.object(photoapp, '_similar', index), \
+         mock.patch.object(photoapp, 'start_similarity_rebuild') as rebuild:
+      # the first initialize has nothing to invalidate:
+      photoapp.initialize('photoapp-config.ini', 's3readwrite', 'photoapp-read-write')
+      self.assertIs(photoapp._similar, index)
+      rebuild.assert_not_called()
+
+      before = photoapp.get_catalog_version()
+      photoapp.initialize('other.ini', 's3', 'user')
+      self.assertNotEqual(photoapp.get_catalog_version(), before)
+      # similarity queries fall back to SQL until the rebuild is done:
+      self.assertFalse(photoapp._similar.ready)
+      self.assertEqual(len(photoapp._similar), 0)
+      rebuild.assert_called_once()
+
+    print("test passed!")
+
+
+############################################################
+#
+# Admission control tests: token buckets and concurrency limits. Offline.
+#
+class LimitsTests(unittest.TestCase):
+
+  def test_01(self):
+    print()
+    print("** limits test_01: per-user and global token buckets **")
+
+    now = [0.0]
+    store = limits.BucketStore(clock=lambda: now[0])
+    admission = limits.Admission(user_rate=1, user_burst=2, global_rate=10, global_burst=3, store=store)
+
+    admission.check_rate(80001)
+    admission.check_rate(80001)
+    with self.assertRaises(limits.Overloaded) as cm:
+      admission.check_rate(80001)
+    self.assertAlmostEqual(cm.exception.retry_after, 1.0)
+
+    # another user is not affected by the first, until the global bucket runs dry:
+    admission.check_rate(80002)
+    with self.assertRaises(limits.Overloaded):
+      admission.check_rate(80003)
+    # ...and then the user's token is given back:
+    self.assertEqual(store.take("user:80003", 1, 2, 2), 0)
+
+    now[0] += 1.0
+    admission.check_rate(80001)
+
+    print("test passed!")
+
+  def test_02(self):
+    print()
+    print("** limits test_02: concurrency limit sheds beyond its queue **")
+
+    limit = limits.ConcurrencyLimit("uploads", 1, queue=0, retry_after=2)
+    with limit.slot():
+      self.assertTrue(limit.saturated())
+      with self.assertRaises(limits.Overloaded) as cm:
+        limit.acquire()
+      self.assertEqual(cm.exception.retry_after, 2)
+    self.assertFalse(limit.saturated())
+
+    queued = limits.ConcurrencyLimit("uploads", 1, queue=1)
+    queued.acquire()
+    with self.assertRaises(limits.Overloaded):
+      queued.acquire(timeout=0.01)
+    queued.release()
+    self.assertEqual((queued.active, queued.waiting), (0, 0))
+
+    print("test passed!")
+
+  def test_03(self):
+    print()
+    print("** limits test_03: buckets shared through a file **")
+
+    with tempfile.TemporaryDirectory() as d:
+      path = os.path.join(d, 'rate-limits')
+      a = limits.SharedBucketStore(path, slots=16, clock=lambda: 100.0)
+      b = limits.SharedBucketStore(path, slots=16, clock=lambda: 100.0)
+      self.assertEqual(a.take("user:1", 1, 2), 0)
+      self.assertEqual(b.take("user:1", 1, 2), 0)
+      self.assertGreater(a.take("user:1", 1, 2), 0)
+      self.assertEqual(b.take("user:2", 1, 2), 0)
+
+    print("test passed!")
+
+
+############################################################
+#
+# Reconciler tests: merge-join of storage and assets. Offline.
+#
+class ReconcilerTests(unittest.TestCase):
+
+  def test_01(self):
+    print()
+    print("** reconciler test_01: merge-join in key order **")
+
+    objects = [("u/a", 1), ("u/b", 2), ("u/d", 4)]
+    assets = [(1001, "u/a", None), (1002, "u/c", None), (1003, "u/d", None)]
+    merged = [(key, size, row and row[0]) for key, size, row in reconciler.merge(objects, assets)]
+    self.assertEqual(merged, [("u/a", 1, 1001), ("u/b", 2, None), ("u/c", None, 1002), ("u/d", 4, 1003)])
+
+    unsorted = reconciler._ascending(iter(["b", "a"]), lambda k: k, "keys")
+    with self.assertRaises(RuntimeError):
+      list(unsorted)
+
+    print("test passed!")
+
+  def test_02(self):
+    print()
+    print("** reconciler test_02: orphans found and cleaned up, page by page **")
+
+    import datetime
+
+    store = storage.MemoryStorage()
+    for key in ("u/a", "u/b", "u/d"):
+      store.put_stream(key, io.BytesIO(b"x" * 10))
+
+    created = datetime.datetime(2020, 1, 1)
+    conn = FakeConnection([
+      [{'rows': [(datetime.datetime(2030, 1, 1),)]}],                   # grace cutoff
+      [{'rows': [(1001, "u/a", created), (1002, "u/c", created)]}],     # assets page 1
+      [{'rows': [(1003, "u/d", created)]}],                             # assets page 2
+      [{'rows': []}],                                                   # orphan recheck
+      [{'rowcount': 0}],                                                # DELETE assetlabels
+      [{'rowcount': 1}],                                                # DELETE assets
+      [{'rowcount': 1}],                                                # bucket_stats
+    ])
+
+    report = reconciler.reconcile(store, conn, cleanup=True, grace=0, page_size=2, upload_grace=0)
+
+    self.assertEqual((report['orphan_objects'], report['missing_objects']), (1, 1))
+    self.assertEqual((report['deleted_objects'], report['deleted_assets']), (1, 1))
+    self.assertEqual((report['objects'], report['bytes'], report['assets']), (2, 20, 2))
+    self.assertEqual(report['samples'], {'orphan_objects': ["u/b"], 'missing_objects': ["u/c"]})
+    self.assertEqual([key for key, _ in store.iter_objects()], ["u/a", "u/d"])
+    self.assertEqual(conn.results, [])
+
+    print("test passed!")
+
+  def test_03(self):
+    print()
+    print("** reconciler test_03: orphans of uploads that may still finish are kept **")
+
+    import datetime
+
+    # an assembled chunked upload may wait up to its TTL for its asset row:
+    self.assertGreaterEqual(reconciler.UPLOAD_GRACE, uploads.UPLOAD_TTL)
+
+    store = storage.MemoryStorage()
+    for key in ("u/b", "u/e"):
+      store.put_stream(key, io.BytesIO(b"x" * 10))
+    store._modified["u/b"] = time.time() - 2 * reconciler.GRACE
+    store._modified["u/e"] = time.time() - 2 * reconciler.UPLOAD_GRACE
+
+    class RecordingConnection(FakeConnection):
+      def commit(self):
+        super().commit()
+        self.executed.append("COMMIT")
+
+    conn = RecordingConnection([
+      [{'rows': [(datetime.datetime(2030, 1, 1),)]}],   # grace cutoff
+      [{'rows': []}],                                   # assets page 1
+      [{'rows': []}],                                   # orphan recheck
+      [{'rowcount': 1}],                                # bucket_stats
+    ])
+
+    report = reconciler.reconcile(store, conn, cleanup=True)
+
+    # both are reported, only the one past the upload grace is deleted:
+    self.assertEqual(report['orphan_objects'], 2)
+    self.assertEqual(report['deleted_objects'], 1)
+    self.assertEqual([key for key, _ in store.iter_objects()], ["u/b"])
+    # the recheck runs in a fresh transaction, after the scan's snapshot:
+    recheck = next(i for i, sql in enumerate(conn.executed) if "WHERE bucketkey IN" in sql)
+    self.assertEqual(conn.executed[recheck - 1], "COMMIT")
+
+    print("test passed!")
+
+  def test_04(self):
+    print()
+    print("** reconciler test_04: command-line cleanup takes the workers' lock **")
+
+    with tempfile.TemporaryDirectory() as d, \
+         mock.patch.object(photoapp, '_catalog', photoapp._catalog), \
+         mock.patch.object(photoapp, '_shared_settings', None), \
+         mock.patch.object(photoapp, 'initialize'), \
+         mock.patch.object(photoapp, 'reconcile', return_value=None) as reconcile:
+      self.assertEqual(photoapp.main(['--state-dir', d, 'reconcile', '--cleanup']), 1)
+      self.assertEqual(reconcile.call_args.kwargs['lock_path'], os.path.join(d, 'reconcile.lock'))
+
+    print("test passed!")
+
+
+############################################################
+#
+# Metadata tests: header parsing on hand-built images. Offline.
+#
+def jpeg_with_exif(width, height, orientation, taken):
+  """
+  A JPEG header: APP1 EXIF (orientation, DateTimeOriginal) then SOF0.
+  """
+  import struct
+
+  tiff = b"II*\x00" + struct.pack("<I", 8)
+  tiff += struct.pack("<H", 2)
+  tiff += struct.pack("<HHIHH", 0x0112, 3, 1, orientation, 0)
+  tiff += struct.pack("<HHII", 0x8769, 4, 1, 38)
+  tiff += struct.pack("<I", 0)
+  tiff += struct.pack("<H", 1)
+  tiff += struct.pack("<HHII", 0x9003, 2, 20, 56)
+  tiff += struct.pack("<I", 0)
+  tiff += taken.encode("ascii") + b"\x00"
+
+  app1 = b"Exif\x00\x00" + tiff
+  sof = struct.pack(">BHHB", 8, height, width, 3) + b"\x01\x22\x00" * 3
+  return (b"\xff\xd8"
+          + b"\xff\xe1" + struct.pack(">H", len(app1) + 2) + app1
+          + b"\xff\xc0" + struct.pack(">H", len(sof) + 2) + sof
+          + b"\xff\xda")
+
+
+class MetadataTests(unittest.TestCase):
+
+  def test_01(self):
+    print()
+    print("** metadata test_01: JPEG dimensions and EXIF from the header **")
+
+    import datetime
+
+    head = jpeg_with_exif(640, 480, 6, "2024:05:17 10:30:00")
+    meta = metadata.extract(head)
+    self.assertEqual(meta, {
+      'mime': "image/jpeg", 'width': 640, 'height': 480,
+      'taken_at': datetime.datetime(2024, 5, 17, 10, 30), 'orientation': 6,
+    })
+
+    # a truncated header keeps what it has:
+    meta = metadata.extract(head[:40])
+    self.assertEqual((meta['mime'], meta['width']), ("image/jpeg", None))
+
+    print("test passed!")
+
+  def test_02(self):
+    print()
+    print("** metadata test_02: other formats, and header capture while streaming **")
+
+    import struct
+
+    png = b"\x89PNG\r\n\x1a\n" + struct.pack(">I", 13) + b"IHDR" + struct.pack(">II", 300, 200)
+    self.assertEqual(metadata.extract(png)['width'], 300)
+    self.assertEqual(metadata.extract(b"GIF89a" + struct.pack("<HH", 16, 9))['height'], 9)
+    self.assertEqual(metadata.extract(b"not an image")['mime'], None)
+
+    reader = storage.DigestReader(io.BytesIO(png + b"\x00" * 100), keep=20)
+    while reader.read(7):
+      pass
+    self.assertEqual(bytes(reader.head), png[:20])
+    self.assertEqual(metadata.hamming(0b1011, 0b0001), 2)
+
+    print("test passed!")
+
+
+class SimilarityTests(unittest.TestCase):
+
+  def test_01(self):
+    print()
+    print("** similarity test_01: index search matches a linear scan **")
+
+    import random
+
+    rng = random.Random(1)
+    hashes = {}
+    for cluster in range(300):
+      base = rng.getrandbits(64)
+      for _ in range(5):
+        h = base
+        for bit in rng.sample(range(64), rng.randint(0, 12)):
+          h ^= 1 << bit
+        hashes[len(hashes) + 1] = h
+
+    index = similarity.SimilarityIndex()
+    index.add_many(hashes.items())
+    self.assertEqual(len(index), len(hashes))
+
+    for query in (1, 17, 600):
+      h = hashes[query]
+      for distance in (0, 3, 6, 10, 13, 20):
+        expected = sorted((metadata.hamming(h, other), assetid)
+                          for assetid, other in hashes.items()
+                          if assetid != query and metadata.hamming(h, other) <= distance)
+        self.assertEqual(index.search(h, distance, exclude=query), expected)
+        self.assertEqual(index.search(h, distance, exclude=query, limit=3), expected[:3])
+
+    print("test passed!")
+
+  def test_02(self):
+    print()
+    print("** similarity test_02: rebuilt from the database, updated in place **")
+
+    saved = photoapp._similar
+    try:
+      conn = FakeConnection([
+        [{'rows': [(1001, 0b1111), (1002, 0b0111)]}],      # page 1
+        [{'rows': [(1003, 0xFFFF0000)]}],                  # page 2
+      ])
+      with mock.patch.object(photoapp, 'get_dbConn', return_value=conn), \
+           mock.patch.object(photoapp, 'SIMILAR_PAGE_SIZE', 2):
+        self.assertTrue(photoapp.rebuild_similarity_index())
+
+      index = photoapp._similar
+      self.assertTrue(index.ready)
+      self.assertEqual(index.search(0b1111, 1, exclude=1001), [(1, 1002)])
+
+      photoapp.index_similar(1004, 0b1110)
+      photoapp.index_similar(1002, None)
+      self.assertEqual(index.search(0b1111, 1, exclude=1001), [(1, 1004)])
+
+      row = (1004, 80001, "b.jpg", "u/b.jpg", 10, "image/jpeg", 1, 1, None, None)
+      conn = FakeConnection([[{'rows': [row]}]])
+      with mock.patch.object(photoapp, 'get_dbConn', return_value=conn):
+        self.assertEqual(photoapp.find_similar(1001, max_distance=1), [row + (1,)])
+      self.assertEqual(conn.round_trips, 1)
+
+      # get_images(similar_to) looks up bounded chunks of candidates,
+      # nearest first, until enough of them pass the other filters:
+      photoapp.index_similar(1005, 0b1101)
+      photoapp.index_similar(1006, 0b1011)
+      other = (1005, 80002, "c.jpg", "v/c.jpg", 10, "image/jpeg", 1, 1, None, None)
+      conn = FakeConnection([[{'rows': []}], [{'rows': [other]}]])
+      with mock.patch.object(photoapp, 'get_dbConn', return_value=conn):
+        found = photoapp.get_images(userid=80002, similar_to=1001, max_distance=1, similar_limit=1)
+      self.assertEqual(found, [other])
+      self.assertEqual(conn.round_trips, 2)
+
+      photoapp.clear_similar()
+      self.assertEqual(len(index), 0)
+    finally:
+      photoapp._similar = saved
+
+    print("test passed!")
+
+  def test_03(self):
+    print()
+    print("** similarity test_03: the API caps max_distance at what the index serves well **")
+
+    from fastapi.testclient import TestClient
+    import api
+
+    client = TestClient(api.app)
+    with mock.patch.object(photoapp, 'find_similar', return_value=[]) as find_similar, \
+         mock.patch.object(photoapp, 'get_images', return_value=[]) as get_images:
+      wide = similarity.MAX_DISTANCE + 1
+      self.assertEqual(client.get(f"/images/1001/similar?max_distance={wide}").status_code, 422)
+      self.assertEqual(client.get(f"/images?similar_to=1001&max_distance={wide}").status_code, 422)
+      find_similar.assert_not_called()
+      get_images.assert_not_called()
+
+      self.assertEqual(client.get(f"/images/1001/similar?max_distance={wide - 1}").status_code, 200)
+
+    print("test passed!")
+
+
+############################################################
+#
+# Import-time tests: importing photoapp (the CLI, client.py, a cold
+# API worker) must not load the AWS / MySQL SDKs, and must stay
+# within a startup budget. Offline.
+#
+IMPORT_BUDGET_MS = float(os.environ.get('PHOTOAPP_IMPORT_BUDGET_MS', 100))
+
+LAZY_MODULES = ('boto3', 'botocore', 'pymysql', 'tenacity')
+
+
+def import_times(module):
+  """
+  Runs python -X importtime -c "import module" in a fresh process and
+  returns {module name: cumulative microseconds}.
+  """
+  result = subprocess.run(
+    [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+    cwd=os.path.dirname(os.path.abspath(__file__)),
+    capture_output=True, text=True, check=True
+  )
+  times = {}
+  for line in result.stderr.splitlines():
+    if not line.startswith('import time:') or 'cumulative' in line:
+      continue
+    _, cumulative, name = line[len('import time:'):].split('|')
+    times[name.strip()] = int(cumulative)
+  return times
+
+
+class ImportTimeTests(unittest.TestCase):
+
+  def test_01(self):
+    print()
+    print("** import test_01: photoapp imports SDKs lazily, within budget **")
+
+    times = import_times('photoapp')
+    loaded = [name for name in LAZY_MODULES if name in times]
+    self.assertEqual(loaded, [])
+
+    elapsed = times['photoapp'] / 1000
+    print(f"import photoapp: {elapsed:.1f} ms (budget {IMPORT_BUDGET_MS:.0f} ms)")
+    self.assertLess(elapsed, IMPORT_BUDGET_MS)
+
+    print("test passed!")
+
+  def test_02(self):
+    print()
+    print("** import test_02: api imports SDKs lazily **")
+
+    times = import_times('api')
+    loaded = [name for name in LAZY_MODULES if name in times]
+    self.assertEqual(loaded, [])
+
+    print("test passed!")
+
 
 ############################################################
 #
@@ -0,0 +1,484 @@
+#
+# Resumable chunked uploads.
+#
+# Protocol (see the /uploads endpoints in api.py):
+#
+#   POST   /uploads/{userid}?filename=F&size=N   -> upload_id, chunk_size
+#   PUT    /uploads/{upload_id}/chunks/{n}       body = part n (from 1)
+#   GET    /uploads/{upload_id}                  -> parts received so far
+#   POST   /uploads/{upload_id}/complete         -> assetid
+#   DELETE /uploads/{upload_id}
+#
+# Every part but the last must be exactly chunk_size bytes; parts map
+# one-to-one onto storage multipart parts (S3 multipart upload), so at
+# most one chunk per request is ever held in memory. Re-sending a part
+# replaces it, and re-sending identical bytes is a no-op, so a client
+# that loses a response can simply retry. Uploads idle for longer than
+# the TTL are aborted and their parts discarded.
+#
+# Completing an upload has two phases: the parts are assembled into
+# the object, then the asset is created. The upload records which
+# phase finished, so if creating the asset fails, retrying the
+# completion resumes there rather than assembling again.
+#
+# Upload state lives in process memory (MemoryUploadStore), or, with
+# several worker processes, in files in the shared state directory
+# (SharedUploadStore), so any worker can serve any request.
+#
+
+import contextlib
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+
+import photoapp
+
+
+#
+# chunk size handed to clients; S3 requires every part but the last
+# to be at least 5 MiB:
+#
+CHUNK_SIZE = 8 * 1024 * 1024
+MIN_CHUNK_SIZE = 5 * 1024 * 1024
+
+#
+# S3 allows at most this many parts per multipart upload:
+#
+MAX_PARTS = 10000
+
+#
+# seconds an upload may sit idle before it is aborted:
+#
+UPLOAD_TTL = 24 * 60 * 60
+
+#
+# minimum seconds between sweeps for expired uploads:
+#
+SWEEP_INTERVAL = 60
+
+#
+# seconds after which a completion that never finished (its worker
+# died mid-way) no longer blocks a retry:
+#
+COMPLETE_TIMEOUT = 15 * 60
+
+
+class NoSuchUpload(KeyError):
+    """Raised for an unknown, completed or expired upload id."""
+
+
+class ChunkedUpload:
+    """
+    State of one in-progress chunked upload.
+    """
+
+    def __init__(self, userid, filename, bucketkey, storage_upload_id, size, now, upload_id=None):
+        self.upload_id = upload_id or uuid.uuid4().hex
+        self.userid = userid
+        self.filename = filename
+        self.bucketkey = bucketkey
+        self.storage_upload_id = storage_upload_id
+        self.size = size
+        self.created = now
+        self.touched = now
+        #
+        # when a completion started (None if none is running), and
+        # whether its first phase, assembling the parts into the
+        # object, has finished:
+        #
+        self.completing = None
+        self.assembled = False
+        self.lock = threading.Lock()
+        #
+        # part_number -> (etag, size, md5 of the bytes):
+        #
+        self.parts = {}
+
+    def received(self):
+        return sum(size for _, size, _ in self.parts.values())
+
+    def status(self):
+        return {
+            "upload_id": self.upload_id,
+            "userid": self.userid,
+            "filename": self.filename,
+            "size": self.size,
+            "received_bytes": self.received(),
+            "parts": sorted(self.parts),
+        }
+
+    _FIELDS = ("upload_id", "userid", "filename", "bucketkey", "storage_upload_id",
+               "size", "created", "touched", "completing", "assembled")
+
+    def to_dict(self):
+        d = {name: getattr(self, name) for name in self._FIELDS}
+        d["parts"] = {str(n): list(part) for n, part in self.parts.items()}
+        return d
+
+    @classmethod
+    def from_dict(cls, d):
+        upload = cls(d["userid"], d["filename"], d["bucketkey"], d["storage_upload_id"],
+                     d["size"], d["created"], d["upload_id"])
+        upload.touched = d["touched"]
+        upload.completing = d["completing"]
+        upload.assembled = d["assembled"]
+        upload.parts = {int(n): tuple(part) for n, part in d["parts"].items()}
+        return upload
+
+
+###################################################################
+#
+# upload stores
+#
+# locked(upload_id) holds the upload's lock and yields it (None if
+# there is no such upload); changes made inside are kept by save().
+#
+class MemoryUploadStore:
+    """
+    Uploads in this process's memory; a client must send every request
+    of an upload to the same worker process.
+    """
+
+    def __init__(self):
+        self._uploads = {}
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def locked(self, upload_id):
+        with self._lock:
+            upload = self._uploads.get(upload_id)
+        if upload is None:
+            yield None
+            return
+        with upload.lock:
+            # it may have been deleted while we waited for the lock:
+            yield upload if upload_id in self._uploads else None
+
+    def save(self, upload):
+        with self._lock:
+            self._uploads[upload.upload_id] = upload
+
+    def delete(self, upload_id):
+        with self._lock:
+            self._uploads.pop(upload_id, None)
+
+    def ids(self):
+        with self._lock:
+            return list(self._uploads)
+
+
+class SharedUploadStore:
+    """
+    Uploads as JSON files in a directory shared by the worker
+    processes on one host, so any of them can serve any request of an
+    upload. Each upload is guarded by an exclusive lock on its own
+    lock file; the JSON is replaced atomically on save.
+    """
+
+    def __init__(self, path):
+        import fcntl
+
+        self._fcntl = fcntl
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def _file(self, upload_id, suffix):
+        if not upload_id.isalnum():
+            return None
+        return os.path.join(self.path, upload_id + suffix)
+
+    @contextlib.contextmanager
+    def locked(self, upload_id):
+        filename = self._file(upload_id, ".json")
+        if filename is None or not os.path.exists(filename):
+            yield None
+            return
+        #
+        # each open() is its own lock holder, so this also excludes
+        # other threads of this process:
+        #
+        fd = os.open(self._file(upload_id, ".lock"), os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            self._fcntl.flock(fd, self._fcntl.LOCK_EX)
+            try:
+                with open(filename, encoding="utf-8") as f:
+                    upload = ChunkedUpload.from_dict(json.load(f))
+            except FileNotFoundError:
+                upload = None  # deleted while we waited
+            yield upload
+        finally:
+            os.close(fd)  # releases the lock
+
+    def save(self, upload):
+        filename = self._file(upload.upload_id, ".json")
+        temp = filename + ".tmp"
+        with open(temp, "w", encoding="utf-8") as f:
+            json.dump(upload.to_dict(), f)
+        os.replace(temp, filename)
+
+    def delete(self, upload_id):
+        for suffix in (".json", ".lock"):
+            try:
+                os.remove(self._file(upload_id, suffix))
+            except FileNotFoundError:
+                pass
+
+    def ids(self):
+        return [name[:-5] for name in os.listdir(self.path) if name.endswith(".json")]
+
+
+###################################################################
+#
+# UploadManager
+#
+class UploadManager:
+    """
+    Registry of in-progress chunked uploads, backed by the photoapp
+    begin_upload / upload_part / assemble_upload / complete_upload /
+    abort_upload functions.
+    """
+
+    def __init__(self, chunk_size=CHUNK_SIZE, ttl=UPLOAD_TTL, backend=photoapp, clock=time.time, store=None):
+        if chunk_size < MIN_CHUNK_SIZE and backend is photoapp:
+            logging.warning(f"uploads: chunk size {chunk_size} is below the S3 minimum part size")
+        self.chunk_size = chunk_size
+        self.ttl = ttl
+        self.backend = backend
+        self.clock = clock
+        self.store = store if store is not None else MemoryUploadStore()
+        self._last_sweep = clock()
+        #
+        # upload_id -> [SHA-256 of the image, md5s of the parts hashed]:
+        # fed part by part while this process receives the parts in
+        # order, so the image needn't be read back to hash it. None
+        # once a part arrives out of order or changes. At completion
+        # the hash is used only if the md5s match the upload's parts,
+        # since with a shared store other workers may have taken some.
+        #
+        self._hashes = {}
+        self._hashes_lock = threading.Lock()
+
+    def begin(self, userid, filename, size=None):
+        """
+        Starts an upload; size (total bytes) is optional but lets
+        chunks be validated as they arrive.
+        """
+        if size is not None and (size < 0 or size > self.chunk_size * MAX_PARTS):
+            raise ValueError(f"size must be between 0 and {self.chunk_size * MAX_PARTS}")
+
+        self.expire_if_due()
+
+        bucketkey, storage_upload_id = self.backend.begin_upload(userid, filename)
+        upload = ChunkedUpload(userid, filename, bucketkey, storage_upload_id, size, self.clock())
+        self.store.save(upload)
+        return upload
+
+    @contextlib.contextmanager
+    def _locked(self, upload_id):
+        with self.store.locked(upload_id) as upload:
+            if upload is None or self._expired(upload, self.clock()):
+                raise NoSuchUpload(upload_id)
+            yield upload
+
+    def get(self, upload_id):
+        with self._locked(upload_id) as upload:
+            return upload
+
+    def status(self, upload_id):
+        with self._locked(upload_id) as upload:
+            return upload.status()
+
+    def _expected_parts(self, upload):
+        if upload.size is None:
+            return None
+        return max(1, -(-upload.size // self.chunk_size))
+
+    def _check_part(self, upload, part_number, nbytes):
+        if not 1 <= part_number <= MAX_PARTS:
+            raise ValueError(f"part number must be between 1 and {MAX_PARTS}")
+        if nbytes > self.chunk_size:
+            raise ValueError(f"part is larger than the chunk size {self.chunk_size}")
+
+        expected = self._expected_parts(upload)
+        if expected is None:
+            return
+        if part_number > expected:
+            raise ValueError(f"upload of {upload.size} bytes has only {expected} parts")
+        if part_number < expected:
+            wanted = self.chunk_size
+        else:
+            wanted = upload.size - (expected - 1) * self.chunk_size
+        if nbytes != wanted:
+            raise ValueError(f"part {part_number} must be {wanted} bytes, got {nbytes}")
+
+    def _completing(self, upload, now):
+        return upload.completing is not None and now - upload.completing < COMPLETE_TIMEOUT
+
+    def put_chunk(self, upload_id, part_number, data):
+        """
+        Stores one part. Returns {'part', 'size', 'etag'}.
+        """
+        digest = hashlib.md5(data).hexdigest()
+
+        with self._locked(upload_id) as upload:
+            self._check_part(upload, part_number, len(data))
+            if upload.assembled or self._completing(upload, self.clock()):
+                raise ValueError("upload is being completed")
+            upload.touched = self.clock()
+            previous = upload.parts.get(part_number)
+            self.store.save(upload)
+
+        if previous is not None and previous[2] == digest:
+            #
+            # a retry of a part we already have:
+            #
+            return {"part": part_number, "size": previous[1], "etag": previous[0]}
+
+        etag = self.backend.upload_part(upload.bucketkey, upload.storage_upload_id, part_number, data)
+
+        with self._locked(upload_id) as upload:
+            upload.parts[part_number] = (etag, len(data), digest)
+            upload.touched = self.clock()
+            self.store.save(upload)
+
+        with self._hashes_lock:
+            hashed = self._hashes.setdefault(upload_id, [hashlib.sha256(), []])
+            if hashed[0] is not None:
+                if part_number == len(hashed[1]) + 1:
+                    hashed[0].update(data)
+                    hashed[1].append(digest)
+                elif part_number > len(hashed[1]) or hashed[1][part_number - 1] != digest:
+                    hashed[0] = None
+
+        return {"part": part_number, "size": len(data), "etag": etag}
+
+    def _content_hash(self, upload):
+        with self._hashes_lock:
+            hashed = self._hashes.get(upload.upload_id)
+            if hashed is None or hashed[0] is None:
+                return None
+            if hashed[1] != [upload.parts[n][2] for n in sorted(upload.parts)]:
+                return None
+            return hashed[0].hexdigest()
+
+    def complete(self, upload_id):
+        """
+        Assembles the parts into the image and creates the asset.
+        Returns the new assetid.
+
+        If creating the asset fails, the upload is left assembled and
+        a retry only creates the asset.
+        """
+        with self._locked(upload_id) as upload:
+            if self._completing(upload, self.clock()):
+                raise ValueError("upload is already being completed")
+
+            numbers = sorted(upload.parts)
+            if not numbers or numbers != list(range(1, len(numbers) + 1)):
+                raise ValueError(f"parts must be numbered 1..N without gaps, have {numbers}")
+            for n in numbers[:-1]:
+                if upload.parts[n][1] != self.chunk_size:
+                    raise ValueError(f"part {n} is {upload.parts[n][1]} bytes, expected {self.chunk_size}")
+            total = upload.received()
+            if upload.size is not None and total != upload.size:
+                raise ValueError(f"received {total} of {upload.size} bytes")
+
+            upload.completing = self.clock()
+            self.store.save(upload)
+
+        parts = [(n, upload.parts[n][0]) for n in numbers]
+        content_hash = self._content_hash(upload)
+
+        try:
+            if not upload.assembled:
+                self.backend.assemble_upload(upload.bucketkey, upload.storage_upload_id, parts)
+                with self._locked(upload_id) as upload:
+                    upload.assembled = True
+                    self.store.save(upload)
+
+            assetid = self.backend.complete_upload(
+                upload.userid, upload.filename, upload.bucketkey, total, content_hash
+            )
+        except ValueError:
+            #
+            # the asset can never be created (e.g. the user is gone):
+            #
+            if not upload.assembled:
+                self._release(upload_id)
+                raise
+            self._forget(upload_id)
+            self._discard(upload)
+            raise
+        except Exception:
+            self._release(upload_id)
+            raise
+
+        self._forget(upload_id)
+        return assetid
+
+    def _release(self, upload_id):
+        """Ends a failed completion so it can be retried."""
+        with self.store.locked(upload_id) as upload:
+            if upload is not None:
+                upload.completing = None
+                upload.touched = self.clock()
+                self.store.save(upload)
+
+    def _forget(self, upload_id):
+        self.store.delete(upload_id)
+        with self._hashes_lock:
+            self._hashes.pop(upload_id, None)
+
+    def _discard(self, upload):
+        """Removes an upload's parts, or its object once assembled."""
+        try:
+            self.backend.abort_upload(upload.bucketkey, upload.storage_upload_id, upload.assembled)
+        except Exception as err:
+            logging.warning(f"uploads: abort of {upload.upload_id} failed: {err}")
+
+    def abort(self, upload_id):
+        with self._locked(upload_id) as upload:
+            if self._completing(upload, self.clock()):
+                raise ValueError("upload is being completed")
+            self.store.delete(upload_id)
+        with self._hashes_lock:
+            self._hashes.pop(upload_id, None)
+        self.backend.abort_upload(upload.bucketkey, upload.storage_upload_id, upload.assembled)
+
+    def _expired(self, upload, now):
+        return not self._completing(upload, now) and now - upload.touched > self.ttl
+
+    def expire(self):
+        """
+        Aborts every upload idle for longer than the TTL; returns how
+        many were aborted.
+        """
+        now = self.clock()
+        self._last_sweep = now
+
+        expired = []
+        for upload_id in self.store.ids():
+            with self.store.locked(upload_id) as upload:
+                if upload is not None and self._expired(upload, now):
+                    self.store.delete(upload_id)
+                    expired.append(upload)
+
+        live = set(self.store.ids())
+        with self._hashes_lock:
+            for upload_id in list(self._hashes):
+                if upload_id not in live:
+                    del self._hashes[upload_id]
+
+        for upload in expired:
+            logging.info(f"uploads: expiring {upload.upload_id} ({upload.filename})")
+            self._discard(upload)
+
+        return len(expired)
+
+    def expire_if_due(self):
+        if self.clock() - self._last_sweep >= SWEEP_INTERVAL:
+            self.expire()
@@ -1,5 +1,5 @@
 
-import { useState } from 'react';
+import { useEffect, useState } from 'react';
 import { UploadZone } from '../components/UploadZone';
 import { AnimatePresence, motion } from 'framer-motion';
 import { Toaster, toast } from 'sonner';
@@ -7,8 +7,12 @@ import { ImageIcon, LayoutGrid, Info, Camera } from 'lucide-react';
 
 import {
   getUsers,
-  getImages,
+  getImagesWithLabels,
+  getLabelsBatch,
+  subscribeToEvents,
+  toLabels,
   uploadImage,
+  uploadImageChunked,
   getImageLabels,
   searchImagesByLabel,
   downloadImage,
@@ -18,6 +22,9 @@ import {
   type Label
 } from "../lib/api";
 
+// files larger than this are sent as resumable chunked uploads
+const CHUNKED_UPLOAD_THRESHOLD = 8 * 1024 * 1024;
+
 export default function App() {
   
   const [users, setUsers] = useState<User[]>([]);
@@ -26,6 +33,19 @@ export default function App() {
   const [searchLabel, setSearchLabel] = useState("");
   const [labels, setLabels] = useState<Record<number, Label[]>>({});
 
+  // labels arrive asynchronously after an upload; apply them as they're pushed
+  useEffect(() => {
+    if (!selectedUser) return;
+    return subscribeToEvents(
+      {
+        "labels-ready": (event) => {
+          setLabels(prev => ({ ...prev, [event.assetid]: toLabels(event.labels ?? []) }));
+        },
+      },
+      selectedUser
+    );
+  }, [selectedUser]);
+
   const btn =
     "px-4 py-2 rounded-lg font-medium transition-colors duration-150 focus:outline-none focus:ring-2 focus:ring-offset-2 disabled:opacity-50 disabled:cursor-not-allowed";
 
@@ -42,13 +62,17 @@ export default function App() {
 
     try {
       for (const file of newFiles) {
-        await uploadImage(selectedUser, file);
+        if (file.size > CHUNKED_UPLOAD_THRESHOLD) {
+          await uploadImageChunked(selectedUser, file);
+        } else {
+          await uploadImage(selectedUser, file);
+        }
       }
 
       toast.success("Upload complete");
-      const imgs = await getImages(selectedUser);
+      const { images: imgs, labels: imgLabels } = await getImagesWithLabels(selectedUser);
       setImages(imgs);
-      setLabels({});
+      setLabels(imgLabels);
     } catch (error) {
       toast.error("Upload failed");
       console.error(error);
@@ -130,9 +154,9 @@ export default function App() {
                   return;
                 }
                 try {
-                  const data = await getImages(selectedUser);
+                  const { images: data, labels: imgLabels } = await getImagesWithLabels(selectedUser);
                   setImages(data);
-                  setLabels({});
+                  setLabels(imgLabels);
                   toast.success("Images loaded");
                 } catch (error) {
                   toast.error("Failed to load images");
@@ -168,7 +192,7 @@ export default function App() {
                     bucketkey: ""
                   }));
                   setImages(imageData);
-                  setLabels({});
+                  setLabels(await getLabelsBatch([...new Set(imageData.map(img => img.assetid))]));
                   toast.success(`Found ${results.length} images`);
                 } catch (error) {
                   toast.error("Search failed");
@@ -2,15 +2,25 @@ import axios from "axios";
 import type {
   User,
   Image,
+  ImageFilters,
   Label,
   ImageLabel,
   PingResponse,
   InitializeResponse,
   UploadResponse,
+  BeginUploadResponse,
+  UploadStatusResponse,
   DeleteResponse,
   UsersResponse,
   ImagesResponse,
+  SimilarImage,
+  SimilarImagesResponse,
+  ImagesWithLabelsResponse,
   ImageLabelsResponse,
+  LabelBatchResponse,
+  LabelPair,
+  PhotoEvent,
+  PhotoEventType,
   LabelSearchResponse,
 } from "./types";
 
@@ -46,13 +56,60 @@ export async function getUsers(): Promise<User[]> {
   return data.users;
 }
 
-export async function getImages(userid?: number): Promise<Image[]> {
+export async function getImages(
+  userid?: number,
+  filters: ImageFilters = {}
+): Promise<Image[]> {
   const { data } = await api.get<ImagesResponse>("/images", {
-    params: userid ? { userid } : {},
+    params: userid ? { userid, ...filters } : filters,
   });
   return data.images;
 }
 
+export function toLabels(pairs: LabelPair[]): Label[] {
+  return pairs.map(([label, confidence]) => ({ label, confidence }));
+}
+
+export async function getImagesWithLabels(
+  userid?: number
+): Promise<{ images: Image[]; labels: Record<number, Label[]> }> {
+  const { data } = await api.get<ImagesWithLabelsResponse>("/images", {
+    params: userid ? { userid, include: "labels" } : { include: "labels" },
+  });
+  const labels: Record<number, Label[]> = {};
+  const images = data.images.map(({ labels: pairs, ...image }) => {
+    labels[image.assetid] = toLabels(pairs);
+    return image;
+  });
+  return { images, labels };
+}
+
+// Max assetids per POST /labels/batch (the server's MAX_LABEL_BATCH).
+export const MAX_LABEL_BATCH = 1000;
+
+// Labels for any number of assets; larger lists are split into
+// requests of at most MAX_LABEL_BATCH ids, sent concurrently.
+export async function getLabelsBatch(
+  assetids: number[]
+): Promise<Record<number, Label[]>> {
+  const chunks: number[][] = [];
+  for (let i = 0; i < assetids.length; i += MAX_LABEL_BATCH) {
+    chunks.push(assetids.slice(i, i + MAX_LABEL_BATCH));
+  }
+  const responses = await Promise.all(
+    chunks.map((chunk) =>
+      api.post<LabelBatchResponse>("/labels/batch", { assetids: chunk })
+    )
+  );
+  const labels: Record<number, Label[]> = {};
+  for (const { data } of responses) {
+    for (const [assetid, pairs] of Object.entries(data.labels)) {
+      labels[Number(assetid)] = toLabels(pairs);
+    }
+  }
+  return labels;
+}
+
 export async function uploadImage(
   userid: number,
   file: File
@@ -72,6 +129,56 @@ export async function uploadImage(
   return data;
 }
 
+// Uploads a file in chunks so an interrupted upload resumes instead of
+// restarting; each chunk is retried a few times before giving up.
+export async function uploadImageChunked(
+  userid: number,
+  file: File,
+  onProgress?: (sentBytes: number, totalBytes: number) => void,
+  maxRetries = 3
+): Promise<UploadResponse> {
+  const { data: upload } = await api.post<BeginUploadResponse>(
+    `/uploads/${userid}`,
+    null,
+    { params: { filename: file.name, size: file.size } }
+  );
+  return resumeChunkedUpload(upload.upload_id, upload.chunk_size, file, onProgress, maxRetries);
+}
+
+export async function resumeChunkedUpload(
+  uploadId: string,
+  chunkSize: number,
+  file: File,
+  onProgress?: (sentBytes: number, totalBytes: number) => void,
+  maxRetries = 3
+): Promise<UploadResponse> {
+  const { data: status } = await api.get<UploadStatusResponse>(`/uploads/${uploadId}`);
+  const received = new Set(status.parts);
+  const partCount = Math.max(1, Math.ceil(file.size / chunkSize));
+  let sent = status.received_bytes;
+
+  for (let part = 1; part <= partCount; part++) {
+    if (received.has(part)) continue;
+    const chunk = file.slice((part - 1) * chunkSize, part * chunkSize);
+    for (let attempt = 0; ; attempt++) {
+      try {
+        await api.put(`/uploads/${uploadId}/chunks/${part}`, chunk, {
+          headers: { "Content-Type": "application/octet-stream" },
+        });
+        break;
+      } catch (error) {
+        if (attempt >= maxRetries) throw error;
+        await new Promise(resolve => setTimeout(resolve, 1000 * 2 ** attempt));
+      }
+    }
+    sent += chunk.size;
+    onProgress?.(sent, file.size);
+  }
+
+  const { data } = await api.post<UploadResponse>(`/uploads/${uploadId}/complete`);
+  return data;
+}
+
 export async function downloadImage(assetid: number): Promise<Blob> {
   const { data } = await api.get<Blob>(`/images/${assetid}/download`, {
     responseType: "blob",
@@ -91,9 +198,40 @@ export async function getImageLabels(assetid: number): Promise<Label[]> {
   return data.labels;
 }
 
+// Near-duplicates of an image, nearest (smallest hash distance) first.
+export async function getSimilarImages(
+  assetid: number,
+  maxDistance?: number
+): Promise<SimilarImage[]> {
+  const { data } = await api.get<SimilarImagesResponse>(
+    `/images/${assetid}/similar`,
+    { params: maxDistance === undefined ? {} : { max_distance: maxDistance } }
+  );
+  return data.images;
+}
+
 export async function searchImagesByLabel(
   label: string
 ): Promise<ImageLabel[]> {
   const { data } = await api.get<LabelSearchResponse>(`/labels/${label}`);
   return data.images;
 }
+
+// Subscribes to upload / labeling progress (Server-Sent Events);
+// returns a function that closes the stream.
+export function subscribeToEvents(
+  handlers: Partial<Record<PhotoEventType, (event: PhotoEvent) => void>>,
+  userid?: number
+): () => void {
+  const url = new URL("/events", API_BASE_URL);
+  if (userid) {
+    url.searchParams.set("userid", String(userid));
+  }
+  const source = new EventSource(url);
+  for (const [type, handler] of Object.entries(handlers)) {
+    source.addEventListener(type, (e) =>
+      handler?.(JSON.parse((e as MessageEvent).data) as PhotoEvent)
+    );
+  }
+  return () => source.close();
+}
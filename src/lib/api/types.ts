@@ -10,6 +10,20 @@ export interface Image {
   userid: number;
   localname: string;
   bucketkey: string;
+  size?: number | null;
+  mime?: string | null;
+  width?: number | null;
+  height?: number | null;
+  taken_at?: string | null;
+  orientation?: number | null;
+}
+
+export interface ImageFilters {
+  min_width?: number;
+  taken_after?: string;
+  similar_to?: number;
+  max_distance?: number;
+  similar_limit?: number;
 }
 
 export interface Label {
@@ -38,6 +52,21 @@ export interface UploadResponse {
   message: string;
 }
 
+export interface BeginUploadResponse {
+  upload_id: string;
+  chunk_size: number;
+  expires_in: number;
+}
+
+export interface UploadStatusResponse {
+  upload_id: string;
+  userid: number;
+  filename: string;
+  size: number | null;
+  received_bytes: number;
+  parts: number[];
+}
+
 export interface DeleteResponse {
   success: boolean;
   message: string;
@@ -51,6 +80,29 @@ export interface ImagesResponse {
   images: Image[];
 }
 
+export interface SimilarImage extends Image {
+  distance: number;
+}
+
+export interface SimilarImagesResponse {
+  images: SimilarImage[];
+}
+
+// [label, confidence] pairs, as returned by the bulk label endpoints
+export type LabelPair = [string, number];
+
+export interface ImageWithLabels extends Image {
+  labels: LabelPair[];
+}
+
+export interface ImagesWithLabelsResponse {
+  images: ImageWithLabels[];
+}
+
+export interface LabelBatchResponse {
+  labels: Record<string, LabelPair[]>;
+}
+
 export interface ImageLabelsResponse {
   assetid: number;
   labels: Label[];
@@ -60,3 +112,24 @@ export interface LabelSearchResponse {
   label: string;
   images: ImageLabel[];
 }
+
+export type PhotoEventType =
+  | "asset-created"
+  | "upload-progress"
+  | "labels-ready"
+  | "upload-failed";
+
+export interface PhotoEvent {
+  id: number;
+  type: PhotoEventType;
+  time: number;
+  // null until the asset row exists (upload-progress, upload-failed)
+  assetid: number | null;
+  userid: number;
+  bucketkey?: string;
+  bytes_sent?: number;
+  total_bytes?: number;
+  label_status?: string;
+  labels?: LabelPair[];
+  error?: string;
+}